@@ -0,0 +1,129 @@
+import argparse
+import os
+import re
+import time
+import files.porter as porter
+from instrumentation import count, stage
+
+# Punctuation and digits are removed before splitting into words
+CLEAN_PATTERN = re.compile(r"[^\w\s]|[\d]")
+
+
+# Stopwords as a frozenset, so every membership test is a hash lookup
+def read_stopwords(stopwords_file_path):
+    with open(stopwords_file_path, 'r', encoding='utf-8') as file:
+        return frozenset(file.read().splitlines())
+
+
+def clean_text(text):
+    return CLEAN_PATTERN.sub('', text)
+
+
+# Stem a list of words, through the batch API of CachedPorterStemmer when the stemmer has it
+def stem_words(words, p):
+    if hasattr(p, "stem_many"):
+        return p.stem_many(words)
+    return [p.stem(word) for word in words]
+
+
+# Words of a text that are not stopwords, cleaning and stopword filtering timed as separate stages
+def filter_tokens(text, stopwords):
+    with stage("clean"):
+        words = clean_text(text).split()
+    with stage("stopwords"):
+        tokens = [word for word in words if word not in stopwords]
+    count("tokens", len(words))
+    return tokens
+
+
+# tokenize -> stopword -> stem, the analysis used for documents and queries
+def analyze(text, stopwords, p):
+    tokens = filter_tokens(text, stopwords)
+    with stage("stem"):
+        return stem_words(tokens, p)
+
+
+# Analyse (doc_id, text) pairs chunk by chunk, the words of a whole chunk are stemmed in one batch
+def analyze_bulk(documents, stopwords, p, chunk_size=256):
+    chunk = []
+    for doc_id, text in documents:
+        chunk.append((doc_id, filter_tokens(text, stopwords)))
+        if len(chunk) >= chunk_size:
+            yield from stem_chunk(chunk, p)
+            chunk = []
+    yield from stem_chunk(chunk, p)
+
+
+def stem_chunk(chunk, p):
+    with stage("stem"):
+        stems = stem_words([word for doc_id, words in chunk for word in words], p)
+    position = 0
+    for doc_id, words in chunk:
+        yield doc_id, stems[position:position + len(words)]
+        position += len(words)
+
+
+# The analysis as the search scripts used to do it: uncompiled regex, stopword list and no stem cache
+def analyze_uncached(text, stopwords, p):
+    clean_words = []
+    for word in re.sub(r"[^\w\s]|[\d]", '', text).split():
+        if word not in stopwords:
+            clean_words.append(p.stem(word))
+    return clean_words
+
+
+# Tokens per second of each way to analyse a corpus
+def benchmark(documents, stopwords_path, repeat=3):
+    stopword_list = list(read_stopwords(stopwords_path))
+    stopwords = read_stopwords(stopwords_path)
+    runs = {
+        "uncached": lambda: [analyze_uncached(text, stopword_list, porter.PorterStemmer())
+                             for text in documents.values()],
+        "pipeline": lambda: [analyze(text, stopwords, p) for text in documents.values()],
+        "bulk": lambda: list(analyze_bulk(documents.items(), stopwords, p)),
+    }
+    tokens = sum(len(text.split()) for text in documents.values())
+    rates = {}
+    for name, run in runs.items():
+        best = float("inf")
+        for _ in range(repeat):
+            # Every run starts with an empty stem cache
+            p = porter.CachedPorterStemmer()
+            start = time.perf_counter()
+            run()
+            best = min(best, time.perf_counter() - start)
+        rates[name] = tokens / best
+    return tokens, rates
+
+
+# Lower-case text of every document in a folder, sub folders are read as in the large corpus layout
+def read_folder(folder_path):
+    documents = {}
+    for name in os.listdir(folder_path):
+        path = os.path.join(folder_path, name)
+        if os.path.isdir(path):
+            documents.update(read_folder(path))
+        else:
+            with open(path, 'r', encoding='utf-8') as file:
+                documents[name] = file.read().lower()
+    return documents
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Tokenisation benchmark')
+    parser.add_argument('folders', nargs='*', default=["documents_2", "documents"],
+                        help='Document folders, flat or with one sub folder per group of documents')
+    args = parser.parse_args()
+
+    stopwords_path = os.path.join(script_dir, "files", "stopwords.txt")
+    for folder in args.folders:
+        documents = read_folder(os.path.join(script_dir, folder))
+        tokens, rates = benchmark(documents, stopwords_path)
+        print(f"{folder}: {tokens} tokens")
+        for name, rate in rates.items():
+            print(f"  {name:<10}{rate:>14,.0f} tokens/s")
+
+
+if __name__ == '__main__':
+    main()
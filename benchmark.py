@@ -0,0 +1,242 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import files.porter as porter
+import search_large_corpus
+import search_small_corpus
+from analyzer import analyze, read_stopwords
+from bm25_matrix import BM25Matrix, bm25_batch, np
+from document_store import LazyDocuments
+from sharded_index import shard_scaling
+from synthetic_corpus import generate
+
+# Code path -> (document folder, layout the code reads, index files written in the working directory)
+CODE_PATHS = {
+    "small": ("documents_2", False, ["index.txt", "index.bin", "index_stems.json", "documents.store"]),
+    "large": ("documents", True, ["index.json", "index_large.bin", "index_large_stems.json"]),
+}
+# Metric -> whether a larger value is better, used to flag regressions against a baseline
+METRICS = {
+    "build_seconds": False, "load_seconds": False, "index_bytes": False,
+    "build_peak_rss_kb": False, "load_peak_rss_kb": False,
+    "p50_ms": False, "p95_ms": False, "p99_ms": False,
+    "qps": True, "batch_qps": True,
+}
+
+
+# Copy a corpus of either layout scale times under new numeric ids into the flat or nested layout,
+# hard links keep large copies cheap
+def scale_corpus(source, target, scale, nested):
+    paths = {}
+    for name in os.listdir(source):
+        path = os.path.join(source, name)
+        if os.path.isdir(path):
+            for file_name in os.listdir(path):
+                paths[file_name] = os.path.join(path, file_name)
+        else:
+            paths[name] = path
+    stride = 10 ** len(str(max(int(name) for name in paths)))
+    os.makedirs(target, exist_ok=True)
+    for copy in range(scale):
+        for name, path in paths.items():
+            doc_id = str(copy * stride + int(name))
+            folder = os.path.join(target, doc_id) if nested else target
+            os.makedirs(folder, exist_ok=True)
+            try:
+                os.link(path, os.path.join(folder, doc_id))
+            except OSError:
+                shutil.copyfile(path, os.path.join(folder, doc_id))
+
+
+# Build or load the index of a code path in the current directory, as automatic() does
+def open_index(code, documents_path, p, stopwords):
+    if code == "large":
+        index, postings, avg_doclen = search_large_corpus.create_index(documents_path, p)
+    else:
+        documents = LazyDocuments(search_small_corpus.read_documents_info, documents_path)
+        index, postings, avg_doclen = search_small_corpus.create_index(documents, stopwords, p)
+    return postings
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+# One phase in a fresh process, so timings and peak RSS are not shared between phases
+# build: index build from the documents, load: index load and queries, then the queries on local shard nodes
+def run_phase(phase, code, documents_path, queries_path, repeat, shard_counts=()):
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    stopwords = read_stopwords(os.path.join(script_dir, "files", "stopwords.txt"))
+    p = porter.CachedPorterStemmer()
+    start_time = time.perf_counter()
+    postings = open_index(code, documents_path, p, stopwords)
+    result = {"seconds": time.perf_counter() - start_time, "documents": len(postings)}
+    # Peak RSS of the build or load alone, before the queries, the matrix and the shard runs add to it
+    # ru_maxrss is in kilobytes on Linux
+    result["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if phase == "build":
+        result["index_bytes"] = sum(os.path.getsize(name) for name in CODE_PATHS[code][2] if os.path.exists(name))
+    else:
+        queries = []
+        with open(queries_path, "r") as queries_file:
+            for query in queries_file:
+                queries.append(analyze(" ".join(query.strip().split(" ")[1:]).strip(), stopwords, p))
+        latencies = []
+        for _ in range(repeat):
+            for query in queries:
+                query_start = time.perf_counter()
+                search_small_corpus.bm25_model(query, postings, 1, 0.75)
+                latencies.append(time.perf_counter() - query_start)
+        latencies.sort()
+        result.update({
+            "queries": len(queries),
+            "p50_ms": 1000 * percentile(latencies, 0.5),
+            "p95_ms": 1000 * percentile(latencies, 0.95),
+            "p99_ms": 1000 * percentile(latencies, 0.99),
+            "qps": len(latencies) / sum(latencies),
+            "batch_qps": None,
+        })
+        if np is not None:
+            matrix = BM25Matrix(postings)
+            batch_start = time.perf_counter()
+            for _ in range(repeat):
+                bm25_batch(queries, matrix)
+            result["batch_qps"] = repeat * len(queries) / (time.perf_counter() - batch_start)
+        # Shard files are written in the working directory
+        result["shards"] = shard_scaling(postings, queries, shard_counts, "index_shards", repeat=repeat)
+    return result
+
+
+def measure(code, documents_path, queries_path, work_dir, repeat, shard_counts=()):
+    phases = {}
+    for phase in ("build", "load"):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--phase", phase, "--code", code,
+                                 "--documents", documents_path, "--queries", queries_path, "--repeat", str(repeat),
+                                 "--shards", *[str(count) for count in shard_counts]],
+                                cwd=work_dir, capture_output=True, text=True, check=True).stdout
+        # The index code prints progress, the result is the last line
+        phases[phase] = json.loads(output.strip().splitlines()[-1])
+    build, load = phases["build"], phases["load"]
+    return {
+        "documents": build["documents"],
+        "build_seconds": build["seconds"], "load_seconds": load["seconds"], "index_bytes": build["index_bytes"],
+        "build_peak_rss_kb": build["peak_rss_kb"], "load_peak_rss_kb": load["peak_rss_kb"],
+        "queries": load["queries"], "p50_ms": load["p50_ms"], "p95_ms": load["p95_ms"], "p99_ms": load["p99_ms"],
+        "qps": load["qps"], "batch_qps": load["batch_qps"],
+        "shard_scaling": load["shards"],
+    }
+
+
+# Metrics more than tolerance worse than the baseline run with the same code path, corpus, scale and corpus kind
+def compare(results, baseline, tolerance):
+    base_runs = {(run["code"], run["corpus"], run["scale"], run.get("synthetic", False)): run
+                 for run in baseline["results"]}
+    regressions = []
+    for run in results:
+        base = base_runs.get((run["code"], run["corpus"], run["scale"], run["synthetic"]))
+        if base is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            new, old = run.get(metric), base.get(metric)
+            if new is None or not old:
+                continue
+            change = (new - old) / old
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append({"code": run["code"], "corpus": run["corpus"], "scale": run["scale"],
+                                    "metric": metric, "baseline": old, "value": new, "change": change})
+    return regressions
+
+
+def environment():
+    return {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+            "numpy": np.__version__ if np is not None else None, "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Index and query benchmark of both search code paths')
+    parser.add_argument('--codes', nargs='+', choices=list(CODE_PATHS), default=list(CODE_PATHS),
+                        help='Code paths to measure, small on documents_2 and large on documents')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 4],
+                        help='Corpus sizes as multiples of the original corpus')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of the query file per measurement')
+    parser.add_argument('-o', '--output', default="benchmark.json", help='JSON file to write the results to')
+    parser.add_argument('--baseline', default="benchmark_baseline.json", help='Stored baseline to compare with')
+    parser.add_argument('--save-baseline', action='store_true', help='Store these results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative change of a metric that counts as a regression')
+    parser.add_argument('--synthetic', action='store_true',
+                        help='Scale with synthetic corpora and queries fitted on each corpus instead of copies')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic corpora')
+    parser.add_argument('--shards', type=int, nargs='*', default=[1, 2, 4],
+                        help='Shard counts whose scatter-gather query throughput is measured, none to skip')
+    # Internal: a single phase run in a child process
+    parser.add_argument('--phase', choices=['build', 'load'], help=argparse.SUPPRESS)
+    parser.add_argument('--code', choices=list(CODE_PATHS), help=argparse.SUPPRESS)
+    parser.add_argument('--documents', help=argparse.SUPPRESS)
+    parser.add_argument('--queries', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.phase:
+        print(json.dumps(run_phase(args.phase, args.code, args.documents, args.queries, args.repeat, args.shards)))
+        return
+
+    results = []
+    temp_dir = tempfile.mkdtemp(prefix="benchmark_")
+    try:
+        for code in args.codes:
+            folder, nested, index_files = CODE_PATHS[code]
+            for scale in args.scales:
+                # The corpus is laid out as the code path reads it, documents/ is flat in this repository
+                documents_path = os.path.join(temp_dir, f"{folder}_x{scale}")
+                queries_path = os.path.join(script_dir, "files", "queries.txt")
+                if args.synthetic:
+                    queries_path = generate(os.path.join(script_dir, folder), queries_path, documents_path, scale,
+                                            nested, args.seed)[2]
+                else:
+                    scale_corpus(os.path.join(script_dir, folder), documents_path, scale, nested)
+                work_dir = os.path.join(temp_dir, f"work_{code}_x{scale}")
+                os.makedirs(work_dir)
+                run = {"code": code, "corpus": folder, "scale": scale, "synthetic": args.synthetic}
+                run.update(measure(code, documents_path, queries_path, work_dir, args.repeat, args.shards))
+                results.append(run)
+                print(f"{code} {folder} x{scale}: {run['documents']} documents, build {run['build_seconds']:.2f} s, "
+                      f"load {run['load_seconds']:.2f} s, {run['index_bytes']} bytes, "
+                      f"p50/p95/p99 {run['p50_ms']:.2f}/{run['p95_ms']:.2f}/{run['p99_ms']:.2f} ms, "
+                      f"{run['qps']:.0f} queries/s")
+                for row in run["shard_scaling"]:
+                    print(f"  {row['shards']} shards: {row['qps']:.0f} queries/s, "
+                          f"same rankings as one index: {row['exact']}")
+                shutil.rmtree(documents_path)
+                shutil.rmtree(work_dir)
+                if args.synthetic:
+                    os.remove(queries_path)
+    finally:
+        shutil.rmtree(temp_dir)
+
+    report = {"environment": environment(), "tolerance": args.tolerance, "results": results, "regressions": []}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as file:
+            report["regressions"] = compare(results, json.load(file), args.tolerance)
+        for regression in report["regressions"]:
+            print(f"REGRESSION {regression['code']} x{regression['scale']} {regression['metric']}: "
+                  f"{regression['baseline']:.4g} -> {regression['value']:.4g} ({regression['change']:+.0%})")
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2)
+    if args.save_baseline:
+        shutil.copyfile(args.output, args.baseline)
+        print(f"Stored baseline {args.baseline}")
+    if report["regressions"]:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+import mmap
+import os
+import shutil
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from postings_codec import decode_postings_fast, encode_postings
+
+# Layout of an index file, all numbers little-endian:
+#   header        magic, version, document and term counts, collection stats, section offsets, postings codec
+#   doc_lens      uint32 * num_docs
+#   doc_id_offs   uint32 * (num_docs + 1), offsets into doc_id_blob
+#   doc_id_blob   utf-8 document IDs
+#   term_offs     uint32 * (num_terms + 1), offsets into term_blob
+#   term_blob     utf-8 terms in sorted order
+#   term_table    (idf, df, postings offset, score upper bound) per term
+#   postings      uint32 doc ids followed by uint32 term frequencies per term, or the bytes of a postings codec
+# Version 1 files have no codec field and always store uint32 postings.
+MAGIC = b"BM25IDX\0"
+FORMAT_VERSION = 2
+HEADER_V1 = struct.Struct("<8sIIIQdddQQQQQQ")
+HEADER = struct.Struct("<8sIIIQdddQQQQQQI")
+TERM_ENTRY = struct.Struct("<dQQd")
+CODEC_IDS = {"raw": 0, "varint": 1, "bitpack": 2}
+
+
+# Read-only view of an index file, opened with mmap so pages are shared between processes
+class BinaryIndex:
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.file = open(file_path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        magic, version = struct.unpack_from("<8sI", self.map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{file_path} is not a BM25 index file")
+        if version == 1:
+            header = HEADER_V1.unpack_from(self.map, 0) + (CODEC_IDS["raw"],)
+        elif version == FORMAT_VERSION:
+            header = HEADER.unpack_from(self.map, 0)
+        else:
+            raise ValueError(f"{file_path} has index format version {version}, expected at most {FORMAT_VERSION}")
+        (magic, version, self.num_docs, self.num_terms, self.total_len, self.avg_doclen, self.k, self.b,
+         doc_lens_off, doc_id_offs_off, doc_id_blob_off, term_offs_off, term_blob_off,
+         term_table_off, codec_id) = header
+        self.version = version
+        self.codec = {codec_id: codec for codec, codec_id in CODEC_IDS.items()}[codec_id]
+        self.doc_lens = self.uint32(doc_lens_off, self.num_docs)
+        self.doc_id_offs = self.uint32(doc_id_offs_off, self.num_docs + 1)
+        self.doc_id_blob_off = doc_id_blob_off
+        self.term_offs = self.uint32(term_offs_off, self.num_terms + 1)
+        self.term_blob_off = term_blob_off
+        self.term_table_off = term_table_off
+        self.doc_ids = DocIdTable(self)
+        self.norms_cache = {}
+        self.bounds_cache = {}
+        # A rebuilt index file replaces the old one, so its modification time tells the two apart
+        self.generation = os.fstat(self.file.fileno()).st_mtime_ns
+
+    def __len__(self):
+        return self.num_docs
+
+    def __contains__(self, term):
+        return self.find_term(term) >= 0
+
+    # uint32 array at offset, a zero-copy view on little-endian machines
+    def uint32(self, offset, count):
+        if sys.byteorder == 'little':
+            return self.view[offset:offset + 4 * count].cast('I')
+        values = array('I', self.view[offset:offset + 4 * count])
+        values.byteswap()
+        return values
+
+    def term(self, term_id):
+        start = self.term_blob_off + self.term_offs[term_id]
+        end = self.term_blob_off + self.term_offs[term_id + 1]
+        return str(self.view[start:end], 'utf-8')
+
+    # Binary search of the sorted term dictionary, returns the term id or -1
+    def find_term(self, term):
+        low = bisect_left(TermList(self), term)
+        if low < self.num_terms and self.term(low) == term:
+            return low
+        return -1
+
+    def term_entry(self, term_id):
+        return TERM_ENTRY.unpack_from(self.map, self.term_table_off + TERM_ENTRY.size * term_id)
+
+    def read_postings(self, term_id):
+        idf, df, offset, bound = self.term_entry(term_id)
+        if self.codec == "raw":
+            return idf, self.uint32(offset, df), self.uint32(offset + 4 * df, df)
+        # Compressed postings of a term end where the next term's postings start
+        if term_id + 1 < self.num_terms:
+            end = self.term_entry(term_id + 1)[2]
+        else:
+            end = len(self.map)
+        docs, tfs = decode_postings_fast(self.view[offset:end], df, self.codec)
+        return idf, docs, tfs
+
+    # Return (idf, docs, tfs) of a term, or None if the term is not indexed
+    def postings(self, term):
+        term_id = self.find_term(term)
+        if term_id < 0:
+            return None
+        return self.read_postings(term_id)
+
+    def iter_postings(self):
+        for term_id in range(self.num_terms):
+            yield self.term(term_id), self.read_postings(term_id)
+
+    def norms(self, k, b):
+        key = (k, b)
+        if key not in self.norms_cache:
+            avg_doclen = self.avg_doclen
+            self.norms_cache[key] = [k * (1 - b + b * (doc_len / avg_doclen)) for doc_len in self.doc_lens]
+        return self.norms_cache[key]
+
+    # Bounds for the parameters the file was written with are stored, others are computed per term on use
+    def upper_bounds(self, k, b):
+        key = (k, b)
+        if key not in self.bounds_cache:
+            self.bounds_cache[key] = TermBounds(self, k, b)
+        return self.bounds_cache[key]
+
+    def close(self):
+        self.doc_lens = self.doc_id_offs = self.term_offs = None
+        self.view.release()
+        self.map.close()
+        self.file.close()
+
+
+# Sorted terms of a BinaryIndex as a sequence for bisect, terms are only decoded while searching
+class TermList:
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return self.index.num_terms
+
+    def __getitem__(self, term_id):
+        return self.index.term(term_id)
+
+
+# Document IDs of a BinaryIndex by dense id, decoded on access
+class DocIdTable:
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return self.index.num_docs
+
+    def __getitem__(self, doc):
+        index = self.index
+        if doc < 0:
+            doc += index.num_docs
+        if not 0 <= doc < index.num_docs:
+            raise IndexError("document id out of range")
+        start = index.doc_id_blob_off + index.doc_id_offs[doc]
+        end = index.doc_id_blob_off + index.doc_id_offs[doc + 1]
+        return str(index.view[start:end], 'utf-8')
+
+    def __iter__(self):
+        for doc in range(self.index.num_docs):
+            yield self[doc]
+
+
+class TermBounds:
+
+    def __init__(self, index, k, b):
+        self.index = index
+        self.k = k
+        self.b = b
+        self.bounds = {}
+
+    def __getitem__(self, term):
+        if term not in self.bounds:
+            index = self.index
+            term_id = index.find_term(term)
+            if term_id < 0:
+                raise KeyError(term)
+            if (self.k, self.b) == (index.k, index.b):
+                self.bounds[term] = index.term_entry(term_id)[3]
+            else:
+                idf, docs, tfs = index.read_postings(term_id)
+                norms = index.norms(self.k, self.b)
+                k_plus = self.k + 1
+                bound = 0.0
+                for doc, tf in zip(docs, tfs):
+                    bound = max(bound, idf * (tf * k_plus) / (tf + norms[doc]))
+                self.bounds[term] = bound
+        return self.bounds[term]
+
+
+def open_binary_index(file_path):
+    return BinaryIndex(file_path)
+
+
+def pack_uint32(values):
+    values = array('I', values)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values.tobytes()
+
+
+# Write any postings index (PostingsIndex or BinaryIndex) to file_path, bounds are stored for (k, b)
+# codec is "raw" for uint32 postings that are read without copying, or one of postings_codec.CODECS
+def write_binary_index(postings_index, file_path, k=1, b=0.75, codec="raw"):
+    bounds = postings_index.upper_bounds(k, b)
+    entries = ((term, idf, docs, tfs, bounds[term]) for term, (idf, docs, tfs) in sorted(postings_index.iter_postings()))
+    write_index_file(file_path, postings_index.doc_ids, postings_index.doc_lens, postings_index.avg_doclen,
+                     entries, k, b, codec)
+
+
+# Write an index file from (term, idf, docs, tfs, bound) in term order
+# Postings are spooled to a side file as they arrive, only the term dictionary is kept in memory
+def write_index_file(file_path, doc_ids, doc_lens, avg_doclen, entries, k=1, b=0.75, codec="raw"):
+    if codec not in CODEC_IDS:
+        raise ValueError(f"Unknown postings codec: {codec}")
+    doc_ids = [str(doc_id).encode('utf-8') for doc_id in doc_ids]
+    doc_lens = list(doc_lens)
+
+    spool_path = file_path + ".postings"
+    terms = []
+    table = []
+    offset = 0
+    with open(spool_path, 'wb') as spool:
+        for term, idf, docs, tfs, bound in entries:
+            if codec == "raw":
+                block = pack_uint32(docs) + pack_uint32(tfs)
+            else:
+                block = encode_postings(docs, tfs, codec).tobytes()
+            spool.write(block)
+            terms.append(term.encode('utf-8'))
+            table.append((idf, len(docs), offset, bound))
+            offset += len(block)
+
+    doc_id_offs = [0]
+    for doc_id in doc_ids:
+        doc_id_offs.append(doc_id_offs[-1] + len(doc_id))
+    term_offs = [0]
+    for term in terms:
+        term_offs.append(term_offs[-1] + len(term))
+
+    doc_lens_off = HEADER.size
+    doc_id_offs_off = doc_lens_off + 4 * len(doc_lens)
+    doc_id_blob_off = doc_id_offs_off + 4 * len(doc_id_offs)
+    term_offs_off = doc_id_blob_off + doc_id_offs[-1]
+    term_blob_off = term_offs_off + 4 * len(term_offs)
+    # The term table holds doubles, keep it 8-byte aligned
+    term_table_off = (term_blob_off + term_offs[-1] + 7) // 8 * 8
+    postings_off = term_table_off + TERM_ENTRY.size * len(table)
+
+    temp_path = file_path + ".tmp"
+    with open(temp_path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(doc_ids), len(terms), sum(doc_lens),
+                               avg_doclen, k, b, doc_lens_off, doc_id_offs_off, doc_id_blob_off,
+                               term_offs_off, term_blob_off, term_table_off, CODEC_IDS[codec]))
+        file.write(pack_uint32(doc_lens))
+        file.write(pack_uint32(doc_id_offs))
+        file.write(b"".join(doc_ids))
+        file.write(pack_uint32(term_offs))
+        file.write(b"".join(terms))
+        file.write(b"\0" * (term_table_off - term_blob_off - term_offs[-1]))
+        for idf, df, offset, bound in table:
+            file.write(TERM_ENTRY.pack(idf, df, postings_off + offset, bound))
+        with open(spool_path, 'rb') as spool:
+            shutil.copyfileobj(spool, file)
+    os.remove(spool_path)
+    os.replace(temp_path, file_path)
@@ -0,0 +1,316 @@
+import heapq
+import itertools
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from instrumentation import count, stage
+from postings_codec import decode_postings_fast, encode_postings
+
+
+# Every PostingsIndex built in this process gets a new generation number, results cached for one do not apply to another
+GENERATIONS = itertools.count(1)
+
+
+# Postings index with dense integer doc ids, shared by both search scripts
+# With a codec ("varint" or "bitpack") every postings list is kept compressed and decoded on use
+class PostingsIndex:
+
+    def __init__(self, doc_ids, doc_lens, avg_doclen, codec=None):
+        self.doc_ids = list(doc_ids)  # dense id -> document ID (file name)
+        self.doc_lens = array('i', doc_lens)
+        self.avg_doclen = float(avg_doclen)
+        self.codec = codec
+        self.terms = {}  # term -> (idf, dense doc ids, term frequencies), or (idf, df, encoded bytes) with a codec
+        self.norms_cache = {}
+        self.bounds_cache = {}
+        self.generation = next(GENERATIONS)
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def add_term(self, term, idf, docs, tfs):
+        if self.codec is None:
+            self.terms[term] = (float(idf), array('i', docs), array('i', tfs))
+        else:
+            self.terms[term] = (float(idf), len(docs), encode_postings(docs, tfs, self.codec))
+
+    def __contains__(self, term):
+        return term in self.terms
+
+    # Return (idf, docs, tfs) of a term, or None if the term is not indexed
+    def postings(self, term):
+        entry = self.terms.get(term)
+        if entry is None or self.codec is None:
+            return entry
+        idf, df, data = entry
+        docs, tfs = decode_postings_fast(data, df, self.codec)
+        return idf, docs, tfs
+
+    def iter_postings(self):
+        for term in self.terms:
+            yield term, self.postings(term)
+
+    # Length normalisation k * (1 - b + b * dl / avgdl) of every document, computed once per (k, b)
+    def norms(self, k, b):
+        key = (k, b)
+        if key not in self.norms_cache:
+            avg_doclen = self.avg_doclen
+            self.norms_cache[key] = [k * (1 - b + b * (doc_len / avg_doclen)) for doc_len in self.doc_lens]
+        return self.norms_cache[key]
+
+    # Largest score contribution of every term for (k, b), never below 0 so that terms with idf < 0 can be skipped
+    def upper_bounds(self, k, b):
+        key = (k, b)
+        if key not in self.bounds_cache:
+            norms = self.norms(k, b)
+            k_plus = k + 1
+            bounds = {}
+            for term, (idf, docs, tfs) in self.iter_postings():
+                bound = 0.0
+                for doc, tf in zip(docs, tfs):
+                    score = idf * (tf * k_plus) / (tf + norms[doc])
+                    if score > bound:
+                        bound = score
+                bounds[term] = bound
+            self.bounds_cache[key] = bounds
+        return self.bounds_cache[key]
+
+
+# The index read from index.txt stores [idf, doc_1, doc_2, ...], a new index stores {doc_id : {...}, idf : idf_value}
+def term_idf(entry):
+    if type(entry) is list:
+        return float(entry[0])
+    return float(entry["idf"])
+
+
+# Build postings from processed documents {doc_id : [stem_1, stem_2, ...]}
+def build_postings_index(processed_doc, index, avg_doclen, k=1, b=0.75, codec=None):
+    postings = {}
+    doc_lens = []
+    for dense_id, words in enumerate(processed_doc.values()):
+        doc_lens.append(len(words))
+        for term, tf in Counter(words).items():
+            if term in postings:
+                postings[term][0].append(dense_id)
+                postings[term][1].append(tf)
+            else:
+                postings[term] = ([dense_id], [tf])
+    return finish_postings_index(processed_doc.keys(), doc_lens, avg_doclen, index, postings, k, b, codec)
+
+
+# Build postings from stored term frequencies {doc_id : {term : tf}} and lengths {doc_id : length}
+def build_postings_from_tf(tf_dict, len_dict, index, avg_doclen, k=1, b=0.75, codec=None):
+    postings = {}
+    doc_lens = []
+    for dense_id, (doc_id, doc_len) in enumerate(len_dict.items()):
+        doc_lens.append(int(doc_len))
+        for term, tf in tf_dict.get(doc_id, {}).items():
+            if term in postings:
+                postings[term][0].append(dense_id)
+                postings[term][1].append(tf)
+            else:
+                postings[term] = ([dense_id], [tf])
+    return finish_postings_index(len_dict.keys(), doc_lens, avg_doclen, index, postings, k, b, codec)
+
+
+def finish_postings_index(doc_ids, doc_lens, avg_doclen, index, postings, k, b, codec):
+    postings_index = PostingsIndex(doc_ids, doc_lens, avg_doclen, codec)
+    # Every indexed term is kept, a term without postings still scores every document with 0
+    for term, entry in index.items():
+        docs, tfs = postings.get(term, ((), ()))
+        postings_index.add_term(term, term_idf(entry), docs, tfs)
+    # Normalisation and score upper bounds for the default parameters are done at index time
+    postings_index.upper_bounds(k, b)
+    return postings_index
+
+
+# Term-at-a-time BM25, only the documents in each term's postings are visited
+def bm25_taat(query, postings_index, k, b):
+    with stage("fetch"):
+        matched = []
+        for term in query:
+            entry = postings_index.postings(term)
+            if entry is not None:
+                matched.append(entry)
+    if not matched:
+        return []
+
+    # A document missing from every postings list scores idf * 0 for each term, which is -0.0 when all idf < 0
+    zero = -0.0 if all(idf < 0 for idf, docs, tfs in matched) else 0.0
+    scores = [zero] * len(postings_index)
+    norms = postings_index.norms(k, b)
+    k_plus = k + 1
+    with stage("score"):
+        for idf, docs, tfs in matched:
+            for doc, tf in zip(docs, tfs):
+                scores[doc] += idf * (tf * k_plus) / (tf + norms[doc])
+    count("postings", sum(len(docs) for idf, docs, tfs in matched))
+
+    # sorted() is stable, so equal scores keep the document order of the collection
+    with stage("sort"):
+        return sorted(zip(postings_index.doc_ids, scores), key=lambda x: x[1], reverse=True)
+
+
+# Pruning methods for bm25_topk
+PRUNING_METHODS = ("maxscore", "wand")
+
+# Relative slack on the heap threshold, a summed upper bound may round differently from a summed score
+BOUND_SLACK = 1e-9
+
+
+# Position of a term occurrence in the query while walking its postings
+class PostingsCursor:
+
+    def __init__(self, idf, docs, tfs, bound):
+        self.idf = idf
+        self.docs = docs
+        self.tfs = tfs
+        self.bound = bound
+        self.pos = 0
+        self.doc = docs[0] if docs else None
+
+    # Move to the first posting with doc >= target, galloping before the binary search
+    def advance(self, target):
+        docs = self.docs
+        pos = self.pos
+        if self.doc is None or self.doc >= target:
+            return
+        step = 1
+        while pos + step < len(docs) and docs[pos + step] < target:
+            pos += step
+            step *= 2
+        pos = bisect_left(docs, target, pos, min(pos + step + 1, len(docs)))
+        self.pos = pos
+        self.doc = docs[pos] if pos < len(docs) else None
+
+    def next(self):
+        self.pos += 1
+        self.doc = self.docs[self.pos] if self.pos < len(self.docs) else None
+
+
+# Score one document over all cursors in query order, the same summation order as bm25_taat
+def score_document(doc, cursors, norms, k_plus):
+    score = 0.0
+    for cursor in cursors:
+        if cursor.doc is not None and cursor.doc < doc:
+            cursor.advance(doc)
+        if cursor.doc == doc:
+            tf = cursor.tfs[cursor.pos]
+            score += cursor.idf * (tf * k_plus) / (tf + norms[doc])
+    return score
+
+
+def threshold(heap, top_k):
+    if len(heap) < top_k:
+        return float("-inf")
+    theta = heap[0][0]
+    return theta - BOUND_SLACK * abs(theta)
+
+
+# Keep the best top_k (score, -doc) pairs, a lower doc id wins a tie like the stable sort in bm25_taat
+def push_result(heap, top_k, score, doc):
+    item = (score, -doc)
+    if len(heap) < top_k:
+        heapq.heappush(heap, item)
+    elif item > heap[0]:
+        heapq.heapreplace(heap, item)
+
+
+def maxscore(cursors, norms, k_plus, top_k, stats):
+    heap = []
+    ordered = sorted(cursors, key=lambda cursor: cursor.bound)
+    # prefix[i] is the best score a document can get from ordered[:i] alone
+    prefix = [0.0]
+    for cursor in ordered:
+        prefix.append(prefix[-1] + cursor.bound)
+    first_essential = 0
+    theta = float("-inf")
+    while first_essential < len(ordered):
+        essential = ordered[first_essential:]
+        doc = min((cursor.doc for cursor in essential if cursor.doc is not None), default=None)
+        if doc is None:
+            break
+        bound = prefix[first_essential]
+        for cursor in essential:
+            if cursor.doc == doc:
+                bound += cursor.bound
+        if bound >= theta:
+            stats["scored"] += 1
+            push_result(heap, top_k, score_document(doc, cursors, norms, k_plus), doc)
+            theta = threshold(heap, top_k)
+            # Lists whose combined bound cannot reach the threshold only get probed from now on
+            while first_essential < len(ordered) and prefix[first_essential + 1] < theta:
+                first_essential += 1
+        for cursor in essential:
+            if cursor.doc == doc:
+                cursor.next()
+    return heap
+
+
+def wand(cursors, norms, k_plus, top_k, stats):
+    heap = []
+    active = [cursor for cursor in cursors if cursor.doc is not None]
+    theta = float("-inf")
+    while active:
+        active.sort(key=lambda cursor: cursor.doc)
+        # The pivot is the first document whose accumulated bound can reach the threshold
+        pivot = None
+        bound = 0.0
+        for i, cursor in enumerate(active):
+            bound += cursor.bound
+            if bound >= theta:
+                pivot = i
+                break
+        if pivot is None:
+            break
+        pivot_doc = active[pivot].doc
+        if active[0].doc == pivot_doc:
+            stats["scored"] += 1
+            push_result(heap, top_k, score_document(pivot_doc, cursors, norms, k_plus), pivot_doc)
+            theta = threshold(heap, top_k)
+            for cursor in active:
+                if cursor.doc == pivot_doc:
+                    cursor.next()
+        else:
+            # Documents before the pivot cannot enter the heap
+            for cursor in active[:pivot]:
+                cursor.advance(pivot_doc)
+        active = [cursor for cursor in active if cursor.doc is not None]
+    return heap
+
+
+# Top-k BM25 with MaxScore or WAND dynamic pruning, returns the same top_k as bm25_taat and the counters
+def bm25_topk(query, postings_index, k, b, top_k, method="maxscore"):
+    if method not in PRUNING_METHODS:
+        raise ValueError(f"Unknown pruning method: {method}")
+    stats = {"scored": 0, "skipped": 0}
+    bounds = postings_index.upper_bounds(k, b)
+    cursors = []
+    for term in query:
+        entry = postings_index.postings(term)
+        if entry is not None:
+            idf, docs, tfs = entry
+            cursors.append(PostingsCursor(idf, docs, tfs, bounds[term]))
+    if not cursors or top_k <= 0:
+        return [], stats
+
+    norms = postings_index.norms(k, b)
+    if method == "maxscore":
+        heap = maxscore(cursors, norms, k + 1, top_k, stats)
+    else:
+        heap = wand(cursors, norms, k + 1, top_k, stats)
+
+    # Documents scoring 0 or less are ordered by the full ranking, fall back to it when they reach the top_k
+    if len(heap) < top_k or heap[0][0] <= 0:
+        ranking = bm25_taat(query, postings_index, k, b)
+        stats["scored"] = len(ranking)
+        stats["skipped"] = 0
+        return ranking[:top_k], stats
+
+    # Every other document in the postings of the query terms was skipped
+    matched = set()
+    for cursor in cursors:
+        matched.update(cursor.docs)
+    stats["skipped"] = len(matched) - stats["scored"]
+    heap.sort(reverse=True)
+    return [(postings_index.doc_ids[-doc], score) for score, doc in heap], stats
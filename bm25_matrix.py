@@ -0,0 +1,109 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Sparse term-document matrix of BM25 weights in CSR form, row t holds idf * tf * (k + 1) / (tf + norm) of term t
+# Works on any index with iter_postings, norms and doc_ids (PostingsIndex, BinaryIndex, SegmentedView)
+class BM25Matrix:
+
+    def __init__(self, postings_index, k=1, b=0.75):
+        if np is None:
+            raise ImportError("Batch scoring needs NumPy")
+        norms = np.asarray(postings_index.norms(k, b), dtype=np.float64)
+        k_plus = k + 1
+        self.k = k
+        self.b = b
+        self.doc_ids = list(postings_index.doc_ids)
+        self.term_rows = {}  # term -> row
+        idfs = []
+        lengths = []
+        indices = []
+        data = []
+        for term, (idf, docs, tfs) in postings_index.iter_postings():
+            docs = np.asarray(docs, dtype=np.int64)
+            tfs = np.asarray(tfs, dtype=np.int64)
+            self.term_rows[term] = len(idfs)
+            idfs.append(idf)
+            lengths.append(len(docs))
+            indices.append(docs)
+            # Same expression and evaluation order as bm25_taat, so every weight is bit-identical
+            data.append(idf * (tfs * k_plus) / (tfs + norms[docs]))
+        self.idfs = np.array(idfs, dtype=np.float64)
+        self.indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.indptr[1:])
+        self.indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+        self.data = np.concatenate(data) if data else np.zeros(0, dtype=np.float64)
+
+    @property
+    def shape(self):
+        return len(self.term_rows), len(self.doc_ids)
+
+    # Sparse query-term matrix in CSR form, one entry per query term occurrence in query order
+    # Terms that are not indexed are left out, like bm25_taat does
+    def query_matrix(self, queries):
+        indptr = [0]
+        indices = []
+        for query in queries:
+            for term in query:
+                row = self.term_rows.get(term)
+                if row is not None:
+                    indices.append(row)
+            indptr.append(len(indices))
+        indices = np.array(indices, dtype=np.int64)
+        return np.array(indptr, dtype=np.int64), indices, np.ones(len(indices), dtype=np.float64)
+
+    # Dense scores of a block of queries: the product of the query matrix and the term-document matrix
+    def scores(self, query_indptr, query_indices, query_data):
+        num_queries = len(query_indptr) - 1
+        num_docs = len(self.doc_ids)
+        starts = self.indptr[query_indices]
+        lengths = self.indptr[query_indices + 1] - starts
+        total = int(lengths.sum())
+        # Position of every posting of every query term in indices and data
+        first = np.cumsum(lengths) - lengths
+        positions = np.arange(total) - np.repeat(first - starts, lengths)
+        rows = np.repeat(np.repeat(np.arange(num_queries), np.diff(query_indptr)), lengths)
+        weights = self.data[positions] * np.repeat(query_data, lengths)
+        # bincount adds the weights in input order, which is query term order, as bm25_taat does
+        flat = np.bincount(rows * num_docs + self.indices[positions], weights=weights,
+                           minlength=num_queries * num_docs)
+        return flat.reshape(num_queries, num_docs)
+
+
+# Dense doc ids of the top_k best scores, best first, equal scores in collection order
+def top_k_docs(row, top_k):
+    if top_k is None or top_k >= len(row):
+        return np.argsort(-row, kind='stable')
+    if top_k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    candidates = np.argpartition(-row, top_k - 1)[:top_k]
+    kth = row[candidates].min()
+    # argpartition breaks ties at the k-th score arbitrarily, take the lowest doc ids among them
+    above = np.flatnonzero(row > kth)
+    tied = np.flatnonzero(row == kth)[:top_k - len(above)]
+    chosen = np.concatenate((above, tied))
+    return chosen[np.lexsort((chosen, -row[chosen]))]
+
+
+# Rank many tokenised queries at once, returns one [(doc_id, score), ...] ranking per query
+# The ranking of a query is what bm25_taat returns, cut to top_k documents when top_k is set
+def bm25_batch(queries, matrix, top_k=None, batch_size=64):
+    rankings = []
+    for block_start in range(0, len(queries), batch_size):
+        block = queries[block_start:block_start + batch_size]
+        query_indptr, query_indices, query_data = matrix.query_matrix(block)
+        block_scores = matrix.scores(query_indptr, query_indices, query_data)
+        for i, row in enumerate(block_scores):
+            matched = query_indices[query_indptr[i]:query_indptr[i + 1]]
+            if len(matched) == 0:
+                rankings.append([])
+                continue
+            if (matrix.idfs[matched] < 0).all():
+                # Documents outside every postings list score -0.0 in bm25_taat when all idf < 0
+                row[row == 0] = -0.0
+            docs = top_k_docs(row, top_k)
+            doc_ids = matrix.doc_ids
+            rankings.append([(doc_ids[doc], score) for doc, score in zip(docs.tolist(), row[docs].tolist())])
+    return rankings
@@ -0,0 +1,416 @@
+import argparse
+import os
+import re
+import time
+from bisect import bisect_left
+import files.porter as porter
+from analyzer import analyze, read_stopwords
+from binary_index import open_binary_index
+from bm25_index import bm25_taat
+from instrumentation import count, stage
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Quoted groups with an optional ~window, parentheses and words; AND, OR and NOT in capitals are operators
+TOKEN_PATTERN = re.compile(r'"[^"]*"(?:~\d+)?|\(|\)|[^\s()"]+')
+OPERATORS = ("AND", "OR", "NOT")
+# Lists at least this long are intersected, merged and subtracted with NumPy when it is installed
+NUMPY_MIN_LENGTH = 256
+# Scoring skips through a postings list when it is this many times longer than the matching documents
+GALLOP_RATIO = 8
+
+
+# Query text written in the Boolean language: operators, brackets or quotes
+def is_boolean(text):
+    return any(token in OPERATORS or token[0] in '("' for token in TOKEN_PATTERN.findall(text))
+
+
+# Parse a query into a tree of ("term", word), ("phrase", [words]), ("near", [words], window), ("and", [nodes]),
+# ("or", [nodes]) and ("not", node). "a b" is a phrase, "a b"~5 needs all words within 5 consecutive words
+# NOT binds tighter than AND, AND tighter than OR, and words next to each other are joined with AND
+def parse_query(text):
+    tokens = TOKEN_PATTERN.findall(text)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def take():
+        nonlocal position
+        position += 1
+        return tokens[position - 1]
+
+    def parse_or():
+        children = [parse_and()]
+        while peek() == "OR":
+            take()
+            children.append(parse_and())
+        return children[0] if len(children) == 1 else ("or", children)
+
+    def parse_and():
+        children = [parse_not()]
+        while peek() is not None and peek() not in ("OR", ")"):
+            if peek() == "AND":
+                take()
+            children.append(parse_not())
+        return children[0] if len(children) == 1 else ("and", children)
+
+    def parse_not():
+        if peek() == "NOT":
+            take()
+            return "not", parse_not()
+        return parse_primary()
+
+    def parse_primary():
+        token = take() if peek() is not None else None
+        if token is None or token in OPERATORS or token == ")":
+            raise ValueError(f"Expected a word, a quoted group or '(' in query: {text}")
+        if token == "(":
+            node = parse_or()
+            if peek() != ")":
+                raise ValueError(f"Missing ')' in query: {text}")
+            take()
+            return node
+        if token.startswith('"'):
+            words, quote, window = token[1:].partition('"~')
+            if quote:
+                return "near", words.split(), int(window)
+            return "phrase", token.strip('"').split()
+        return "term", token
+
+    node = parse_or()
+    if position != len(tokens):
+        raise ValueError(f"Unexpected '{tokens[position]}' in query: {text}")
+    return node
+
+
+# Run the words of a tree through the document analysis, words that are stopwords disappear
+# Returns None for a tree without any indexed word left
+def analyze_tree(node, stopwords, p):
+    kind = node[0]
+    if kind == "term":
+        stems = analyze(node[1].lower(), stopwords, p)
+        if not stems:
+            return None
+        return ("term", stems[0]) if len(stems) == 1 else ("and", [("term", stem) for stem in stems])
+    if kind in ("phrase", "near"):
+        stems = analyze(" ".join(node[1]).lower(), stopwords, p)
+        if len(stems) < 2:
+            return ("term", stems[0]) if stems else None
+        return ("phrase", stems) if kind == "phrase" else ("near", stems, node[2])
+    if kind == "not":
+        child = analyze_tree(node[1], stopwords, p)
+        return None if child is None else ("not", child)
+    children = [child for child in (analyze_tree(child, stopwords, p) for child in node[1]) if child is not None]
+    if not children:
+        return None
+    return children[0] if len(children) == 1 else (kind, children)
+
+
+# Terms that add to the score of a document: every term outside a NOT, in query order
+def scoring_terms(node):
+    kind = node[0]
+    if kind == "term":
+        return [node[1]]
+    if kind in ("phrase", "near"):
+        return list(node[1])
+    if kind == "not":
+        return []
+    return [term for child in node[1] for term in scoring_terms(child)]
+
+
+# First position at or after low where docs[position] >= target, by doubling steps and a binary search of the
+# last step, so matching a short list against a long one skips most of the long list
+def gallop(docs, target, low=0):
+    length = len(docs)
+    bound = 1
+    while low + bound < length and docs[low + bound] < target:
+        bound *= 2
+    return bisect_left(docs, target, low + bound // 2, min(low + bound + 1, length))
+
+
+def use_numpy(*lists):
+    return np is not None and min(len(docs) for docs in lists) >= NUMPY_MIN_LENGTH
+
+
+def intersect(first, second):
+    if len(first) > len(second):
+        first, second = second, first
+    if use_numpy(first, second):
+        return np.intersect1d(np.asarray(first), np.asarray(second), assume_unique=True).tolist()
+    result = []
+    position = 0
+    length = len(second)
+    for doc in first:
+        position = gallop(second, doc, position)
+        if position == length:
+            break
+        if second[position] == doc:
+            result.append(doc)
+    return result
+
+
+def unite(lists):
+    if len(lists) == 2 and use_numpy(*lists):
+        return np.union1d(np.asarray(lists[0]), np.asarray(lists[1])).tolist()
+    return sorted(set().union(*lists))
+
+
+def subtract(docs, excluded):
+    if use_numpy(docs, excluded):
+        return np.setdiff1d(np.asarray(docs), np.asarray(excluded), assume_unique=True).tolist()
+    result = []
+    position = 0
+    length = len(excluded)
+    for doc in docs:
+        position = gallop(excluded, doc, position)
+        if position == length or excluded[position] != doc:
+            result.append(doc)
+    return result
+
+
+# Start positions of a phrase in a document, from the positions of its words in phrase order
+def phrase_starts(position_lists):
+    starts = set(position_lists[0])
+    for offset, positions in enumerate(position_lists[1:], 1):
+        starts &= {position - offset for position in positions}
+        if not starts:
+            break
+    return starts
+
+
+# Fewest consecutive words of a document that hold every word of a group, 0 when a word is missing
+def min_span(position_lists):
+    if not all(position_lists):
+        return 0
+    events = sorted((position, i) for i, positions in enumerate(position_lists) for position in positions)
+    needed = len(position_lists)
+    counts = [0] * needed
+    covered = 0
+    best = 0
+    first = 0
+    for position, i in events:
+        if counts[i] == 0:
+            covered += 1
+        counts[i] += 1
+        while covered == needed:
+            start, j = events[first]
+            if not best or position - start + 1 < best:
+                best = position - start + 1
+            counts[j] -= 1
+            if counts[j] == 0:
+                covered -= 1
+            first += 1
+    return best
+
+
+# Whether the positions of the words of a phrase or proximity node in one document match it
+def matches_positions(node, position_lists):
+    if node[0] == "phrase":
+        return bool(phrase_starts(position_lists))
+    return 0 < min_span(position_lists) <= node[2]
+
+
+# Words whose positions a phrase or proximity node checks, in order for a phrase and once each for a window
+def position_terms(node):
+    return node[1] if node[0] == "phrase" else list(dict.fromkeys(node[1]))
+
+
+# Evaluates analysed trees against one index, postings of a term are fetched once per query
+# With a positional index sharing the dense doc ids of the postings, phrases and proximity windows are checked
+# against the positions of the documents containing all their words, without it they only need all their words
+class QueryPlanner:
+
+    def __init__(self, postings_index, positional_index=None):
+        self.postings_index = postings_index
+        self.positional_index = positional_index
+        self.fetched = {}
+        self.intersections = 0
+        self.verified = 0
+
+    # (idf, docs, tfs) of a term, or None if the term is not indexed
+    def postings(self, term):
+        if term not in self.fetched:
+            self.fetched[term] = self.postings_index.postings(term)
+        return self.fetched[term]
+
+    def docs(self, term):
+        entry = self.postings(term)
+        return () if entry is None else entry[1]
+
+    # Estimated size of the result of a node: df of a term, the smallest operand of AND, the sum of OR
+    def cost(self, node):
+        kind = node[0]
+        if kind == "term":
+            return len(self.docs(node[1]))
+        if kind in ("phrase", "near"):
+            return min(len(self.docs(term)) for term in node[1])
+        if kind == "not":
+            return len(self.postings_index) - self.cost(node[1])
+        costs = [self.cost(child) for child in node[1]]
+        return min(costs) if kind == "and" else sum(costs)
+
+    # AND operands from the rarest to the most frequent, NOT operands are subtracted once the rest is known
+    def plan(self, node):
+        kind = node[0]
+        if kind in ("and", "or"):
+            children = [self.plan(child) for child in node[1]]
+            if kind == "and":
+                children.sort(key=lambda child: (child[0] == "not", self.cost(child)))
+            return kind, children
+        if kind == "not":
+            return "not", self.plan(node[1])
+        return node
+
+    # Sorted dense doc ids matching a planned node
+    def evaluate(self, node):
+        kind = node[0]
+        if kind == "term":
+            return self.docs(node[1])
+        if kind in ("phrase", "near"):
+            terms = position_terms(node)
+            docs = self.evaluate(("and", sorted((("term", term) for term in terms), key=self.cost)))
+            if self.positional_index is None:
+                return docs
+            cursors = [self.positional_index.cursor(term) for term in terms]
+            if any(cursor is None for cursor in cursors):
+                return []
+            self.verified += len(docs)
+            return [doc for doc in docs if matches_positions(node, [cursor.positions(doc) for cursor in cursors])]
+        if kind == "not":
+            return subtract(range(len(self.postings_index)), self.evaluate(node[1]))
+        if kind == "or":
+            return unite([self.evaluate(child) for child in node[1]])
+        docs = None
+        for child in node[1]:
+            if child[0] == "not":
+                docs = subtract(docs if docs is not None else range(len(self.postings_index)),
+                                self.evaluate(child[1]))
+            else:
+                child_docs = self.evaluate(child)
+                if docs is None:
+                    docs = child_docs
+                else:
+                    docs = intersect(docs, child_docs)
+                    self.intersections += 1
+            if not docs:
+                return []
+        return docs
+
+
+# Readable plan of a tree with the estimated size of every node
+def explain(planner, node, depth=0):
+    indent = "  " * depth
+    kind = node[0]
+    if kind == "term":
+        return [f"{indent}{node[1]} (df {planner.cost(node)})"]
+    if kind == "phrase":
+        return [f"{indent}\"{' '.join(node[1])}\" (at most {planner.cost(node)})"]
+    if kind == "near":
+        return [f"{indent}\"{' '.join(node[1])}\"~{node[2]} (at most {planner.cost(node)})"]
+    lines = [f"{indent}{kind.upper()} (about {planner.cost(node)})"]
+    for child in ([node[1]] if kind == "not" else node[1]):
+        lines.extend(explain(planner, child, depth + 1))
+    return lines
+
+
+# BM25 of the documents matching a tree, scored only on them: the same sum over the query terms in query order
+# as bm25_taat, so a matching document gets the score and the rank it has in the full ranking
+def bm25_conjunctive(tree, postings_index, k, b, top_k=None, positional_index=None):
+    with stage("plan"):
+        planner = QueryPlanner(postings_index, positional_index)
+        docs = list(planner.evaluate(planner.plan(tree)))
+    counters = {"candidates": len(docs), "intersections": planner.intersections, "verified": planner.verified}
+    count("candidates", len(docs))
+    if not docs:
+        return [], counters
+
+    matched = [entry for entry in (planner.postings(term) for term in scoring_terms(tree)) if entry is not None]
+    # Same zero as bm25_taat for a matching document without any scoring term, e.g. one matched by NOT alone
+    zero = -0.0 if matched and all(idf < 0 for idf, term_docs, tfs in matched) else 0.0
+    scores = [zero] * len(docs)
+    norms = postings_index.norms(k, b)
+    k_plus = k + 1
+    slots = None
+    with stage("score"):
+        for idf, term_docs, tfs in matched:
+            length = len(term_docs)
+            if len(docs) * GALLOP_RATIO < length:
+                # Few candidates: skip through the postings of the term to each of them
+                position = 0
+                for i, doc in enumerate(docs):
+                    position = gallop(term_docs, doc, position)
+                    if position == length:
+                        break
+                    if term_docs[position] == doc:
+                        scores[i] += idf * (tfs[position] * k_plus) / (tfs[position] + norms[doc])
+            else:
+                # Many candidates: walk the postings once and look the documents up
+                if slots is None:
+                    slots = {doc: i for i, doc in enumerate(docs)}
+                for doc, tf in zip(term_docs, tfs):
+                    i = slots.get(doc)
+                    if i is not None:
+                        scores[i] += idf * (tf * k_plus) / (tf + norms[doc])
+
+    with stage("sort"):
+        doc_ids = postings_index.doc_ids
+        ranking = sorted(((doc_ids[doc], score) for doc, score in zip(docs, scores)), key=lambda x: x[1],
+                         reverse=True)
+    return (ranking if top_k is None else ranking[:top_k]), counters
+
+
+# Parse, analyse and rank a Boolean query, returns the ranking and the planner counters
+def boolean_search(text, postings_index, stopwords, p, k=1, b=0.75, top_k=None, positional_index=None):
+    tree = analyze_tree(parse_query(text), stopwords, p)
+    if tree is None:
+        return [], {"candidates": 0, "intersections": 0, "verified": 0}
+    return bm25_conjunctive(tree, postings_index, k, b, top_k, positional_index)
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Conjunctive BM25 of Boolean queries against the full ranking')
+    parser.add_argument('queries', nargs='*', default=[],
+                        help='Boolean queries, by default the query file with its words joined by AND')
+    parser.add_argument('-i', '--index', default="index.bin", help='Binary index file')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Runs of the query set')
+    args = parser.parse_args()
+
+    stopwords = read_stopwords(os.path.join(script_dir, "files", "stopwords.txt"))
+    p = porter.CachedPorterStemmer()
+    index = open_binary_index(args.index)
+    texts = args.queries
+    if not texts:
+        with open(os.path.join(script_dir, "files", "queries.txt"), "r") as queries_file:
+            texts = [" ".join(query.split()[1:]) for query in queries_file]
+    trees = [tree for tree in (analyze_tree(parse_query(text), stopwords, p) for text in texts) if tree is not None]
+
+    start_time = time.perf_counter()
+    for _ in range(args.repeat):
+        rankings = [bm25_conjunctive(tree, index, 1, 0.75)[0] for tree in trees]
+    conjunctive_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    for _ in range(args.repeat):
+        full = [bm25_taat(scoring_terms(tree), index, 1, 0.75) for tree in trees]
+    full_time = time.perf_counter() - start_time
+    matching = sum(len(ranking) for ranking in rankings)
+    # The full ranking restricted to the matching documents must be the conjunctive ranking
+    exact = all([item for item in full_ranking if item[0] in {doc_id for doc_id, score in ranking}] == ranking
+                for ranking, full_ranking in zip(rankings, full) if ranking and full_ranking)
+    print(f"{len(trees)} queries: conjunctive {args.repeat * len(trees) / conjunctive_time:.0f} queries/s, "
+          f"full scan {args.repeat * len(trees) / full_time:.0f} queries/s, {matching} matching documents, "
+          f"same scores and order as the full scan: {exact}")
+    if args.queries:
+        planner = QueryPlanner(index)
+        for tree, ranking in zip(trees, rankings):
+            print("\n".join(explain(planner, planner.plan(tree))))
+            for rank, (doc_id, score) in enumerate(ranking[:10], 1):
+                print(f"{rank} {doc_id} {score}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import argparse
+import os
+import time
+import files.porter as porter
+import search_small_corpus
+from bm25_index import build_postings_index
+from postings_codec import CODECS, decode_batch_numpy, decode_postings, decode_postings_numpy, encode_postings, np
+
+
+# Build the postings of a flat document folder the same way search_small_corpus does
+def corpus_postings(documents_path, stopwords_path):
+    documents = search_small_corpus.read_documents_info(documents_path)
+    stopwords = search_small_corpus.read_stopword_file(stopwords_path)
+    p = porter.CachedPorterStemmer()
+    processed_doc = {}
+    for doc_id, document in documents.items():
+        processed_doc[doc_id] = search_small_corpus.clear_txt(document, stopwords, p)
+    terms = {term: {"idf": 0.0} for words in processed_doc.values() for term in words}
+    return build_postings_index(processed_doc, terms, 1)
+
+
+# Bytes per posting and decode throughput of every codec
+def codec_report(postings_index, repeat=3):
+    lists = [(docs, tfs) for term, (idf, docs, tfs) in postings_index.iter_postings()]
+    num_postings = sum(len(docs) for docs, tfs in lists)
+    rows = [("raw uint32", 8.0, None, None, None)]
+    for codec in CODECS:
+        encoded = [(encode_postings(docs, tfs, codec), len(docs)) for docs, tfs in lists]
+        size = sum(len(data) for data, df in encoded)
+        # Every codec must give back exactly the postings it encoded
+        for (data, df), (docs, tfs) in zip(encoded, lists):
+            assert decode_postings(data, df, codec) == (list(docs), list(tfs))
+        python_rate = num_postings / best_time(lambda: [decode_postings(data, df, codec) for data, df in encoded],
+                                               repeat)
+        numpy_rate = None
+        batch_rate = None
+        if np is not None:
+            numpy_rate = num_postings / best_time(
+                lambda: [decode_postings_numpy(data, df, codec) for data, df in encoded], repeat)
+            blocks = [data for data, df in encoded]
+            dfs = [df for data, df in encoded]
+            batch_rate = num_postings / best_time(lambda: decode_batch_numpy(blocks, dfs, codec), repeat)
+        rows.append((codec, size / num_postings, python_rate, numpy_rate, batch_rate))
+    return num_postings, rows
+
+
+def best_time(run, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Postings compression report')
+    parser.add_argument('folders', nargs='*', default=["documents", "documents_2"],
+                        help='Flat document folders to index')
+    args = parser.parse_args()
+
+    stopwords_path = os.path.join(script_dir, "files", "stopwords.txt")
+    for folder in args.folders:
+        num_postings, rows = codec_report(corpus_postings(os.path.join(script_dir, folder), stopwords_path))
+        print(f"{folder}: {num_postings} postings")
+        print(f"  {'codec':<12}{'bytes/posting':>15}{'python decode/s':>18}{'numpy decode/s':>18}"
+              f"{'numpy batch/s':>18}")
+        for codec, bytes_per_posting, *rates in rows:
+            texts = "".join(f"{rate:>18,.0f}" if rate else f"{'-':>18}" for rate in rates)
+            print(f"  {codec:<12}{bytes_per_posting:>15.3f}{texts}")
+
+
+if __name__ == '__main__':
+    main()
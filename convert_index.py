@@ -0,0 +1,56 @@
+import argparse
+import os
+import files.porter as porter
+import search_large_corpus
+import search_small_corpus
+from binary_index import CODEC_IDS, open_binary_index, write_binary_index
+from bm25_index import build_postings_index, build_postings_from_tf
+
+
+# index.txt only stores idf and doc ids, term frequencies and lengths come from the documents again
+def convert_text_index(index_path, documents_path, stopwords_path):
+    index, avg_doclen = search_small_corpus.load_index(index_path)
+    documents = search_small_corpus.read_documents_info(documents_path)
+    stopwords = search_small_corpus.read_stopword_file(stopwords_path)
+    p = porter.CachedPorterStemmer()
+    processed_doc = {}
+    for doc_id, document in documents.items():
+        processed_doc[doc_id] = search_small_corpus.clear_txt(document, stopwords, p)
+    return build_postings_index(processed_doc, index, avg_doclen)
+
+
+# index.json already stores the term frequencies and lengths of every document
+def convert_json_index(index_path):
+    index, avg_doclen, tf_dict, len_dict = search_large_corpus.load_index(index_path)
+    return build_postings_from_tf(tf_dict, len_dict, index, avg_doclen)
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Convert index.txt or index.json to the binary index format')
+    parser.add_argument('index', help='index.txt of the small corpus or index.json of the large corpus')
+    parser.add_argument('-o', '--output', default=None, help='Binary index file to write')
+    parser.add_argument('-d', '--documents', default=os.path.join(script_dir, "documents_2"),
+                        help='Documents of a text index, used to recover term frequencies')
+    parser.add_argument('-s', '--stopwords', default=os.path.join(script_dir, "files", "stopwords.txt"),
+                        help='Stopword file used when the text index was built')
+    parser.add_argument('-c', '--codec', choices=list(CODEC_IDS), default='raw',
+                        help='Postings encoding, raw uint32 or compressed with varint or bitpack')
+    args = parser.parse_args()
+
+    if args.index.endswith(".json"):
+        postings = convert_json_index(args.index)
+        output = args.output or "index_large.bin"
+    else:
+        postings = convert_text_index(args.index, args.documents, args.stopwords)
+        output = args.output or "index.bin"
+    write_binary_index(postings, output, codec=args.codec)
+
+    binary_index = open_binary_index(output)
+    print(f"Wrote {output}: {binary_index.num_docs} documents, {binary_index.num_terms} terms, "
+          f"{binary_index.codec} postings, {os.path.getsize(output)} bytes")
+    binary_index.close()
+
+
+if __name__ == '__main__':
+    main()
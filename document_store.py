@@ -0,0 +1,188 @@
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections import Counter
+from collections.abc import Mapping
+from binary_index import pack_uint32
+from instrumentation import stage
+
+# Layout of a document store file, all numbers little-endian:
+#   header        magic, version, document and vector term counts, section offsets
+#   doc_lens      uint32 * num_docs, analysed length of every document
+#   doc_id_offs   uint32 * (num_docs + 1), offsets into doc_id_blob
+#   doc_id_blob   utf-8 document IDs
+#   term_offs     uint32 * (num_terms + 1), offsets into term_blob
+#   term_blob     utf-8 terms of the vectors, numbered in order of first use
+#   vector_offs   uint32 * (num_docs + 1), offsets into vectors in (term id, tf) pairs
+#   vectors       uint32 term id and uint32 term frequency per distinct term of a document, in order of first use
+#   text_offs     uint64 * (num_docs + 1), offsets into text_blob
+#   text_blob     utf-8 text of every document as it was indexed
+STORE_MAGIC = b"BM25DOC\0"
+STORE_VERSION = 1
+STORE_HEADER = struct.Struct("<8sIIIQQQQQQQQ")
+
+
+def pack_uint64(values):
+    values = array('Q', values)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values.tobytes()
+
+
+# Documents of a folder read on first use, a warm start that opens the index files never reads the folder
+class LazyDocuments(Mapping):
+
+    def __init__(self, reader, folder_path):
+        self.reader = reader
+        self.folder_path = folder_path
+        self.documents = None
+
+    def load(self):
+        if self.documents is None:
+            with stage("read"):
+                self.documents = self.reader(self.folder_path)
+        return self.documents
+
+    def __getitem__(self, doc_id):
+        return self.load()[doc_id]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+
+# Read-only view of a document store file with mmap: term frequency vectors and lengths to rebuild postings without
+# analysing the documents again, and the text of a document read by offset only when it is asked for
+class DocumentStore:
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.file = open(file_path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.num_docs, self.num_terms, doc_lens_off, doc_id_offs_off, doc_id_blob_off,
+         term_offs_off, term_blob_off, vector_offs_off, vectors_off, text_offs_off) = STORE_HEADER.unpack_from(self.map)
+        if magic != STORE_MAGIC:
+            raise ValueError(f"{file_path} is not a document store file")
+        if version != STORE_VERSION:
+            raise ValueError(f"{file_path} has document store version {version}, expected {STORE_VERSION}")
+        self.doc_lens = self.numbers('I', doc_lens_off, self.num_docs)
+        doc_id_offs = self.numbers('I', doc_id_offs_off, self.num_docs + 1)
+        self.doc_ids = [self.map[doc_id_blob_off + start:doc_id_blob_off + end].decode('utf-8')
+                        for start, end in zip(doc_id_offs, doc_id_offs[1:])]
+        self.term_offs_off = term_offs_off
+        self.term_blob_off = term_blob_off
+        self.vector_offs = self.numbers('I', vector_offs_off, self.num_docs + 1)
+        self.vectors_off = vectors_off
+        self.text_offs = self.numbers('Q', text_offs_off, self.num_docs + 1)
+        self.text_blob_off = text_offs_off + 8 * (self.num_docs + 1)
+        self.terms = None
+        self.positions = None
+
+    def __len__(self):
+        return self.num_docs
+
+    def numbers(self, typecode, offset, count):
+        values = array(typecode)
+        values.frombytes(self.map[offset:offset + values.itemsize * count])
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return values
+
+    # Terms are decoded on the first vector read, snippets alone never need them
+    def vector_terms(self):
+        if self.terms is None:
+            term_offs = self.numbers('I', self.term_offs_off, self.num_terms + 1)
+            blob = self.map[self.term_blob_off:self.term_blob_off + term_offs[-1]]
+            self.terms = [blob[start:end].decode('utf-8') for start, end in zip(term_offs, term_offs[1:])]
+        return self.terms
+
+    # {term: tf} of the document at a dense position
+    def term_frequencies(self, doc):
+        terms = self.vector_terms()
+        start, end = self.vector_offs[doc], self.vector_offs[doc + 1]
+        pairs = self.numbers('I', self.vectors_off + 8 * start, 2 * (end - start))
+        return {terms[term_id]: tf for term_id, tf in zip(pairs[0::2], pairs[1::2])}
+
+    def iter_vectors(self):
+        for doc, doc_id in enumerate(self.doc_ids):
+            yield doc_id, self.term_frequencies(doc)
+
+    # Position of a document ID, the table is built on the first lookup
+    def position(self, doc_id):
+        if self.positions is None:
+            self.positions = {doc_id: doc for doc, doc_id in enumerate(self.doc_ids)}
+        return self.positions[doc_id]
+
+    def text(self, doc_id):
+        doc = self.position(doc_id)
+        start, end = self.text_offs[doc], self.text_offs[doc + 1]
+        return self.map[self.text_blob_off + start:self.text_blob_off + end].decode('utf-8')
+
+    # First width characters of a document on one line
+    def snippet(self, doc_id, width=120):
+        text = " ".join(self.text(doc_id).split())
+        return text if len(text) <= width else text[:width - 3] + "..."
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def open_document_store(file_path):
+    return DocumentStore(file_path)
+
+
+# Write the texts {doc_id: text} and analysed words {doc_id: [stem, ...]} of the indexed documents,
+# in the order of processed_doc, which is the dense doc id order of the postings
+def write_document_store(file_path, documents, processed_doc):
+    doc_ids = [str(doc_id).encode('utf-8') for doc_id in processed_doc]
+    doc_lens = [len(words) for words in processed_doc.values()]
+    term_ids = {}
+    vector_offs = [0]
+    vectors = []
+    for words in processed_doc.values():
+        for term, tf in Counter(words).items():
+            vectors.append(term_ids.setdefault(term, len(term_ids)))
+            vectors.append(tf)
+        vector_offs.append(len(vectors) // 2)
+    terms = [term.encode('utf-8') for term in term_ids]
+    texts = [documents[doc_id].encode('utf-8') for doc_id in processed_doc]
+
+    def offsets(blobs):
+        values = [0]
+        for blob in blobs:
+            values.append(values[-1] + len(blob))
+        return values
+
+    doc_id_offs = offsets(doc_ids)
+    term_offs = offsets(terms)
+    text_offs = offsets(texts)
+    doc_lens_off = STORE_HEADER.size
+    doc_id_offs_off = doc_lens_off + 4 * len(doc_lens)
+    doc_id_blob_off = doc_id_offs_off + 4 * len(doc_id_offs)
+    term_offs_off = doc_id_blob_off + doc_id_offs[-1]
+    term_blob_off = term_offs_off + 4 * len(term_offs)
+    vector_offs_off = term_blob_off + term_offs[-1]
+    vectors_off = vector_offs_off + 4 * len(vector_offs)
+    text_offs_off = vectors_off + 4 * len(vectors)
+
+    temp_path = file_path + ".tmp"
+    with open(temp_path, 'wb') as file:
+        file.write(STORE_HEADER.pack(STORE_MAGIC, STORE_VERSION, len(doc_ids), len(terms), doc_lens_off,
+                                     doc_id_offs_off, doc_id_blob_off, term_offs_off, term_blob_off,
+                                     vector_offs_off, vectors_off, text_offs_off))
+        file.write(pack_uint32(doc_lens))
+        file.write(pack_uint32(doc_id_offs))
+        file.write(b"".join(doc_ids))
+        file.write(pack_uint32(term_offs))
+        file.write(b"".join(terms))
+        file.write(pack_uint32(vector_offs))
+        file.write(pack_uint32(vectors))
+        file.write(pack_uint64(text_offs))
+        for text in texts:
+            file.write(text)
+    os.replace(temp_path, file_path)
@@ -0,0 +1,229 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Metrics of every query, in the order they are reported
+METRICS = ["precision", "recall", "p_10", "r_precision", "map", "bpref", "ndcg", "ndcg_10"]
+# A (query, document) pair is one int64 key: query index in the high 32 bits, document index in the low 32 bits
+KEY_SHIFT = 32
+
+# Judgments of a worker process, read once by init_worker
+worker_state = {}
+
+
+# Discounted cumulative gain of every position, the gain of a document is its relevance grade
+def discounts(ranks):
+    return 1.0 / np.log2(ranks + 1.0)
+
+
+# Relevance judgments parsed once into sorted keys and grades
+# Documents and queries get dense integer indices, a run is looked up against them with one searchsorted
+class Qrels:
+
+    def __init__(self, qrels_path):
+        if np is None:
+            raise ImportError("Vectorised evaluation needs NumPy")
+        self.query_index = {}  # query id -> index
+        self.doc_index = {}  # document id -> index
+        queries = []
+        docs = []
+        grades = []
+        with open(qrels_path, 'r') as file:
+            for line in file:
+                fields = line.split()
+                if len(fields) < 4:
+                    continue
+                queries.append(self.query_index.setdefault(fields[0], len(self.query_index)))
+                docs.append(self.doc_index.setdefault(fields[2], len(self.doc_index)))
+                grades.append(int(fields[3]))
+        queries = np.asarray(queries, dtype=np.int64)
+        grades = np.asarray(grades, dtype=np.float64)
+        keys = (queries << KEY_SHIFT) | np.asarray(docs, dtype=np.int64)
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.grades = grades[order]
+
+        # Relevant documents of every query, and the DCG of the ideal ranking of its judgments
+        query_count = len(self.query_index)
+        relevant = grades > 0
+        self.relevant = np.bincount(queries, weights=relevant, minlength=query_count)
+        order = np.lexsort((-grades, queries))
+        sorted_queries = queries[order]
+        starts = np.searchsorted(sorted_queries, np.arange(query_count))
+        positions = np.arange(len(order)) - starts[sorted_queries] + 1
+        gains = np.maximum(grades[order], 0) * discounts(positions)
+        self.ideal_dcg = np.bincount(sorted_queries, weights=gains, minlength=query_count)
+        self.ideal_dcg_10 = np.bincount(sorted_queries, weights=gains * (positions <= 10), minlength=query_count)
+
+
+# Ranked lists of a run as arrays, from the query id, rank and doc id columns of its rows
+# Rows are grouped by query in order of first appearance and sorted by rank inside a query
+class Run:
+
+    def __init__(self, query_column, rank_column, doc_column, qrels):
+        self.query_ids = list(dict.fromkeys(query_column))
+        local_index = {query_id: index for index, query_id in enumerate(self.query_ids)}
+        queries = np.fromiter((local_index[query_id] for query_id in query_column), dtype=np.int64,
+                              count=len(query_column))
+        ranks = np.asarray(rank_column, dtype=np.int64)
+        # Documents that were never judged get -1 and never match a key
+        docs = np.fromiter((qrels.doc_index.get(doc_id, -1) for doc_id in doc_column), dtype=np.int64,
+                           count=len(query_column))
+        order = np.lexsort((ranks, queries))
+        self.queries = queries[order]
+        self.ranks = ranks[order]
+        self.docs = docs[order]
+        # Index of every run query in the judgments, -1 for a query without judgments
+        self.judged_queries = np.asarray([qrels.query_index.get(query_id, -1) for query_id in self.query_ids],
+                                         dtype=np.int64)
+
+
+# Run file with "<query id> <rank> <doc id> <score>" per line
+def read_run(run_path, qrels):
+    with open(run_path, 'r') as file:
+        fields = file.read().split()
+    return Run(fields[0::4], fields[1::4], fields[2::4], qrels)
+
+
+# Run of rankings held in memory, as automatic() would write them; positive_only keeps only scores > 0
+# as search_large_corpus does
+def rankings_run(query_ids, rankings, qrels, positive_only=False):
+    query_column = []
+    rank_column = []
+    doc_column = []
+    for query_id, ranking in zip(query_ids, rankings):
+        rank = 1
+        for doc_id, score in ranking:
+            if positive_only and not score > 0:
+                continue
+            query_column.append(query_id)
+            rank_column.append(rank)
+            doc_column.append(doc_id)
+            rank += 1
+    return Run(query_column, rank_column, doc_column, qrels)
+
+
+# Every metric of every query of a run in one pass over its rows
+# The definitions are those of evaluate_small_corpus: precision and recall over the whole ranking, P@10, R-precision,
+# MAP and bpref where a non-relevant document counts at most as many times as the relevant documents retrieved,
+# nDCG uses the relevance grades with a log2 discount, over the whole ranking and the first 10 ranks
+def evaluate_run(run, qrels):
+    query_count = len(run.query_ids)
+    queries = run.queries
+    ranks = run.ranks.astype(np.float64)
+
+    # Grade of every row, 0 for documents without a judgment
+    judged = run.judged_queries[queries]
+    keys = np.where((judged >= 0) & (run.docs >= 0), (judged << KEY_SHIFT) | np.maximum(run.docs, 0), -1)
+    positions = np.minimum(np.searchsorted(qrels.keys, keys), max(len(qrels.keys) - 1, 0))
+    found = (keys >= 0) & (qrels.keys[positions] == keys) if len(qrels.keys) else np.zeros(len(keys), dtype=bool)
+    grades = np.where(found, qrels.grades[positions], 0.0)
+    relevant = grades > 0
+
+    # Position of a row inside its query, and the relevant rows up to and including it
+    retrieved = np.bincount(queries, minlength=query_count)
+    starts = np.concatenate(([0], np.cumsum(retrieved)[:-1]))
+    offsets = np.arange(len(queries)) - starts[queries]
+    relevant_cumulative = np.cumsum(relevant)
+    relevant_before_query = np.concatenate(([0], relevant_cumulative))[starts]
+    relevant_so_far = relevant_cumulative - relevant_before_query[queries]
+    non_relevant_above = offsets + 1 - relevant_so_far
+
+    judged_relevant = np.where(run.judged_queries >= 0, qrels.relevant[np.maximum(run.judged_queries, 0)], 0.0)
+    hits = np.bincount(queries, weights=relevant, minlength=query_count)
+    row_judged_relevant = judged_relevant[queries]
+    row_hits = hits[queries]
+
+    def per_query(weights):
+        return np.bincount(queries, weights=weights, minlength=query_count)
+
+    def ratio(numerator, denominator):
+        return np.divide(numerator, denominator, out=np.zeros(query_count), where=denominator > 0)
+
+    # bpref adds 1 - min(non-relevant above, relevant retrieved) / relevant retrieved for every relevant row
+    bpref_terms = np.where(relevant, 1 - np.minimum(non_relevant_above, row_hits) /
+                           np.where(row_hits > 0, row_hits, 1), 0.0)
+    gains = grades * discounts(ranks)
+    ideal = np.where(run.judged_queries >= 0, qrels.ideal_dcg[np.maximum(run.judged_queries, 0)], 0.0)
+    ideal_10 = np.where(run.judged_queries >= 0, qrels.ideal_dcg_10[np.maximum(run.judged_queries, 0)], 0.0)
+    return {
+        "precision": ratio(hits, retrieved),
+        "recall": ratio(hits, judged_relevant),
+        "p_10": per_query(relevant & (ranks <= 10)) / 10,
+        "r_precision": ratio(per_query(relevant & (ranks <= row_judged_relevant)), judged_relevant),
+        "map": ratio(per_query(np.where(relevant, relevant_so_far / ranks, 0.0)), judged_relevant),
+        "bpref": ratio(per_query(bpref_terms), hits),
+        "ndcg": ratio(per_query(gains), ideal),
+        "ndcg_10": ratio(per_query(gains * (ranks <= 10)), ideal_10),
+    }
+
+
+# Per query and mean metrics of a run, the mean is over the queries of the run as in evaluate_small_corpus
+def run_report(run, qrels):
+    scores = evaluate_run(run, qrels)
+    columns = {metric: scores[metric].tolist() for metric in METRICS}
+    count = len(run.query_ids)
+    return {
+        "queries": count,
+        "mean": {metric: sum(values) / count if count else 0.0 for metric, values in columns.items()},
+        "per_query": {query_id: {metric: columns[metric][i] for metric in METRICS}
+                      for i, query_id in enumerate(run.query_ids)},
+    }
+
+
+def evaluation_report(run_path, qrels):
+    report = {"run": run_path}
+    report.update(run_report(read_run(run_path, qrels), qrels))
+    return report
+
+
+def init_worker(qrels_path):
+    worker_state["qrels"] = Qrels(qrels_path)
+
+
+def evaluate_in_worker(run_path):
+    return evaluation_report(run_path, worker_state["qrels"])
+
+
+# Evaluate run files in worker processes that each parse the judgments once, reports come back in input order
+def evaluate_runs(run_paths, qrels_path, workers=1):
+    if workers <= 1 or len(run_paths) <= 1:
+        qrels = Qrels(qrels_path)
+        return [evaluation_report(run_path, qrels) for run_path in run_paths]
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(qrels_path,)) as executor:
+        return list(executor.map(evaluate_in_worker, run_paths))
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Evaluate run files against the relevance judgments')
+    parser.add_argument('runs', nargs='*', default=[os.path.join(script_dir, "files", "results.txt")],
+                        help='Run files in the format of files/results.txt')
+    parser.add_argument('--qrels', default=os.path.join(script_dir, "files", "qrels.txt"),
+                        help='Relevance judgments')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1,
+                        help='Number of processes evaluating run files')
+    parser.add_argument('--per-query', action='store_true', help='Print the metrics of every query')
+    parser.add_argument('-o', '--output', default=None, help='Write all reports as JSON to this file')
+    args = parser.parse_args()
+
+    reports = evaluate_runs(args.runs, args.qrels, args.workers)
+    print("run" + "".join(f"\t{metric}" for metric in METRICS))
+    for report in reports:
+        if args.per_query:
+            for query_id, scores in report["per_query"].items():
+                print(f"{report['run']}:{query_id}" + "".join(f"\t{scores[metric]:.4f}" for metric in METRICS))
+        print(report["run"] + "".join(f"\t{report['mean'][metric]:.4f}" for metric in METRICS))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(reports, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
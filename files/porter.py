@@ -26,8 +26,14 @@
 #
 # It has been modified slightly for ease of use.
 #
+# CachedPorterStemmer at the end of this file remembers the stem of every word,
+# see its docstring.
+#
 ###
 
+import json
+from collections import OrderedDict
+
 class PorterStemmer:
 
     def __init__(self):
@@ -338,4 +344,70 @@ class PorterStemmer:
         self.step3()
         self.step4()
         self.step5()
-        return self.b[self.k0:self.k+1]
\ No newline at end of file
+        return self.b[self.k0:self.k+1]
+
+
+class CachedPorterStemmer(PorterStemmer):
+
+    def __init__(self, max_size=None):
+        """A PorterStemmer that stems every distinct word only once.
+
+        With max_size None the cache is a vocabulary table that keeps every
+        word, otherwise it is an LRU cache of at most max_size words. The
+        table can be saved next to an index and loaded again, so that
+        stemming the words of a query is a dictionary lookup.
+        """
+        PorterStemmer.__init__(self)
+        self.max_size = max_size
+        self.cache = OrderedDict() if max_size else {}
+        self.hits = 0
+        self.misses = 0
+
+    def stem(self, p):
+        """Return the stem of p from the cache, stemming it on a miss."""
+        cache = self.cache
+        if p in cache:
+            self.hits += 1
+            if self.max_size:
+                cache.move_to_end(p)
+            return cache[p]
+        self.misses += 1
+        word = PorterStemmer.stem(self, p)
+        cache[p] = word
+        if self.max_size and len(cache) > self.max_size:
+            cache.popitem(last=False)
+        return word
+
+    def stem_many(self, words):
+        """Stem a list of words, each distinct word is looked up once and
+        the stems are mapped back to every occurrence.
+        """
+        table = {}
+        for word in set(words):
+            table[word] = self.stem(word)
+        self.hits += len(words) - len(table)
+        return [table[word] for word in words]
+
+    def hit_rate(self):
+        """Fraction of stem requests answered from the cache."""
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
+
+    def cache_info(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.cache),
+                "max_size": self.max_size, "hit_rate": self.hit_rate()}
+
+    def save(self, file_path):
+        """Write the cached word -> stem table as JSON."""
+        with open(file_path, 'w', encoding='utf-8') as file:
+            json.dump(dict(self.cache), file, ensure_ascii=False)
+
+    def load(self, file_path):
+        """Add a table written by save() to the cache."""
+        with open(file_path, 'r', encoding='utf-8') as file:
+            table = json.load(file)
+        for word, stem in table.items():
+            self.cache[word] = stem
+        if self.max_size:
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
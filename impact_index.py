@@ -0,0 +1,263 @@
+import argparse
+import heapq
+import os
+import struct
+import time
+from array import array
+from collections import Counter, defaultdict
+import files.porter as porter
+import search_small_corpus
+from analyzer import analyze, read_stopwords
+from evaluate_small_corpus import calculate_map, read_rel
+
+# Layout of an impact file, all numbers little-endian:
+#   header      magic, version, bits, k, b, scale, document and term counts
+#   doc ids     uint32 length + utf-8 bytes per document
+#   terms       uint32 length + utf-8 term, uint32 segment count, then per segment
+#               uint32 impact, uint32 count and count uint32 doc ids in ascending order
+# Segments of a term are stored highest impact first.
+MAGIC = b"BM25IMP\0"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<8sIIdddII")
+SEGMENT = struct.Struct("<II")
+LENGTH = struct.Struct("<I")
+
+# Postings added between two deadline checks
+CHUNK_SIZE = 1024
+# Estimated seconds to rank one touched document in the final top-k, that time is kept free of a time budget
+SELECT_SECONDS = 3e-7
+
+
+# Postings of every term grouped by quantised BM25 impact, highest impact first
+# impact = round(score * scale), so a document's score is about the sum of its impacts / scale
+class ImpactIndex:
+
+    def __init__(self, doc_ids, bits, k, b, scale):
+        self.doc_ids = list(doc_ids)
+        self.bits = bits
+        self.k = k
+        self.b = b
+        self.scale = scale
+        self.terms = {}  # term -> [(impact, doc ids), ...]
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __contains__(self, term):
+        return term in self.terms
+
+    def add_term(self, term, segments):
+        self.terms[term] = segments
+
+    def num_postings(self):
+        return sum(len(docs) for segments in self.terms.values() for impact, docs in segments)
+
+
+# Quantise the BM25 score of every posting to bits bits
+# A posting with a score <= 0 can only lower a document, it is left out as in most impact-ordered indexes
+def build_impact_index(postings_index, k=1, b=0.75, bits=8):
+    # The largest score of the collection is given the largest impact, so the postings are walked twice
+    max_score = 0.0
+    for term, docs, scores in posting_scores(postings_index, k, b):
+        max_score = max(max_score, max(scores))
+    scale = ((1 << bits) - 1) / max_score if max_score > 0 else 1.0
+    impact_index = ImpactIndex(postings_index.doc_ids, bits, k, b, scale)
+    for term, docs, scores in posting_scores(postings_index, k, b):
+        groups = {}
+        for doc, score in zip(docs, scores):
+            if score > 0:
+                impact = max(1, round(score * scale))
+                groups.setdefault(impact, array('I')).append(doc)
+        if groups:
+            impact_index.add_term(term, sorted(groups.items(), reverse=True))
+    return impact_index
+
+
+# (term, docs, BM25 score of every posting) of each term
+def posting_scores(postings_index, k, b):
+    norms = postings_index.norms(k, b)
+    k_plus = k + 1
+    for term, (idf, docs, tfs) in postings_index.iter_postings():
+        yield term, docs, [idf * (tf * k_plus) / (tf + norms[doc]) for doc, tf in zip(docs, tfs)]
+
+
+def write_impact_index(impact_index, file_path):
+    temp_path = file_path + ".tmp"
+    with open(temp_path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, FORMAT_VERSION, impact_index.bits, impact_index.k, impact_index.b,
+                               impact_index.scale, len(impact_index.doc_ids), len(impact_index.terms)))
+        for doc_id in impact_index.doc_ids:
+            doc_id = str(doc_id).encode('utf-8')
+            file.write(LENGTH.pack(len(doc_id)))
+            file.write(doc_id)
+        for term, segments in impact_index.terms.items():
+            term = term.encode('utf-8')
+            file.write(LENGTH.pack(len(term)))
+            file.write(term)
+            file.write(LENGTH.pack(len(segments)))
+            for impact, docs in segments:
+                file.write(SEGMENT.pack(impact, len(docs)))
+                file.write(array('I', docs).tobytes())
+    os.replace(temp_path, file_path)
+
+
+def open_impact_index(file_path):
+    with open(file_path, 'rb') as file:
+        data = file.read()
+    magic, version, bits, k, b, scale, num_docs, num_terms = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{file_path} is not an impact index file")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"{file_path} has impact format version {version}, expected {FORMAT_VERSION}")
+    offset = HEADER.size
+
+    def read_string():
+        nonlocal offset
+        length = LENGTH.unpack_from(data, offset)[0]
+        offset += LENGTH.size + length
+        return data[offset - length:offset].decode('utf-8')
+
+    doc_ids = [read_string() for _ in range(num_docs)]
+    impact_index = ImpactIndex(doc_ids, bits, k, b, scale)
+    for _ in range(num_terms):
+        term = read_string()
+        num_segments = LENGTH.unpack_from(data, offset)[0]
+        offset += LENGTH.size
+        segments = []
+        for _ in range(num_segments):
+            impact, count = SEGMENT.unpack_from(data, offset)
+            offset += SEGMENT.size
+            docs = array('I')
+            docs.frombytes(data[offset:offset + 4 * count])
+            offset += 4 * count
+            segments.append((impact, docs))
+        impact_index.add_term(term, segments)
+    return impact_index
+
+
+# Score-at-a-time ranking: segments of all query terms are added highest impact first,
+# so stopping early keeps the postings that matter most for the top of the ranking.
+# posting_budget caps the postings added, time_budget caps the seconds spent; without either the ranking is exhaustive.
+# Returns the best top_k (doc_id, score) found so far and {"postings", "total", "complete"}
+def bm25_saat(query, impact_index, top_k=10, posting_budget=None, time_budget=None):
+    start_time = time.perf_counter()
+    # A term repeated in the query is added once per occurrence, as in bm25_taat
+    counts = Counter(term for term in query if term in impact_index)
+    segments = []
+    for term, count in counts.items():
+        for impact, docs in impact_index.terms[term]:
+            segments.append((impact * count, docs))
+    # sort() is stable, equal impacts keep query term order
+    segments.sort(key=lambda segment: segment[0], reverse=True)
+
+    # Segments are short, adding them one posting at a time is cheaper than a NumPy call per segment
+    # Only documents that received a posting have an accumulator, so the cost follows the postings added and
+    # not the size of the collection
+    accumulators = defaultdict(int)
+    processed = 0
+    complete = True
+    for impact, docs in segments:
+        position = 0
+        while position < len(docs):
+            if ((posting_budget is not None and processed >= posting_budget) or
+                    (time_budget is not None and
+                     time.perf_counter() - start_time + SELECT_SECONDS * len(accumulators) >= time_budget)):
+                complete = False
+                break
+            end = min(len(docs), position + CHUNK_SIZE)
+            if posting_budget is not None:
+                end = min(end, position + posting_budget - processed)
+            for doc in docs[position:end]:
+                accumulators[doc] += impact
+            processed += end - position
+            position = end
+        if not complete:
+            break
+
+    stats = {"postings": processed, "total": sum(len(docs) for impact, docs in segments), "complete": complete}
+    doc_ids = impact_index.doc_ids
+    scale = impact_index.scale
+    # Equal scores keep the document order of the collection
+    best = heapq.nsmallest(top_k, [(-score, doc) for doc, score in accumulators.items() if score])
+    return [(doc_ids[doc], -score / scale) for score, doc in best], stats
+
+
+# Latency and MAP of the queries under each budget, next to exhaustive bm25_model cut to the same depth
+# budgets are ("postings", n) or ("ms", milliseconds)
+def impact_benchmark(queries, postings_index, impact_index, relevance, depth=100, budgets=()):
+    runs = [("exhaustive", None)] + [("saat", None)] + [("saat", budget) for budget in budgets]
+    report = []
+    for method, budget in runs:
+        results = {}
+        latencies = []
+        postings = 0
+        total = 0
+        for query_id, query in queries:
+            start_time = time.perf_counter()
+            if method == "exhaustive":
+                ranking = search_small_corpus.bm25_model(query, postings_index, impact_index.k, impact_index.b)[:depth]
+            else:
+                posting_budget = budget[1] if budget is not None and budget[0] == "postings" else None
+                time_budget = budget[1] / 1000 if budget is not None and budget[0] == "ms" else None
+                ranking, stats = bm25_saat(query, impact_index, depth, posting_budget, time_budget)
+                postings += stats["postings"]
+                total += stats["total"]
+            latencies.append(time.perf_counter() - start_time)
+            results[query_id] = {rank: doc_id for rank, (doc_id, score) in enumerate(ranking, 1)}
+        latencies.sort()
+        if method == "exhaustive":
+            label = "exhaustive bm25_model"
+        elif budget is None:
+            label = "saat, no budget"
+        else:
+            label = f"saat, {budget[1]} {budget[0]}"
+        report.append({
+            "run": label,
+            "mean_ms": 1000 * sum(latencies) / len(latencies),
+            "p95_ms": 1000 * latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))],
+            "map": calculate_map(results, relevance),
+            "postings": postings / total if total else 1.0,
+        })
+    return report
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Build an impact-ordered index and compare it with exhaustive BM25')
+    parser.add_argument('-o', '--output', default="index_impact.bin", help='Impact index file to write')
+    parser.add_argument('--bits', type=int, default=8, help='Bits of a quantised impact')
+    parser.add_argument('-d', '--depth', type=int, default=100, help='Ranking depth used for MAP')
+    parser.add_argument('--postings', type=int, nargs='*', default=[250, 500, 1000, 2000],
+                        help='Posting budgets to benchmark')
+    parser.add_argument('--ms', type=float, nargs='*', default=[0.5, 1.0],
+                        help='Time budgets in milliseconds to benchmark')
+    args = parser.parse_args()
+
+    # The idf and document lengths come from the BM25 index of the small corpus, built when missing
+    stopwords = read_stopwords(os.path.join(script_dir, "files", "stopwords.txt"))
+    p = porter.CachedPorterStemmer()
+    documents = search_small_corpus.read_documents_info(os.path.join(script_dir, "documents_2"))
+    index, postings_index, avg_doclen = search_small_corpus.create_index(documents, stopwords, p)
+
+    start_time = time.time()
+    write_impact_index(build_impact_index(postings_index, bits=args.bits), args.output)
+    impact_index = open_impact_index(args.output)
+    print(f"Wrote {args.output}: {impact_index.num_postings()} postings with {args.bits} bit impacts, "
+          f"{os.path.getsize(args.output)} bytes in {time.time() - start_time} seconds")
+
+    queries = []
+    with open(os.path.join(script_dir, "files", "queries.txt"), "r") as queries_file:
+        for query in queries_file:
+            query_terms = query.strip().split(" ")
+            queries.append((query_terms[0], analyze(" ".join(query_terms[1:]).strip(), stopwords, p)))
+    relevance = read_rel(os.path.join(script_dir, "files", "qrels.txt"))
+    budgets = [("postings", budget) for budget in args.postings] + [("ms", budget) for budget in args.ms]
+
+    print(f"{'run':<26}{'mean ms':>10}{'p95 ms':>10}{'MAP@' + str(args.depth):>10}{'postings':>10}")
+    for row in impact_benchmark(queries, postings_index, impact_index, relevance, args.depth, budgets):
+        print(f"{row['run']:<26}{row['mean_ms']:>10.3f}{row['p95_ms']:>10.3f}{row['map']:>10.4f}"
+              f"{row['postings']:>10.1%}")
+
+
+if __name__ == '__main__':
+    main()
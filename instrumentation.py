@@ -0,0 +1,138 @@
+import cProfile
+import io
+import json
+import pstats
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import nullcontext
+
+# Returned by stage() while instrumentation is off, so a disabled stage costs one call and a flag check
+NULL_STAGE = nullcontext()
+
+
+# A stage inside another one is reported as "outer/inner", so query analysis and document analysis stay apart
+class StageTimer:
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        stack = self.instrumentation.stack
+        self.path = stack[-1] + "/" + self.name if stack else self.name
+        stack.append(self.path)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        self.instrumentation.stack.pop()
+        self.instrumentation.seconds[self.path] += seconds
+        self.instrumentation.calls[self.path] += 1
+        return False
+
+
+# Stage timers and counters for indexing and queries, off by default
+# cProfile and tracemalloc can be switched on with it for a function level and an allocation level view
+class Instrumentation:
+
+    def __init__(self):
+        self.enabled = False
+        self.report_path = None
+        self.profiler = None
+        self.trace_memory = False
+        self.reset()
+
+    def reset(self):
+        self.seconds = defaultdict(float)
+        self.calls = Counter()
+        self.counters = Counter()
+        self.stack = []
+        self.started = time.perf_counter()
+
+    def enable(self, profile=False, trace_memory=False, report_path=None):
+        self.enabled = True
+        self.report_path = report_path
+        if profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        if trace_memory:
+            self.trace_memory = True
+            tracemalloc.start()
+
+    def disable(self):
+        self.enabled = False
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.trace_memory:
+            tracemalloc.stop()
+            self.trace_memory = False
+
+    def stage(self, name):
+        if self.enabled:
+            return StageTimer(self, name)
+        return NULL_STAGE
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] += n
+
+    def report(self, top=15):
+        report = {
+            "seconds": time.perf_counter() - self.started,
+            "stages": {name: {"seconds": self.seconds[name], "calls": self.calls[name]}
+                       for name in sorted(self.seconds)},
+            "counters": dict(self.counters),
+        }
+        if self.profiler is not None:
+            stats = pstats.Stats(self.profiler)
+            functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+            report["profile"] = [{"function": f"{file_name}:{line}({name})", "calls": calls, "own_seconds": own,
+                                  "cumulative_seconds": cumulative}
+                                 for (file_name, line, name), (primitive, calls, own, cumulative, callers)
+                                 in functions]
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            statistics = tracemalloc.take_snapshot().statistics('lineno')[:top]
+            report["memory"] = {"current_bytes": current, "peak_bytes": peak,
+                                "top": [{"line": str(stat.traceback), "bytes": stat.size, "blocks": stat.count}
+                                        for stat in statistics]}
+        return report
+
+    def text_report(self, top=15):
+        report = self.report(top)
+        lines = [f"Instrumented {report['seconds']:.3f} seconds"]
+        for name, stage in report["stages"].items():
+            lines.append(f"  {name:<30}{stage['seconds']:>10.4f} s{stage['calls']:>10} calls")
+        for name, value in sorted(report["counters"].items()):
+            lines.append(f"  {name:<30}{value:>12}")
+        if self.profiler is not None:
+            output = io.StringIO()
+            pstats.Stats(self.profiler, stream=output).sort_stats('cumulative').print_stats(top)
+            lines.append(output.getvalue().rstrip())
+        if "memory" in report:
+            memory = report["memory"]
+            lines.append(f"  memory: {memory['current_bytes']} bytes traced, peak {memory['peak_bytes']} bytes")
+            for stat in memory["top"]:
+                lines.append(f"    {stat['bytes']:>12} bytes {stat['line']}")
+        return "\n".join(lines)
+
+    # Write the JSON report when a report path was given, and print the text report
+    def emit(self):
+        if self.report_path:
+            with open(self.report_path, 'w', encoding='utf-8') as file:
+                json.dump(self.report(), file, indent=2)
+        print(self.text_report())
+
+
+# Process-wide instrumentation used by the analyzer, the indexing code and the scorers
+instrumentation = Instrumentation()
+
+
+def stage(name):
+    return instrumentation.stage(name)
+
+
+def count(name, n=1):
+    instrumentation.count(name, n)
@@ -0,0 +1,111 @@
+import argparse
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import files.porter as porter
+from analyzer import analyze, read_stopwords
+from binary_index import open_binary_index
+from bm25_index import bm25_taat, bm25_topk
+from segment_index import SegmentIndex
+
+# Index and search settings of a worker process, set once by init_worker
+worker_state = {}
+
+
+# Open the index in a worker: ("binary", index file) or ("segments", index directory)
+# Index files are opened with mmap, so every worker reads the same pages of the page cache instead of a pickled copy
+def open_index(index_spec):
+    kind, path = index_spec
+    if kind == "binary":
+        return open_binary_index(path)
+    elif kind == "segments":
+        # Stopwords and the stemmer are only needed to update the index
+        return SegmentIndex(path, frozenset(), None).view()
+    raise ValueError(f"Unknown index kind: {kind}")
+
+
+def init_worker(index_spec, k, b, top_k, pruning):
+    worker_state["index"] = open_index(index_spec)
+    worker_state["settings"] = (k, b, top_k, pruning)
+
+
+# Rank one batch of analysed queries, top_k None gives the full bm25_taat ranking
+def search_batch(queries):
+    postings_index = worker_state["index"]
+    k, b, top_k, pruning = worker_state["settings"]
+    rankings = []
+    scored = 0
+    skipped = 0
+    for query in queries:
+        if top_k is None:
+            rankings.append(bm25_taat(query, postings_index, k, b))
+        else:
+            ranking, counters = bm25_topk(query, postings_index, k, b, top_k, pruning)
+            rankings.append(ranking)
+            scored += counters["scored"]
+            skipped += counters["skipped"]
+    return rankings, scored, skipped
+
+
+# Rank the queries in worker processes, the rankings come back in query order whatever the scheduling
+def parallel_search(queries, index_spec, workers, k=1, b=0.75, top_k=None, pruning="maxscore"):
+    # A few batches per worker keeps the cores busy when queries differ in cost
+    batch_size = max(1, math.ceil(len(queries) / (workers * 4)))
+    batches = [queries[i:i + batch_size] for i in range(0, len(queries), batch_size)]
+    rankings = []
+    counters = {"scored": 0, "skipped": 0}
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(index_spec, k, b, top_k, pruning)) as executor:
+        for batch_rankings, scored, skipped in executor.map(search_batch, batches):
+            rankings.extend(batch_rankings)
+            counters["scored"] += scored
+            counters["skipped"] += skipped
+    return rankings, counters
+
+
+# Queries per second of the query file repeated repeat times, for each number of workers
+def throughput(queries, index_spec, worker_counts, top_k=None, repeat=1):
+    queries = queries * repeat
+    report = []
+    serial = None
+    for workers in worker_counts:
+        start_time = time.perf_counter()
+        if workers == 1:
+            init_worker(index_spec, 1, 0.75, top_k, "maxscore")
+            rankings = search_batch(queries)[0]
+        else:
+            rankings = parallel_search(queries, index_spec, workers, 1, 0.75, top_k)[0]
+        seconds = time.perf_counter() - start_time
+        if serial is None:
+            serial = rankings
+        report.append({"workers": workers, "queries": len(queries), "seconds": seconds,
+                       "qps": len(queries) / seconds, "same_as_first": rankings == serial})
+    return report
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Query throughput with worker processes')
+    parser.add_argument('-i', '--index', default="index.bin", help='Binary index file')
+    parser.add_argument('-w', '--workers', type=int, nargs='+', default=[1, 2, 4], help='Worker counts to compare')
+    parser.add_argument('-k', '--top-k', type=int, default=None, help='Rank only the top k documents')
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='Repeat the query file to build a larger query set')
+    args = parser.parse_args()
+
+    stopwords = read_stopwords(os.path.join(script_dir, "files", "stopwords.txt"))
+    p = porter.CachedPorterStemmer()
+    queries = []
+    with open(os.path.join(script_dir, "files", "queries.txt"), "r") as queries_file:
+        for query in queries_file:
+            queries.append(analyze(" ".join(query.strip().split(" ")[1:]).strip(), stopwords, p))
+
+    print(f"{os.cpu_count()} cores")
+    for row in throughput(queries, ("binary", args.index), args.workers, args.top_k, args.repeat):
+        print(f"{row['workers']} workers: {row['queries']} queries in {row['seconds']:.3f} seconds, "
+              f"{row['qps']:.1f} queries/s, same rankings: {row['same_as_first']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+import argparse
+import json
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+import files.porter as porter
+import search_large_corpus
+import search_small_corpus
+from analyzer import analyze, read_stopwords
+from bm25_matrix import BM25Matrix, bm25_batch
+from document_store import LazyDocuments
+from evaluate_runs import METRICS, Qrels, rankings_run, run_report
+from parallel_search import open_index
+
+# Corpus -> (document folder, binary index file written by create_index, whether only scores > 0 are written)
+CORPORA = {
+    "small": ("documents_2", "index.bin", False),
+    "large": ("documents", "index_large.bin", True),
+}
+
+# Index, analysed queries and judgments of a worker process, set once by init_worker
+worker_state = {}
+
+
+# Build or load the index of a corpus in the current directory as automatic() does, and analyse the queries once
+# The documents are read from the corpus folder next to this script, wherever it is run from
+def load_corpus(corpus, queries_path, p):
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    stopwords = read_stopwords(os.path.join(script_dir, "files", "stopwords.txt"))
+    documents_path = os.path.join(script_dir, CORPORA[corpus][0])
+    if corpus == "large":
+        index, postings, avg_doclen = search_large_corpus.create_index(documents_path, p)
+    else:
+        documents = LazyDocuments(search_small_corpus.read_documents_info, documents_path)
+        index, postings, avg_doclen = search_small_corpus.create_index(documents, stopwords, p)
+    query_ids = []
+    queries = []
+    with open(queries_path, "r") as queries_file:
+        for query in queries_file:
+            query_terms = query.strip().split(" ")
+            query_ids.append(query_terms[0])
+            queries.append(analyze(" ".join(query_terms[1:]).strip(), stopwords, p))
+    return postings, query_ids, queries
+
+
+def set_state(postings_index, query_ids, queries, qrels, positive_only, depth):
+    worker_state.update({"index": postings_index, "query_ids": query_ids, "queries": queries, "qrels": qrels,
+                         "positive_only": positive_only, "depth": depth})
+
+
+# Workers map the binary index file instead of receiving a pickled copy of the index
+def init_worker(index_spec, query_ids, queries, qrels_path, positive_only, depth):
+    set_state(open_index(index_spec), query_ids, queries, Qrels(qrels_path), positive_only, depth)
+
+
+# Mean metrics of one (k1, b) setting, the rankings are evaluated in memory without a results file
+def evaluate_setting(setting):
+    k, b = setting
+    state = worker_state
+    rankings = bm25_batch(state["queries"], BM25Matrix(state["index"], k, b), state["depth"])
+    run = rankings_run(state["query_ids"], rankings, state["qrels"], state["positive_only"])
+    return run_report(run, state["qrels"])["mean"]
+
+
+def grid_settings(k_values, b_values):
+    return [(k, b) for k in k_values for b in b_values]
+
+
+# Settings drawn uniformly from the k1 and b ranges, the same seed gives the same settings
+def random_settings(count, k_range, b_range, seed=0):
+    rng = random.Random(seed)
+    return [(round(rng.uniform(*k_range), 4), round(rng.uniform(*b_range), 4)) for _ in range(count)]
+
+
+# Metrics of every setting in input order, settings are spread over worker processes
+def sweep(settings, postings_index, index_spec, query_ids, queries, qrels_path, workers=1, positive_only=False,
+          depth=None):
+    if workers <= 1:
+        set_state(postings_index, query_ids, queries, Qrels(qrels_path), positive_only, depth)
+        return [evaluate_setting(setting) for setting in settings]
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(index_spec, query_ids, queries, qrels_path, positive_only, depth)) as executor:
+        return list(executor.map(evaluate_setting, settings))
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='BM25 k1 and b sweep over one loaded index')
+    parser.add_argument('--corpus', choices=list(CORPORA), default='small', help='Corpus to tune on')
+    parser.add_argument('--k1', type=float, nargs='+', default=[0.5, 0.75, 1.0, 1.2, 1.5, 2.0],
+                        help='k1 values of the grid')
+    parser.add_argument('--b', type=float, nargs='+', default=[0.25, 0.5, 0.75, 1.0], help='b values of the grid')
+    parser.add_argument('--random', type=int, default=None,
+                        help='Number of random settings drawn from --k1-range and --b-range instead of the grid')
+    parser.add_argument('--k1-range', type=float, nargs=2, default=[0.2, 3.0], help='Range of random k1 values')
+    parser.add_argument('--b-range', type=float, nargs=2, default=[0.0, 1.0], help='Range of random b values')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random settings')
+    parser.add_argument('-k', '--depth', type=int, default=None,
+                        help='Rank only the top k documents of each query, the full ranking by default')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1,
+                        help='Number of processes evaluating settings')
+    parser.add_argument('--sort', choices=METRICS, default='map', help='Metric the table is sorted by')
+    parser.add_argument('--queries', default=os.path.join(script_dir, "files", "queries.txt"), help='Query file')
+    parser.add_argument('--qrels', default=os.path.join(script_dir, "files", "qrels.txt"), help='Relevance judgments')
+    parser.add_argument('-o', '--output', default=None, help='Write the table as JSON to this file')
+    args = parser.parse_args()
+
+    if args.random:
+        settings = random_settings(args.random, args.k1_range, args.b_range, args.seed)
+    else:
+        settings = grid_settings(args.k1, args.b)
+    index_file, positive_only = CORPORA[args.corpus][1:]
+    # create_index writes the index in the current directory, workers are given its absolute path
+    index_spec = ("binary", os.path.abspath(index_file))
+
+    start_time = time.perf_counter()
+    postings, query_ids, queries = load_corpus(args.corpus, args.queries, porter.CachedPorterStemmer())
+    load_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    results = sweep(settings, postings, index_spec, query_ids, queries, args.qrels, args.workers,
+                    positive_only, args.depth)
+    sweep_time = time.perf_counter() - start_time
+
+    rows = [{"k1": k, "b": b, **metrics} for (k, b), metrics in zip(settings, results)]
+    rows.sort(key=lambda row: row[args.sort], reverse=True)
+    print("k1\tb" + "".join(f"\t{metric}" for metric in METRICS))
+    for row in rows:
+        print(f"{row['k1']}\t{row['b']}" + "".join(f"\t{row[metric]:.4f}" for metric in METRICS))
+    print(f"Loaded the index and {len(queries)} queries once in {load_time:.2f} seconds, "
+          f"evaluated {len(settings)} settings in {sweep_time:.2f} seconds")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump({"corpus": args.corpus, "depth": args.depth, "sort": args.sort, "results": rows}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
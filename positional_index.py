@@ -0,0 +1,393 @@
+import argparse
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+import files.porter as porter
+from analyzer import analyze, analyze_bulk, read_folder, read_stopwords
+from binary_index import TermList, pack_uint32, write_binary_index
+from bm25_index import build_postings_index, bm25_topk
+from boolean_query import QueryPlanner, matches_positions, position_terms
+from evaluate_runs import Qrels, rankings_run, run_report
+from postings_codec import varint_encode
+from term_dictionary import read_varint
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Layout of a positions file, all numbers little-endian:
+#   header        magic, version, document and term counts, number of positions, section offsets
+#   doc_id_offs   uint32 * (num_docs + 1), offsets into doc_id_blob
+#   doc_id_blob   utf-8 document IDs, in the dense id order of the postings index built from the same documents
+#   term_offs     uint32 * (num_terms + 1), offsets into term_blob
+#   term_blob     utf-8 terms in sorted order
+#   term_table    (df, offset of the term's data) per term
+#   term data     uint32 first doc of every block of SKIP_INTERVAL documents, uint32 offset of every block in the
+#                 term's positions, then per document: varint doc gap in its block, varint number of positions,
+#                 varint first position and the gaps to the next positions
+# Positions count the analysed words of a document, so stopwords between two words do not break a phrase
+POSITIONS_MAGIC = b"BM25POS\0"
+POSITIONS_VERSION = 1
+POSITIONS_HEADER = struct.Struct("<8sIIIQQQQQQ")
+POSITIONS_ENTRY = struct.Struct("<IQ")
+# Documents per skip entry, reading the positions of one document decodes at most one block
+SKIP_INTERVAL = 16
+# Occurrences of two query terms further apart than this do not count as close
+MAX_DISTANCE = 5
+# Documents of the BM25 ranking that are re-ranked with the proximity of the query terms
+PROXIMITY_DEPTH = 100
+
+
+# Read-only view of a positions file with mmap, the positions of a term are decoded block by block on use
+class PositionalIndex:
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.file = open(file_path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        (magic, version, self.num_docs, self.num_terms, self.num_positions, doc_id_offs_off, doc_id_blob_off,
+         term_offs_off, term_blob_off, term_table_off) = POSITIONS_HEADER.unpack_from(self.map)
+        if magic != POSITIONS_MAGIC:
+            raise ValueError(f"{file_path} is not a positions file")
+        if version != POSITIONS_VERSION:
+            raise ValueError(f"{file_path} has positions version {version}, expected {POSITIONS_VERSION}")
+        self.doc_id_offs = self.uint32(doc_id_offs_off, self.num_docs + 1)
+        self.doc_id_blob_off = doc_id_blob_off
+        self.term_offs = self.uint32(term_offs_off, self.num_terms + 1)
+        self.term_blob_off = term_blob_off
+        self.term_table_off = term_table_off
+        self.dense_ids = None
+
+    def __len__(self):
+        return self.num_docs
+
+    def __contains__(self, term):
+        return self.find_term(term) >= 0
+
+    def uint32(self, offset, count):
+        if sys.byteorder == 'little':
+            return self.view[offset:offset + 4 * count].cast('I')
+        values = array('I', self.view[offset:offset + 4 * count])
+        values.byteswap()
+        return values
+
+    def term(self, term_id):
+        start = self.term_blob_off + self.term_offs[term_id]
+        end = self.term_blob_off + self.term_offs[term_id + 1]
+        return str(self.view[start:end], 'utf-8')
+
+    def find_term(self, term):
+        low = bisect_left(TermList(self), term)
+        if low < self.num_terms and self.term(low) == term:
+            return low
+        return -1
+
+    def doc_id(self, doc):
+        start = self.doc_id_blob_off + self.doc_id_offs[doc]
+        end = self.doc_id_blob_off + self.doc_id_offs[doc + 1]
+        return str(self.view[start:end], 'utf-8')
+
+    # Dense id of a document ID, the table is built on the first lookup
+    def dense_id(self, doc_id):
+        if self.dense_ids is None:
+            self.dense_ids = {self.doc_id(doc): doc for doc in range(self.num_docs)}
+        return self.dense_ids[doc_id]
+
+    # Cursor over the positions of a term, or None if the term has no positions
+    def cursor(self, term):
+        term_id = self.find_term(term)
+        if term_id < 0:
+            return None
+        df, offset = POSITIONS_ENTRY.unpack_from(self.map, self.term_table_off + POSITIONS_ENTRY.size * term_id)
+        return PositionCursor(self, df, offset)
+
+    # Positions of a term in one document, empty when it does not occur
+    def positions(self, term, doc):
+        cursor = self.cursor(term)
+        return [] if cursor is None else cursor.positions(doc)
+
+    def close(self):
+        self.doc_id_offs = self.term_offs = None
+        self.view.release()
+        self.map.close()
+        self.file.close()
+
+
+# Positions of one term for documents asked in increasing dense id order: the skip entries are searched from the
+# current block on and only the block holding the document is decoded
+class PositionCursor:
+
+    def __init__(self, index, df, offset):
+        self.view = index.view
+        self.df = df
+        blocks = (df + SKIP_INTERVAL - 1) // SKIP_INTERVAL
+        self.skip_docs = index.uint32(offset, blocks)
+        self.skip_offs = index.uint32(offset + 4 * blocks, blocks)
+        self.data_off = offset + 8 * blocks
+        self.block = -1
+        self.docs = []
+        self.lists = []
+
+    def read_block(self, block):
+        view = self.view
+        position = self.data_off + self.skip_offs[block]
+        doc = self.skip_docs[block]
+        self.docs = []
+        self.lists = []
+        for _ in range(min(SKIP_INTERVAL, self.df - block * SKIP_INTERVAL)):
+            gap, position = read_varint(view, position)
+            doc += gap
+            count, position = read_varint(view, position)
+            positions = []
+            current = 0
+            for _ in range(count):
+                gap, position = read_varint(view, position)
+                current += gap
+                positions.append(current)
+            self.docs.append(doc)
+            self.lists.append(positions)
+        self.block = block
+
+    def positions(self, doc):
+        block = bisect_right(self.skip_docs, doc, max(self.block, 0)) - 1
+        if block < 0:
+            return []
+        if block != self.block:
+            self.read_block(block)
+        i = bisect_left(self.docs, doc)
+        if i < len(self.docs) and self.docs[i] == doc:
+            return self.lists[i]
+        return []
+
+
+def open_positional_index(file_path):
+    return PositionalIndex(file_path)
+
+
+# Write the positions of the analysed words {doc_id: [stem, ...]}, in the order of processed_doc, which must be the
+# dense doc id order of the postings index the positions are used with
+def write_positional_index(file_path, processed_doc):
+    occurrences = {}
+    num_positions = 0
+    for doc, words in enumerate(processed_doc.values()):
+        for position, term in enumerate(words):
+            if term in occurrences:
+                entry = occurrences[term]
+                if entry[-1][0] == doc:
+                    entry[-1][1].append(position)
+                else:
+                    entry.append((doc, [position]))
+            else:
+                occurrences[term] = [(doc, [position])]
+        num_positions += len(words)
+
+    terms = sorted(occurrences)
+    blocks = []
+    table = []
+    offset = 0
+    for term in terms:
+        entries = occurrences[term]
+        skip_docs = []
+        skip_offs = []
+        data = bytearray()
+        for i, (doc, positions) in enumerate(entries):
+            if i % SKIP_INTERVAL == 0:
+                skip_docs.append(doc)
+                skip_offs.append(len(data))
+                previous = doc
+            varint_encode((doc - previous, len(positions)), data)
+            varint_encode([position - last for position, last in zip(positions, [0] + positions[:-1])], data)
+            previous = doc
+        block = pack_uint32(skip_docs) + pack_uint32(skip_offs) + bytes(data)
+        blocks.append(block)
+        table.append((len(entries), offset))
+        offset += len(block)
+
+    doc_ids = [str(doc_id).encode('utf-8') for doc_id in processed_doc]
+    encoded_terms = [term.encode('utf-8') for term in terms]
+
+    def offsets(blobs):
+        values = [0]
+        for blob in blobs:
+            values.append(values[-1] + len(blob))
+        return values
+
+    doc_id_offs = offsets(doc_ids)
+    term_offs = offsets(encoded_terms)
+    doc_id_offs_off = POSITIONS_HEADER.size
+    doc_id_blob_off = doc_id_offs_off + 4 * len(doc_id_offs)
+    term_offs_off = doc_id_blob_off + doc_id_offs[-1]
+    term_blob_off = term_offs_off + 4 * len(term_offs)
+    term_table_off = term_blob_off + term_offs[-1]
+    data_off = term_table_off + POSITIONS_ENTRY.size * len(table)
+
+    temp_path = file_path + ".tmp"
+    with open(temp_path, 'wb') as file:
+        file.write(POSITIONS_HEADER.pack(POSITIONS_MAGIC, POSITIONS_VERSION, len(doc_ids), len(terms), num_positions,
+                                         doc_id_offs_off, doc_id_blob_off, term_offs_off, term_blob_off,
+                                         term_table_off))
+        file.write(pack_uint32(doc_id_offs))
+        file.write(b"".join(doc_ids))
+        file.write(pack_uint32(term_offs))
+        file.write(b"".join(encoded_terms))
+        for df, offset in table:
+            file.write(POSITIONS_ENTRY.pack(df, data_off + offset))
+        for block in blocks:
+            file.write(block)
+    os.replace(temp_path, file_path)
+
+
+# Phrases and proximity windows of a tree matched against the raw text of the candidate documents, the way a
+# phrase query would have to run without positions
+def rescan_phrases(tree, postings_index, documents, stopwords, p):
+    planner = QueryPlanner(postings_index)
+    docs = planner.evaluate(planner.plan(tree))
+    matches = []
+    for doc in docs:
+        words = analyze(documents[postings_index.doc_ids[doc]], stopwords, p)
+        position_lists = [[position for position, word in enumerate(words) if word == term]
+                          for term in position_terms(tree)]
+        if matches_positions(tree, position_lists):
+            matches.append(doc)
+    return matches
+
+
+# BM25 re-ranked by the proximity of the query terms, after Rasolofo and Savoy's BM25TP: every pair of occurrences
+# of two different query terms at most max_distance words apart adds 1 / distance² to both terms, and each term
+# adds min(1, idf) * acc * (k + 1) / (acc + norm) of its accumulated weight to the BM25 score of the document
+# Only the top depth documents of the BM25 ranking are re-ranked, so positions are read for them alone
+def bm25_proximity(query, postings_index, positional_index, k, b, top_k=None, depth=PROXIMITY_DEPTH,
+                   max_distance=MAX_DISTANCE):
+    ranking = bm25_topk(query, postings_index, k, b, max(depth, top_k or 0), "maxscore")[0]
+    terms = [term for term in dict.fromkeys(query) if postings_index.postings(term) is not None]
+    if len(terms) < 2 or not ranking:
+        return ranking if top_k is None else ranking[:top_k]
+    idfs = [min(1.0, postings_index.postings(term)[0]) for term in terms]
+    cursors = [positional_index.cursor(term) for term in terms]
+    norms = postings_index.norms(k, b)
+    k_plus = k + 1
+    docs = sorted((positional_index.dense_id(doc_id), i) for i, (doc_id, score) in enumerate(ranking))
+    boosts = [0.0] * len(ranking)
+    for doc, i in docs:
+        events = sorted((position, term) for term, cursor in enumerate(cursors) if cursor is not None
+                        for position in cursor.positions(doc))
+        accumulated = [0.0] * len(terms)
+        for current, (position, term) in enumerate(events):
+            for previous in range(current - 1, -1, -1):
+                other_position, other = events[previous]
+                distance = position - other_position
+                if distance > max_distance:
+                    break
+                if other != term and distance:
+                    weight = 1.0 / (distance * distance)
+                    accumulated[term] += weight
+                    accumulated[other] += weight
+        boosts[i] = sum(idf * acc * k_plus / (acc + norms[doc])
+                        for idf, acc in zip(idfs, accumulated) if acc)
+    reranked = sorted(((doc_id, score + boost) for (doc_id, score), boost in zip(ranking, boosts)),
+                      key=lambda x: x[1], reverse=True)
+    return reranked if top_k is None else reranked[:top_k]
+
+
+def file_size(path):
+    return os.path.getsize(path)
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Size and phrase query latency of positional postings')
+    parser.add_argument('folder', nargs='?', default="documents", help='Document folder to index')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Runs of the phrase queries')
+    parser.add_argument('--window', type=int, default=4, help='Words of the proximity window queries')
+    parser.add_argument('--qrels', default=os.path.join(script_dir, "files", "qrels.txt"),
+                        help='Judgments for comparing BM25 with proximity-boosted BM25, needs NumPy')
+    args = parser.parse_args()
+
+    stopwords = read_stopwords(os.path.join(script_dir, "files", "stopwords.txt"))
+    p = porter.CachedPorterStemmer()
+    documents = read_folder(os.path.join(script_dir, args.folder))
+    processed_doc = dict(analyze_bulk(documents.items(), stopwords, p))
+    dfs = {}
+    for words in processed_doc.values():
+        for term in set(words):
+            dfs[term] = dfs.get(term, 0) + 1
+    index = {term: {"idf": math.log((len(processed_doc) - df + 0.5) / (df + 0.5))} for term, df in dfs.items()}
+    avg_doclen = sum(len(words) for words in processed_doc.values()) / len(processed_doc)
+    postings = build_postings_index(processed_doc, index, avg_doclen)
+
+    with tempfile.TemporaryDirectory() as directory:
+        index_path = os.path.join(directory, "index.bin")
+        positions_path = os.path.join(directory, "positions.bin")
+        write_binary_index(postings, index_path)
+        start_time = time.perf_counter()
+        write_positional_index(positions_path, processed_doc)
+        write_time = time.perf_counter() - start_time
+        positional = open_positional_index(positions_path)
+        index_bytes = file_size(index_path)
+        positions_bytes = file_size(positions_path)
+        print(f"{args.folder}: {len(processed_doc)} documents, {positional.num_positions} positions")
+        print(f"index {index_bytes} bytes, positions {positions_bytes} bytes written in {1000 * write_time:.0f} ms, "
+              f"+{positions_bytes / index_bytes:.0%} over the index, "
+              f"{8 * positions_bytes / positional.num_positions:.1f} bits per position")
+
+        # Every pair of neighbouring analysed words of a query is a phrase and a proximity window
+        query_ids = []
+        queries = []
+        with open(os.path.join(script_dir, "files", "queries.txt"), "r") as queries_file:
+            for query in queries_file:
+                query_terms = query.strip().split(" ")
+                query_ids.append(query_terms[0])
+                queries.append(analyze(" ".join(query_terms[1:]).strip(), stopwords, p))
+        phrases = [("phrase", list(pair)) for query in queries for pair in zip(query, query[1:]) if pair[0] != pair[1]]
+        windows = [("near", phrase[1], args.window) for phrase in phrases]
+
+        def timed(run, trees):
+            start_time = time.perf_counter()
+            for _ in range(args.repeat):
+                matches = [run(tree) for tree in trees]
+            return 1000 * (time.perf_counter() - start_time) / (args.repeat * len(trees)), matches
+
+        def conjunctive(tree):
+            planner = QueryPlanner(postings)
+            return list(planner.evaluate(planner.plan(("and", [("term", term) for term in tree[1]]))))
+
+        def positional_match(tree):
+            planner = QueryPlanner(postings, positional)
+            return planner.evaluate(planner.plan(tree))
+
+        for name, trees in (("phrase", phrases), (f"window of {args.window}", windows)):
+            and_ms, and_matches = timed(conjunctive, trees)
+            positions_ms, matches = timed(positional_match, trees)
+            start_time = time.perf_counter()
+            rescanned = [rescan_phrases(tree, postings, documents, stopwords, p) for tree in trees]
+            rescan_ms = 1000 * (time.perf_counter() - start_time) / len(trees)
+            print(f"{len(trees)} {name} queries: AND {and_ms:.3f} ms ({sum(map(len, and_matches))} documents), "
+                  f"positions {positions_ms:.3f} ms ({sum(map(len, matches))} documents), "
+                  f"re-scanning the text {rescan_ms:.3f} ms, same matches: {matches == rescanned}")
+
+        start_time = time.perf_counter()
+        rankings = [bm25_topk(query, postings, 1, 0.75, PROXIMITY_DEPTH, "maxscore")[0] for query in queries]
+        bm25_ms = 1000 * (time.perf_counter() - start_time) / len(queries)
+        start_time = time.perf_counter()
+        boosted = [bm25_proximity(query, postings, positional, 1, 0.75) for query in queries]
+        proximity_ms = 1000 * (time.perf_counter() - start_time) / len(queries)
+        print(f"top {PROXIMITY_DEPTH} of {len(queries)} queries: BM25 {bm25_ms:.3f} ms, "
+              f"proximity-boosted BM25 {proximity_ms:.3f} ms")
+        if np is not None and os.path.exists(args.qrels):
+            qrels = Qrels(args.qrels)
+            for name, runs in (("BM25", rankings), ("proximity-boosted BM25", boosted)):
+                mean = run_report(rankings_run(query_ids, runs, qrels), qrels)["mean"]
+                print(f"{name}: " + ", ".join(f"{metric} {value:.4f}" for metric, value in mean.items()))
+        positional.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import argparse
+import os
+import resource
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import files.porter as porter
+from analyzer import analyze, read_stopwords
+from binary_index import open_binary_index
+from bm25_index import bm25_taat
+
+# Size charged for a cached lookup of a term that is not indexed
+MISSING_ENTRY_BYTES = 64
+
+
+# Resident set size of this process in bytes, from /proc on Linux, otherwise the peak reported by getrusage
+def resident_bytes():
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# Index wrapper that keeps the postings of recently used terms, bounded by max_bytes of decoded postings
+# At startup only the sorted term dictionary of the wrapped BinaryIndex is mapped, a term's postings are read
+# from the file the first time it is queried and stay cached while the term is hot
+# Raw postings are views of the mapped file that cost nothing to read again, so only postings a codec has to
+# decode are cached and raw lookups go straight to the index
+class CachedPostingsIndex:
+
+    def __init__(self, postings_index, max_bytes=16 * 2 ** 20):
+        self.index = postings_index
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # term -> ((idf, docs, tfs) or None, size in bytes)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.doc_ids = postings_index.doc_ids
+        self.avg_doclen = postings_index.avg_doclen
+        self.generation = postings_index.generation
+        self.decodes = getattr(postings_index, "codec", "raw") != "raw"
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, term):
+        return self.postings(term) is not None
+
+    def postings(self, term):
+        if not self.decodes:
+            return self.index.postings(term)
+        entry = self.entries.get(term)
+        if entry is not None:
+            self.entries.move_to_end(term)
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        postings = self.index.postings(term)
+        # Document ids and term frequencies are 4 bytes each
+        size = MISSING_ENTRY_BYTES if postings is None else 8 * len(postings[1]) + MISSING_ENTRY_BYTES
+        if size <= self.max_bytes:
+            self.entries[term] = (postings, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                evicted, (evicted_postings, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+        return postings
+
+    # Full scans read the index directly, they would only flush the cache
+    def iter_postings(self):
+        return self.index.iter_postings()
+
+    def norms(self, k, b):
+        return self.index.norms(k, b)
+
+    def upper_bounds(self, k, b):
+        return self.index.upper_bounds(k, b)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": len(self.entries),
+                "bytes": self.bytes, "hit_rate": self.hits / lookups if lookups else 0.0, "caching": self.decodes}
+
+    def close(self):
+        self.entries.clear()
+        self.bytes = 0
+        self.index.close()
+
+
+# Open an index file with a postings cache of cache_bytes, no cache when cache_bytes is 0
+def open_cached_index(file_path, cache_bytes):
+    index = open_binary_index(file_path)
+    if cache_bytes > 0:
+        return CachedPostingsIndex(index, cache_bytes)
+    return index
+
+
+# Startup, first query and steady state of one cache size, run in a fresh process so memory is not shared
+def measure(index_path, cache_bytes, queries, repeat):
+    resident_start = resident_bytes()
+    start_time = time.perf_counter()
+    index = open_cached_index(index_path, cache_bytes)
+    open_seconds = time.perf_counter() - start_time
+    resident_open = resident_bytes()
+
+    start_time = time.perf_counter()
+    bm25_taat(queries[0], index, 1, 0.75)
+    first_query_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        for query in queries:
+            bm25_taat(query, index, 1, 0.75)
+    seconds = time.perf_counter() - start_time
+    result = {"cache_bytes": cache_bytes, "open_ms": 1000 * open_seconds,
+              "first_query_ms": 1000 * first_query_seconds, "qps": repeat * len(queries) / seconds,
+              "open_resident_bytes": resident_open - resident_start, "resident_bytes": resident_bytes(),
+              "cache": index.stats() if cache_bytes > 0 else None}
+    return result
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Cold start, hit rate and memory of postings cache sizes')
+    parser.add_argument('-i', '--index', default="index.bin", help='Binary index file')
+    parser.add_argument('-c', '--cache-mb', type=float, nargs='+', default=[0, 0.25, 1, 16],
+                        help='Postings cache sizes in megabytes, 0 reads every lookup from the file')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Runs of the query file')
+    args = parser.parse_args()
+
+    stopwords = read_stopwords(os.path.join(script_dir, "files", "stopwords.txt"))
+    p = porter.CachedPorterStemmer()
+    with open(os.path.join(script_dir, "files", "queries.txt"), "r") as queries_file:
+        queries = [analyze(" ".join(query.strip().split(" ")[1:]).strip(), stopwords, p) for query in queries_file]
+
+    for cache_mb in args.cache_mb:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            row = executor.submit(measure, args.index, int(cache_mb * 2 ** 20), queries, args.repeat).result()
+        cache = row["cache"]
+        hit_rate = f"{cache['hit_rate']:.1%} hits, {cache['bytes']} bytes cached" if cache else "no cache"
+        if cache and not cache["caching"]:
+            hit_rate = "raw postings read from the mapped file, not cached"
+        print(f"{cache_mb} MB: open {row['open_ms']:.2f} ms (+{row['open_resident_bytes'] // 1024} KB resident), "
+              f"first query {row['first_query_ms']:.2f} ms, {row['qps']:.0f} queries/s, {hit_rate}, "
+              f"{row['resident_bytes'] // 1024} KB resident")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# A postings list is stored as one stream of 2 * df values: doc id gaps, then tf - 1 of each posting
+CODECS = ("varint", "bitpack")
+BLOCK_SIZE = 128
+
+
+def to_stream(docs, tfs):
+    stream = []
+    previous = 0
+    for doc in docs:
+        stream.append(doc - previous)
+        previous = doc
+    stream.extend(tf - 1 for tf in tfs)
+    return stream
+
+
+def from_stream(stream, count):
+    docs = []
+    doc = 0
+    for gap in stream[:count]:
+        doc += gap
+        docs.append(doc)
+    return docs, [value + 1 for value in stream[count:]]
+
+
+# Variable-byte: 7 bits per byte, the high bit is set on every byte except the last one of a value
+def varint_encode(values, out):
+    for value in values:
+        while value >= 0x80:
+            out.append((value & 0x7f) | 0x80)
+            value >>= 7
+        out.append(value)
+
+
+def varint_decode(data, count):
+    values = []
+    value = 0
+    shift = 0
+    for byte in data:
+        if byte & 0x80:
+            value |= (byte & 0x7f) << shift
+            shift += 7
+        else:
+            values.append(value | (byte << shift))
+            value = 0
+            shift = 0
+            if len(values) == count:
+                break
+    return values
+
+
+def varint_decode_numpy(data, count):
+    raw = np.frombuffer(data, dtype=np.uint8)
+    last = np.flatnonzero(raw < 0x80)[:count]
+    raw = raw[:last[-1] + 1] if count else raw[:0]
+    starts = np.empty(count, dtype=np.int64)
+    starts[:1] = 0
+    starts[1:] = last[:-1] + 1
+    # Shift of every byte is 7 times its position inside its value
+    position = np.arange(len(raw)) - np.repeat(starts, last - starts + 1)
+    parts = (raw & 0x7f).astype(np.uint64) << (7 * position).astype(np.uint64)
+    return np.add.reduceat(parts, starts) if count else np.zeros(0, dtype=np.uint64)
+
+
+# Block bit-packing: every block of BLOCK_SIZE values is stored with one byte of bit width and then the packed bits
+def bitpack_encode(values, out):
+    for start in range(0, len(values), BLOCK_SIZE):
+        block = values[start:start + BLOCK_SIZE]
+        width = max(block).bit_length()
+        packed = 0
+        for i, value in enumerate(block):
+            packed |= value << (i * width)
+        out.append(width)
+        out.extend(packed.to_bytes((len(block) * width + 7) // 8, 'little'))
+
+
+def bitpack_decode(data, count):
+    values = []
+    offset = 0
+    while len(values) < count:
+        size = min(BLOCK_SIZE, count - len(values))
+        width = data[offset]
+        length = (size * width + 7) // 8
+        packed = int.from_bytes(data[offset + 1:offset + 1 + length], 'little')
+        mask = (1 << width) - 1
+        values.extend((packed >> (i * width)) & mask for i in range(size))
+        offset += 1 + length
+    return values
+
+
+def bitpack_decode_numpy(data, count):
+    raw = np.frombuffer(data, dtype=np.uint8)
+    blocks = []
+    offset = 0
+    decoded = 0
+    while decoded < count:
+        size = min(BLOCK_SIZE, count - decoded)
+        width = int(raw[offset])
+        length = (size * width + 7) // 8
+        if width == 0:
+            blocks.append(np.zeros(size, dtype=np.uint64))
+        else:
+            bits = np.unpackbits(raw[offset + 1:offset + 1 + length], bitorder='little')[:size * width]
+            weights = np.left_shift(np.uint64(1), np.arange(width, dtype=np.uint64))
+            blocks.append(bits.reshape(size, width).astype(np.uint64) @ weights)
+        offset += 1 + length
+        decoded += size
+    return np.concatenate(blocks) if blocks else np.zeros(0, dtype=np.uint64)
+
+
+# Bit offset and width of every value in consecutive bit-packed streams of the given lengths
+def bitpack_layout(raw, counts):
+    offsets = []
+    sizes = []
+    widths = []
+    offset = 0
+    # Block headers have to be walked in order, the values themselves are located with array operations
+    for count in counts:
+        for block_start in range(0, count, BLOCK_SIZE):
+            size = min(BLOCK_SIZE, count - block_start)
+            width = int(raw[offset])
+            offsets.append(8 * (offset + 1))
+            sizes.append(size)
+            widths.append(width)
+            offset += 1 + (size * width + 7) // 8
+    sizes = np.array(sizes, dtype=np.int64)
+    widths = np.repeat(np.array(widths, dtype=np.int64), sizes)
+    position = np.arange(int(sizes.sum())) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    return np.repeat(np.array(offsets, dtype=np.int64), sizes) + position * widths, widths
+
+
+def bitpack_decode_batch_numpy(data, counts):
+    raw = np.frombuffer(data, dtype=np.uint8)
+    starts, widths = bitpack_layout(raw, counts)
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    bits = np.unpackbits(raw, bitorder='little')
+    bits = np.append(bits, np.zeros(64, dtype=np.uint8))
+    # Gather up to the widest value's bits for every value at once, bits past a value's width are masked out
+    shifts = np.arange(max(int(widths.max()), 1), dtype=np.int64)
+    gathered = bits[starts[:, None] + shifts[None, :]].astype(np.uint64)
+    gathered *= (shifts[None, :] < widths[:, None])
+    return (gathered << shifts.astype(np.uint64)).sum(axis=1, dtype=np.uint64)
+
+
+# Batch decode of many postings lists with one vectorised pass over their concatenated bytes
+def decode_batch_numpy(blocks, dfs, codec):
+    if len(dfs) == 0:
+        return []
+    data = b"".join(bytes(block) for block in blocks)
+    dfs = np.asarray(dfs, dtype=np.int64)
+    if codec == "varint":
+        stream = varint_decode_numpy(data, int(2 * dfs.sum()))
+    elif codec == "bitpack":
+        stream = bitpack_decode_batch_numpy(data, (2 * dfs).tolist())
+    else:
+        raise ValueError(f"Unknown postings codec: {codec}")
+    stream = stream.astype(np.int64)
+    # Each list is df gaps followed by df tf - 1 values, the gaps are summed per list
+    list_starts = np.repeat(np.cumsum(2 * dfs) - 2 * dfs, dfs)
+    position = np.arange(int(dfs.sum())) - np.repeat(np.cumsum(dfs) - dfs, dfs)
+    gaps = stream[list_starts + position]
+    tfs = stream[list_starts + position + np.repeat(dfs, dfs)] + 1
+    totals = np.cumsum(gaps)
+    list_ends = np.cumsum(dfs)
+    before = np.concatenate(([0], totals))[list_ends - dfs]
+    docs = totals - np.repeat(before, dfs)
+    return list(zip(np.split(docs, list_ends[:-1]), np.split(tfs, list_ends[:-1])))
+
+
+# Compress the postings of one term into a byte array
+def encode_postings(docs, tfs, codec):
+    out = array('B')
+    if codec == "varint":
+        varint_encode(to_stream(docs, tfs), out)
+    elif codec == "bitpack":
+        bitpack_encode(to_stream(docs, tfs), out)
+    else:
+        raise ValueError(f"Unknown postings codec: {codec}")
+    return out
+
+
+# Decode postings of df entries to lists of doc ids and term frequencies
+def decode_postings(data, df, codec):
+    if codec == "varint":
+        return from_stream(varint_decode(data, 2 * df), df)
+    elif codec == "bitpack":
+        return from_stream(bitpack_decode(data, 2 * df), df)
+    raise ValueError(f"Unknown postings codec: {codec}")
+
+
+# Batch decode into NumPy arrays of doc ids and term frequencies
+def decode_postings_numpy(data, df, codec):
+    if codec == "varint":
+        stream = varint_decode_numpy(data, 2 * df)
+    elif codec == "bitpack":
+        stream = bitpack_decode_numpy(data, 2 * df)
+    else:
+        raise ValueError(f"Unknown postings codec: {codec}")
+    stream = stream.astype(np.int64)
+    return np.cumsum(stream[:df]), stream[df:] + 1
+
+
+# Decode to lists, through NumPy when it is installed
+def decode_postings_fast(data, df, codec):
+    if np is None:
+        return decode_postings(data, df, codec)
+    docs, tfs = decode_postings_numpy(data, df, codec)
+    return docs.tolist(), tfs.tolist()
@@ -0,0 +1,98 @@
+from collections import OrderedDict
+from bm25_index import bm25_taat, bm25_topk
+
+# Rough memory cost of a cached ranking: a list slot, a (doc_id, score) tuple and a float per row,
+# the doc_id strings are shared with the index. A key costs about a tuple slot and a term per query term.
+ROW_BYTES = 88
+KEY_BYTES = 200
+TERM_BYTES = 120
+
+
+# LRU cache of rankings keyed on the analysed query, bounded by entries and by estimated bytes
+# The key is the analysed terms of the query in order with k, b and depth, under the generation of the index.
+# When a lookup sees another index generation, the index was rebuilt or updated and every entry is dropped.
+class QueryCache:
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (ranking, bytes)
+        self.bytes = 0
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Scores are summed in query term order, so the same terms in another order are another key:
+    # a hit always returns the scores a miss would compute
+    @staticmethod
+    def key(query, k, b, depth):
+        return tuple(query), k, b, depth
+
+    def check_generation(self, generation):
+        if generation != self.generation:
+            if self.entries:
+                self.invalidations += 1
+            self.clear()
+            self.generation = generation
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    # Return the cached ranking, or None
+    def get(self, query, k, b, depth, generation):
+        self.check_generation(generation)
+        key = self.key(query, k, b, depth)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, query, k, b, depth, generation, ranking):
+        self.check_generation(generation)
+        key = self.key(query, k, b, depth)
+        size = KEY_BYTES + TERM_BYTES * len(key[0]) + ROW_BYTES * len(ranking)
+        if size > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[1]
+        self.entries[key] = (ranking, size)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            self.bytes -= self.entries.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    def hit_rate(self):
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "invalidations": self.invalidations, "entries": len(self.entries), "bytes": self.bytes,
+                "hit_rate": self.hit_rate()}
+
+
+# Rank a query through the cache, top_k None is the full bm25_taat ranking, otherwise bm25_topk with pruning
+# Returns the ranking and the documents scored and skipped, both 0 on a hit
+# Cached rankings are shared, callers must not modify them
+def cached_search(cache, query, postings_index, k, b, top_k=None, pruning="maxscore"):
+    generation = postings_index.generation
+    ranking = cache.get(query, k, b, top_k, generation)
+    if ranking is not None:
+        return ranking, {"scored": 0, "skipped": 0}
+    if top_k is None:
+        ranking = bm25_taat(query, postings_index, k, b)
+        counters = {"scored": len(ranking), "skipped": 0}
+    else:
+        ranking, counters = bm25_topk(query, postings_index, k, b, top_k, pruning)
+    cache.put(query, k, b, top_k, generation, ranking)
+    return ranking, counters
@@ -1,35 +1,103 @@
+import argparse
 import math
 import os
-import re
 import time
 import json
 import files.porter as porter
+from analyzer import analyze, analyze_bulk, clean_text, read_stopwords, stem_words
 from collections import defaultdict
-
-
-def interactive():
+from concurrent.futures import ProcessPoolExecutor
+from binary_index import write_binary_index
+from boolean_query import analyze_tree, bm25_conjunctive, boolean_search, is_boolean, parse_query
+from bm25_matrix import BM25Matrix, bm25_batch
+from bm25_index import PRUNING_METHODS, build_postings_from_tf, bm25_taat, bm25_topk
+from instrumentation import count, instrumentation, stage
+from parallel_search import parallel_search
+from positional_index import bm25_proximity, open_positional_index, write_positional_index
+from postings_cache import CachedPostingsIndex, open_cached_index
+from query_cache import QueryCache, cached_search
+from term_dictionary import WILDCARDS, build_dictionary, enable_completion, expand_query
+
+
+# positions为True时，短语和邻近窗口按词的位置精确匹配；proximity为True时，查询词距离越近分数越高
+def interactive(pruning="maxscore", workers=1, postings_cache_mb=0, positions=False, proximity=False):
     # 读取文档以及stopword
     script_dir = os.path.dirname(os.path.abspath(__file__))
     stopwords_path = os.path.join(script_dir, "files", "stopwords.txt")
     documents_folder = "documents2"
 
     stopwords = read_stopword_file(stopwords_path)
-    p = porter.PorterStemmer()
-
-    index, documents, avg_doclen = create_index(documents_folder)
+    p = porter.CachedPorterStemmer()
+
+    with stage("index"):
+        index, postings, avg_doclen = create_index(documents_folder, p, workers, postings_cache_mb)
+    positional = None
+    if positions or proximity:
+        positional = load_positional_index(postings, documents_folder, stopwords, p)
+    proximity = proximity and positional is not None
+    # 有序词典，用于通配符查询以及按df排序的Tab补全
+    dictionary = build_dictionary(postings)
+    enable_completion(dictionary)
+    # 重复的查询直接从缓存返回结果
+    cache = QueryCache()
     while True:
-        query = input("Enter a query (or 'QUIT' to exit): ")
+        query = input("Enter a query, aero* matches prefixes, AND, OR, NOT, brackets and quotes make it Boolean "
+                      "(or 'QUIT' to exit, 'STATS' for the instrumentation report, 'SUGGEST <prefix>' for terms): ")
         if query == "QUIT":
+            print(f"查询缓存：{cache.stats()}")
             break
+        elif query == "STATS":
+            if instrumentation.enabled:
+                instrumentation.emit()
+            else:
+                print("未开启计时，请使用--instrument启动")
+        elif query.startswith("SUGGEST "):
+            # 以该前缀开头、df最高的词项
+            for term, df, offset in dictionary.complete(query[len("SUGGEST "):].strip().lower()):
+                print(f"{term} {df}")
+        elif is_boolean(query):
+            # 只对满足布尔查询的文档计算bm25分数
+            try:
+                with stage("search"):
+                    results, counters = boolean_search(query, postings, stopwords, p, 1, 0.75, 15, positional)
+            except ValueError as error:
+                print(error)
+                continue
+            count("queries")
+            print(f"匹配的文档数：{counters['candidates']}")
+            rank = 1
+            for result in results:
+                print(str(rank) + " " + result[0] + " " + str(result[1]))
+                rank += 1
         else:
-            results = bm25_model(query, documents, index, 1, 0.75, avg_doclen)
+            # 查询与文档使用相同的处理流程
+            # 含有*或?的词替换为匹配的索引词项
+            with stage("query_analysis"):
+                if WILDCARDS.search(query):
+                    query_text = expand_query(query, stopwords, p, dictionary)
+                else:
+                    query_text = clear_txt(query, stopwords, p)
+            with stage("search"):
+                if proximity:
+                    results = bm25_proximity(query_text, postings, positional, 1, 0.75, 15)
+                else:
+                    results, counters = bm25_top_k(query_text, postings, 1, 0.75, 15, pruning, cache)
+            count("queries")
             rank = 1
             for result in results:
                 print(str(rank) + " " + result[0] + " " + str(result[1]))
                 rank += 1
 
 
-def automatic():
+# top_k不为None时，每个查询只用动态剪枝取前top_k个文档
+# batch为True时，所有查询用一次稀疏矩阵乘法计算分数
+# query_workers大于1时，查询分批在多个进程中计算，各进程通过mmap共享索引文件
+# postings_cache_mb大于0时，已保存索引中常用词项的倒排表保存在LRU缓存中
+# boolean为True时，每个查询按布尔查询解析，只对匹配的文档排序
+# positions为True时，布尔查询中的短语和邻近窗口按词的位置精确匹配
+# proximity为True时，每个排名的前几个文档按查询词之间的距离重新排序
+def automatic(top_k=None, pruning="maxscore", workers=1, batch=False, query_workers=1, postings_cache_mb=0,
+              boolean=False, positions=False, proximity=False):
     # 读取文档以及stopword
     load_start_time = time.time()
     documents_folder = "documents"
@@ -38,120 +106,263 @@ def automatic():
 
     print("load stopwords")
     stopwords = read_stopword_file(stopwords_path)
-    p = porter.PorterStemmer()
+    p = porter.CachedPorterStemmer()
     print("load stopwords end")
 
-    index, documents, avg_doclen, tf_dict, len_dict = create_index(documents_folder)
+    with stage("index"):
+        index, postings, avg_doclen = create_index(documents_folder, p, workers, postings_cache_mb)
+    positional = None
+    if positions or proximity:
+        positional = load_positional_index(postings, documents_folder, stopwords, p)
+    proximity = proximity and positional is not None
     load_end_time = time.time()
     load_time = load_end_time - load_start_time
     print(f"程序加载时间：{load_time}秒")
 
     print("Loading end")
     start_time = time.time()
+    cache = QueryCache()
+    scored = 0
+    skipped = 0
+    matching = 0
+    # 布尔查询和邻近度排序逐个计算
+    if boolean or proximity:
+        batch = False
+        query_workers = 1
     # 打开 "queries.txt" 文件以读取查询
     with open("files/queries.txt", "r") as queries_file:
         queries = queries_file.readlines()
 
+    # 处理每个查询
+    query_ids = []
+    query_texts = []
+    with stage("query_analysis"):
+        for query in queries:
+            query_terms = query.strip().split(" ")
+            query_ids.append(query_terms[0])
+            if boolean:
+                query_texts.append(analyze_tree(parse_query(" ".join(query_terms[1:])), stopwords, p))
+            else:
+                query_texts.append(clear_txt(" ".join(query_terms[1:]).strip(), stopwords, p))
+    count("queries", len(query_ids))
+    if batch:
+        with stage("search"):
+            rankings = bm25_batch(query_texts, BM25Matrix(postings, 1, 0.75), top_k)
+    elif query_workers > 1:
+        # 子进程中的各阶段不计时，只记录整个并行查询的时间
+        with stage("search"):
+            rankings, counters = parallel_search(query_texts, ("binary", "index_large.bin"), query_workers,
+                                                 1, 0.75, top_k, pruning)
+        scored += counters["scored"]
+        skipped += counters["skipped"]
+
     # 打开 "results.txt" 文件以写入结果
     with open("files/results.txt", "w") as results_file:
         # 遍历每个查询
-        for query in queries:
-            query_terms = query.strip().split(" ")
-            query_id = query_terms[0]
-            query_text = clear_txt(" ".join(query_terms[1:]).strip(), stopwords, p)
+        for i, query_id in enumerate(query_ids):
+            query_text = query_texts[i]
 
             # 计算查询与文档的相似度分数，得到排名列表
-            ranking = bm25_model(query_text, index, 1, 0.75, avg_doclen, tf_dict, len_dict)
+            if boolean:
+                with stage("search"):
+                    ranking, counters = ([], {"candidates": 0}) if query_text is None else \
+                        bm25_conjunctive(query_text, postings, 1, 0.75, top_k, positional)
+                matching += counters["candidates"]
+            elif proximity:
+                with stage("search"):
+                    ranking = bm25_proximity(query_text, postings, positional, 1, 0.75, top_k)
+            elif batch or query_workers > 1:
+                ranking = rankings[i]
+            elif top_k is None:
+                with stage("search"):
+                    ranking = bm25_model(query_text, postings, 1, 0.75, cache)
+            else:
+                with stage("search"):
+                    ranking, counters = bm25_top_k(query_text, postings, 1, 0.75, top_k, pruning, cache)
+                scored += counters["scored"]
+                skipped += counters["skipped"]
             rank_number = 1
 
             # 遍历排名列表，写入结果到 "results.txt" 文件
-            for rank in ranking:
-                if rank[1] > 0:
-                    results_file.write(f"{query_id}\t{rank_number}\t{rank[0]}\t{str(rank[1])}\n")
-                    rank_number += 1
+            with stage("write"):
+                for rank in ranking:
+                    if rank[1] > 0:
+                        results_file.write(f"{query_id}\t{rank_number}\t{rank[0]}\t{str(rank[1])}\n")
+                        rank_number += 1
     end_time = time.time()
     runtime = end_time - start_time
     print(f"程序运行时间：{runtime}秒")
+    if boolean:
+        print(f"满足布尔查询的文档数：{matching}")
+    elif top_k is not None and not batch and not proximity:
+        print(f"计算分数的文档数：{scored}，{pruning}跳过的文档数：{skipped}")
+    print(f"stemmer缓存命中率：{p.hit_rate()}")
+    if not boolean and not proximity and not batch and query_workers <= 1:
+        print(f"查询缓存：{cache.stats()}")
+    if isinstance(postings, CachedPostingsIndex):
+        print(f"倒排表缓存：{postings.stats()}")
+    if instrumentation.enabled:
+        count("scored", scored)
+        count("skipped", skipped)
+        instrumentation.emit()
     return
 
 
-def create_index(documents_folder):
-    # 读取索引
+# workers大于1时用多个进程建立新索引，p是带缓存的stemmer
+# postings_cache_mb大于0时，打开已保存的索引并使用该大小（MB）的倒排表缓存
+def create_index(documents_folder, p, workers=1, postings_cache_mb=0):
+    # 二进制索引用mmap映射，包含词项、倒排表和文档长度
+    binary_index_path = "index_large.bin"
+    # 词表的词干，查询时的stemming基本只是查表
+    stems_path = "index_large_stems.json"
     index_file_path = "index.json"
+    # 二进制索引不比index.json旧时才使用，删除index.json会重建两者
+    if os.path.exists(binary_index_path) and os.path.exists(index_file_path) and \
+            os.path.getmtime(binary_index_path) >= os.path.getmtime(index_file_path):
+        print("have binary index")
+        with stage("load"):
+            postings = open_cached_index(binary_index_path, int(postings_cache_mb * 2 ** 20))
+            if os.path.exists(stems_path):
+                p.load(stems_path)
+        return postings, postings, postings.avg_doclen
+
+    # 读取索引
     if os.path.exists(index_file_path):
         processed_doc = {}
         print("have index")
         # 如果索引文件存在，加载索引
-        index, avg_doclen, tf_dict, len_dict = load_index(index_file_path)
+        with stage("load"):
+            index, avg_doclen, tf_dict, len_dict = load_index(index_file_path)
     else:
         script_dir = os.path.dirname(os.path.abspath(__file__))
         stopwords_path = os.path.join(script_dir, "files", "stopwords.txt")
 
-        documents = read_documents_info(documents_folder)
+        with stage("read"):
+            documents = read_documents_info(documents_folder)
         stopwords = read_stopword_file(stopwords_path)
-        p = porter.PorterStemmer()
         # 如果索引文件不存在，创建索引并保存到文件
-        index = {}
-        processed_doc = {}
-        tf_dict = {}
-        len_dict = {}
-        for doc_id, document in documents.items():
-            # 清除标点符号
-            document = clear_pun(document)
-            words = document.split()
-            clean_words = set()
-            all_words = []
-            term_fre = defaultdict(int)
-            for word in words:
-                if word not in stopwords:
-                    # stemming
-                    stem_word = p.stem(word)
-                    all_words.append(stem_word)
-                    term_fre[word] += 1
-                    # 创建索引
-                    if stem_word not in clean_words:
-                        clean_words.add(stem_word)
-                        if stem_word in index:
-                            index[stem_word]["doc_id"].add(doc_id)
-                        else:
-                            index[stem_word] = {}
-                            index[stem_word]["doc_id"] = set()
-                            index[stem_word]["doc_id"].add(doc_id)
-                tf_dict[doc_id] = term_fre
-            len_dict[doc_id] = len(all_words)
-            processed_doc[doc_id] = all_words
+        if workers > 1:
+            index, processed_doc, tf_dict, len_dict = index_documents_parallel(documents, stopwords, workers, p)
+        else:
+            index, processed_doc, tf_dict, len_dict = index_documents(documents, stopwords, p)
         # 存储文档平均长度
         avg_doclen = calculate_avg_doc_len(processed_doc)
 
         # 计算文档idf
         document_numbers = len(processed_doc)
 
-        for term in index:
-            df = len(index[term]["doc_id"])
-            idf = math.log((document_numbers - df + 0.5) / (df + 0.5))
-            index[term]["idf"] = idf
-
-        save_index(index, "index.json", avg_doclen, tf_dict, len_dict)
-    return index, processed_doc, avg_doclen, tf_dict, len_dict
+        with stage("idf"):
+            for term in index:
+                df = len(index[term]["doc_id"])
+                idf = math.log((document_numbers - df + 0.5) / (df + 0.5))
+                index[term]["idf"] = idf
+
+        with stage("save"):
+            save_index(index, "index.json", avg_doclen, tf_dict, len_dict)
+
+    # 由tf_dict和len_dict生成倒排表，文档编号为连续整数
+    with stage("postings_index"):
+        postings = build_postings_from_tf(tf_dict, len_dict, index, avg_doclen)
+    # 保存二进制索引，之后运行时不再解析index.json
+    with stage("save"):
+        write_binary_index(postings, binary_index_path)
+        p.save(stems_path)
+    return index, postings, avg_doclen
+
+
+# 索引中每个文档处理后各词的位置，index_large.bin更新后重新生成
+def load_positional_index(postings, documents_folder, stopwords, p, positions_path="index_large_positions.bin"):
+    if not os.path.exists(positions_path) or os.path.getmtime(positions_path) < os.path.getmtime("index_large.bin"):
+        with stage("positions"):
+            with stage("read"):
+                documents = read_documents_info(documents_folder)
+            processed_doc = dict(analyze_bulk(((doc_id, documents[doc_id]) for doc_id in postings.doc_ids),
+                                              stopwords, p))
+            write_positional_index(positions_path, processed_doc)
+    return open_positional_index(positions_path)
+
+
+# 建立不含idf的倒排索引，以及每个文档处理后的词、词频和长度
+def index_documents(documents, stopwords, p):
+    index = {}
+    processed_doc = {}
+    tf_dict = {}
+    len_dict = {}
+    for doc_id, document in documents.items():
+        # 清除标点符号
+        with stage("clean"):
+            words = clear_pun(document).split()
+        with stage("stopwords"):
+            kept_words = [word for word in words if word not in stopwords]
+        # stemming
+        with stage("stem"):
+            all_words = stem_words(kept_words, p)
+        with stage("postings"):
+            clean_words = set()
+            term_fre = defaultdict(int)
+            for word in kept_words:
+                term_fre[word] += 1
+            # 创建索引
+            for stem_word in all_words:
+                if stem_word not in clean_words:
+                    clean_words.add(stem_word)
+                    if stem_word in index:
+                        index[stem_word]["doc_id"].add(doc_id)
+                    else:
+                        index[stem_word] = {}
+                        index[stem_word]["doc_id"] = set()
+                        index[stem_word]["doc_id"].add(doc_id)
+            # 只有清除标点后没有任何词的文档没有词频
+            if words:
+                tf_dict[doc_id] = term_fre
+            len_dict[doc_id] = len(all_words)
+            processed_doc[doc_id] = all_words
+        count("tokens", len(words))
+        count("documents")
+    return index, processed_doc, tf_dict, len_dict
+
+
+# 在子进程中为一块文档建立索引，同时返回子进程的词干表，父进程才能保存整个词表的词干
+def index_chunk(chunk, stopwords):
+    p = porter.CachedPorterStemmer()
+    return index_documents(dict(chunk), stopwords, p) + (p.cache,)
+
+
+# 把文档按顺序分块，由多个进程建立部分索引，再按顺序合并，子进程得到的词干加入p的缓存
+def index_documents_parallel(documents, stopwords, workers, p):
+    items = list(documents.items())
+    # 每个进程分几块，文档长度不均时各核心也能保持忙碌
+    chunk_size = max(1, math.ceil(len(items) / (workers * 4)))
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+    index = {}
+    processed_doc = {}
+    tf_dict = {}
+    len_dict = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for partial in executor.map(index_chunk, chunks, [stopwords] * len(chunks)):
+            partial_index, partial_doc, partial_tf, partial_len, stems = partial
+            # 各块按文档顺序返回，合并后词项和文档的顺序与单进程相同
+            for term, value in partial_index.items():
+                if term in index:
+                    index[term]["doc_id"].update(value["doc_id"])
+                else:
+                    index[term] = value
+            processed_doc.update(partial_doc)
+            tf_dict.update(partial_tf)
+            len_dict.update(partial_len)
+            p.cache.update(stems)
+    return index, processed_doc, tf_dict, len_dict
 
 
 # 清除标点符号以及数字
 def clear_pun(document_content):
-    clean_document = re.sub(r"[^\w\s]|[\d]", '', document_content)
-    return clean_document
+    return clean_text(document_content)
 
 
+# 清除标点符号、数字和stopword，再做stemming
 def clear_txt(txt, stopwords, p):
-    clean_txt = re.sub(r"[^\w\s]|[\d]", '', txt)
-    words = clean_txt.split()
-    clean_words = []
-
-    for word in words:
-        if word not in stopwords:
-            # stemming
-            word = p.stem(word)
-            clean_words.append(word)
-    return clean_words
+    return analyze(txt, stopwords, p)
 
 
 def save_index(index, file_path, avg_doclen, tf_dict, len_dict):
@@ -202,31 +413,23 @@ def read_documents_info(documents_folder):
     return document_collection
 
 
-# 读取stopword文件
+# 读取stopword文件，返回frozenset以便常数时间查找
 def read_stopword_file(stopwords_file_path):
-    with open(stopwords_file_path, 'r', encoding='utf-8') as file:
-        stopwords = file.read().splitlines()
-    return stopwords
-
-
-# BM25 model
-def bm25_model(query, index, k, b, avg_doclen, tf_dict, len_dict):
-    scores = {}
-    for term in query:
-        if term in index:
-            idf = float(index[term]["idf"])
-            for doc_id, doc_len in len_dict.items():
-                if term in tf_dict[doc_id]:
-                    tf = tf_dict[doc_id][term]
-                else:
-                    tf = 0
-                score = idf * (tf * (k + 1)) / (tf + k * (1 - b + b * (int(doc_len) / float(avg_doclen))))
-                if doc_id in scores.keys():
-                    scores[doc_id] += score
-                else:
-                    scores[doc_id] = score
-    sorted_documents = sorted(scores.items(), key=lambda x: x[1], reverse=True)
-    return sorted_documents
+    return read_stopwords(stopwords_file_path)
+
+
+# BM25 model，只遍历查询词倒排表中的文档
+def bm25_model(query, postings, k, b, cache=None):
+    if cache is not None:
+        return cached_search(cache, query, postings, k, b)[0]
+    return bm25_taat(query, postings, k, b)
+
+
+# BM25 top-k，使用MaxScore或WAND剪枝，返回排名以及计算/跳过的文档数
+def bm25_top_k(query, postings, k, b, top_k, pruning, cache=None):
+    if cache is not None:
+        return cached_search(cache, query, postings, k, b, top_k, pruning)
+    return bm25_topk(query, postings, k, b, top_k, pruning)
 
 
 def calculate_avg_doc_len(documents_clean):
@@ -238,5 +441,47 @@ def calculate_avg_doc_len(documents_clean):
     avg_doclen = total_word_numbers / documents_numbers
     return avg_doclen
 
-# interactive()
-automatic()
+
+def main():
+    parser = argparse.ArgumentParser(description='Large Corpus Search Program')
+    parser.add_argument('-m', '--mode', choices=['automatic', 'interactive'], default='automatic',
+                        help='Specify the mode to run the program')
+    parser.add_argument('-k', '--top-k', type=int, default=None,
+                        help='Only retrieve the top k documents of each query in automatic mode')
+    parser.add_argument('--pruning', choices=PRUNING_METHODS, default='maxscore',
+                        help='Dynamic pruning method used for top k retrieval')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of processes used to build a new index')
+    parser.add_argument('--batch', action='store_true',
+                        help='Score all queries at once with sparse matrix products (needs NumPy)')
+    parser.add_argument('-q', '--query-workers', type=int, default=1,
+                        help='Number of processes that rank queries in automatic mode')
+    parser.add_argument('--boolean', action='store_true',
+                        help='Parse the queries as Boolean queries with AND, OR, NOT, brackets and quotes, '
+                             'words next to each other must all match')
+    parser.add_argument('--positions', action='store_true',
+                        help='Keep word positions so that Boolean phrases "a b" and windows "a b"~5 match exactly')
+    parser.add_argument('--proximity', action='store_true',
+                        help='Re-rank the top documents by how close the query terms are, implies --positions')
+    parser.add_argument('--postings-cache-mb', type=float, default=0,
+                        help='Keep the postings of hot terms of a stored binary index in an LRU cache of this size')
+    parser.add_argument('--instrument', action='store_true',
+                        help='Time the indexing and query stages and print a report')
+    parser.add_argument('--profile', action='store_true', help='Add a cProfile report to the instrumentation')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Add a tracemalloc report of the largest allocations to the instrumentation')
+    parser.add_argument('--report', default=None, help='Also write the instrumentation report as JSON to this file')
+    args = parser.parse_args()
+
+    if args.instrument or args.profile or args.trace_memory or args.report:
+        instrumentation.enable(args.profile, args.trace_memory, args.report)
+
+    if args.mode == 'automatic':
+        automatic(args.top_k, args.pruning, args.workers, args.batch, args.query_workers, args.postings_cache_mb,
+                  args.boolean, args.positions, args.proximity)
+    elif args.mode == 'interactive':
+        interactive(args.pruning, args.workers, args.postings_cache_mb, args.positions, args.proximity)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+import files.porter as porter
+import search_large_corpus
+import search_small_corpus
+from analyzer import analyze, read_stopwords
+from bm25_index import PRUNING_METHODS, bm25_topk
+from bm25_matrix import BM25Matrix, bm25_batch, np
+from document_store import LazyDocuments
+from query_cache import QueryCache
+
+MAX_K = 1000
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+# BM25 search over one loaded index. Requests arriving within batch_window seconds of each other are
+# scored together in one pass on the executor thread, so the event loop keeps accepting connections
+class SearchService:
+
+    def __init__(self, postings_index, stopwords, p, pruning="maxscore", max_batch=64, batch_window=0.002,
+                 cache=None):
+        self.postings = postings_index
+        self.stopwords = stopwords
+        self.p = p
+        self.pruning = pruning
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.cache = cache if cache is not None else QueryCache()
+        # With NumPy a batch is one sparse matrix product, otherwise each query is ranked with dynamic pruning
+        self.matrix = BM25Matrix(postings_index) if np is not None else None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.batcher = None
+        self.started = time.time()
+        self.counters = Counter()
+        self.latencies = deque(maxlen=10000)  # milliseconds of the latest search requests
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.batcher = asyncio.create_task(self.run_batches())
+
+    async def stop(self):
+        self.batcher.cancel()
+        self.executor.shutdown(wait=False)
+
+    # Rank the analysed queries with their largest top_k, runs on the executor
+    def score_batch(self, queries, top_k):
+        if self.matrix is not None:
+            return bm25_batch(queries, self.matrix, top_k)
+        return [bm25_topk(query, self.postings, 1, 0.75, top_k, self.pruning)[0] for query in queries]
+
+    async def run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            if self.batch_window > 0:
+                await asyncio.sleep(self.batch_window)
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            top_k = max(top_k for query, top_k, future in batch)
+            try:
+                rankings = await loop.run_in_executor(self.executor, self.score_batch,
+                                                      [query for query, top_k, future in batch], top_k)
+            except Exception as error:
+                for query, top_k, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            self.counters["batches"] += 1
+            self.counters["batched_queries"] += len(batch)
+            for (query, top_k, future), ranking in zip(batch, rankings):
+                # A client that went away leaves a cancelled future behind
+                if not future.done():
+                    future.set_result(ranking[:top_k])
+
+    # Returns the analysed query, its ranking and whether it came from the cache
+    async def search(self, text, top_k):
+        query = analyze(text.lower(), self.stopwords, self.p)
+        generation = self.postings.generation
+        ranking = self.cache.get(query, 1, 0.75, top_k, generation)
+        if ranking is not None:
+            return query, ranking, True
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((query, top_k, future))
+        ranking = await future
+        self.cache.put(query, 1, 0.75, top_k, generation, ranking)
+        return query, ranking, False
+
+    async def route(self, method, target):
+        url = urlsplit(target)
+        if method != "GET":
+            return 405, {"error": f"{method} is not supported"}
+        if url.path == "/search":
+            return await self.handle_search(parse_qs(url.query))
+        elif url.path == "/health":
+            return 200, {"status": "ok", "documents": len(self.postings), "generation": self.postings.generation,
+                         "uptime_seconds": time.time() - self.started}
+        elif url.path == "/metrics":
+            return 200, self.metrics()
+        return 404, {"error": f"No route for {url.path}"}
+
+    async def handle_search(self, params):
+        start_time = time.perf_counter()
+        text = params.get("q", [""])[0]
+        if not text.strip():
+            return 400, {"error": "Missing query parameter q"}
+        try:
+            top_k = int(params.get("k", ["10"])[0])
+        except ValueError:
+            return 400, {"error": "k must be an integer"}
+        if not 1 <= top_k <= MAX_K:
+            return 400, {"error": f"k must be between 1 and {MAX_K}"}
+        query, ranking, cached = await self.search(text, top_k)
+        took = 1000 * (time.perf_counter() - start_time)
+        self.counters["searches"] += 1
+        self.latencies.append(took)
+        return 200, {"query": text, "terms": query, "k": top_k, "cached": cached, "took_ms": took,
+                     "results": [{"rank": rank, "doc_id": doc_id, "score": score}
+                                 for rank, (doc_id, score) in enumerate(ranking, 1)]}
+
+    def metrics(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(q):
+            return latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else 0.0
+
+        batches = self.counters["batches"]
+        return {"requests": self.counters["requests"], "errors": self.counters["errors"],
+                "searches": self.counters["searches"], "batches": batches,
+                "mean_batch_size": self.counters["batched_queries"] / batches if batches else 0.0,
+                "latency_ms": {"p50": percentile(0.5), "p95": percentile(0.95), "p99": percentile(0.99)},
+                "cache": self.cache.stats(), "stemmer": self.p.cache_info(),
+                "uptime_seconds": time.time() - self.started}
+
+    # HTTP/1.1 with keep-alive, one request at a time per connection
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                lines = head.decode('latin-1').split("\r\n")
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                try:
+                    length = int(headers.get("content-length", "0") or 0)
+                except ValueError:
+                    length = -1
+                if length > 0:
+                    try:
+                        await reader.readexactly(length)
+                    except (asyncio.IncompleteReadError, ConnectionError):
+                        break
+
+                self.counters["requests"] += 1
+                request_line = lines[0].split(" ")
+                if length < 0:
+                    # Without a usable length the end of the body is unknown, so the connection is closed after
+                    # the answer
+                    status, body = 400, {"error": "Bad Content-Length"}
+                    version = "HTTP/1.0"
+                elif len(request_line) != 3:
+                    status, body = 400, {"error": "Malformed request line"}
+                    version = "HTTP/1.0"
+                else:
+                    method, target, version = request_line
+                    try:
+                        status, body = await self.route(method, target)
+                    except Exception as error:
+                        status, body = 500, {"error": str(error)}
+                if status >= 400:
+                    self.counters["errors"] += 1
+
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                payload = json.dumps(body).encode('utf-8')
+                writer.write((f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                              f"Content-Type: application/json\r\n"
+                              f"Content-Length: {len(payload)}\r\n"
+                              f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode('latin-1'))
+                writer.write(payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+async def serve(service, host, port):
+    await service.start()
+    server = await asyncio.start_server(service.handle_connection, host, port)
+    print(f"Serving on http://{host}:{server.sockets[0].getsockname()[1]}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.stop()
+
+
+# Load or build the index of a corpus once, as the search scripts do
+def load_index(corpus, p, workers=1):
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    stopwords = read_stopwords(os.path.join(script_dir, "files", "stopwords.txt"))
+    if corpus == "large":
+        index, postings, avg_doclen = search_large_corpus.create_index("documents", p, workers)
+    else:
+        documents = LazyDocuments(search_small_corpus.read_documents_info, os.path.join(script_dir, "documents_2"))
+        index, postings, avg_doclen = search_small_corpus.create_index(documents, stopwords, p, workers)
+    return postings, stopwords
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP search service')
+    parser.add_argument('--corpus', choices=['small', 'large'], default='small', help='Corpus to serve')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on, 0 picks a free port')
+    parser.add_argument('--max-batch', type=int, default=64, help='Most queries scored in one pass')
+    parser.add_argument('--batch-window-ms', type=float, default=2.0,
+                        help='Time to wait for more queries before a batch is scored')
+    parser.add_argument('--pruning', choices=PRUNING_METHODS, default='maxscore',
+                        help='Dynamic pruning method used when NumPy is not installed')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of processes used to build a new index')
+    args = parser.parse_args()
+
+    p = porter.CachedPorterStemmer()
+    postings, stopwords = load_index(args.corpus, p, args.workers)
+    service = SearchService(postings, stopwords, p, args.pruning, args.max_batch, args.batch_window_ms / 1000)
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,156 +1,402 @@
 import argparse
 import math
 import os
-import re
 import time
+from concurrent.futures import ProcessPoolExecutor
 import files.porter as porter
-
-
-# Manual input search
-def interactive():
+from analyzer import analyze, analyze_bulk, clean_text, read_stopwords
+from binary_index import write_binary_index
+from boolean_query import analyze_tree, bm25_conjunctive, boolean_search, is_boolean, parse_query
+from document_store import LazyDocuments, open_document_store, write_document_store
+from bm25_matrix import BM25Matrix, bm25_batch
+from bm25_index import PRUNING_METHODS, build_postings_from_tf, build_postings_index, bm25_taat, bm25_topk
+from instrumentation import count, instrumentation, stage
+from parallel_search import parallel_search
+from positional_index import bm25_proximity, open_positional_index, write_positional_index
+from postings_cache import CachedPostingsIndex, open_cached_index
+from query_cache import QueryCache, cached_search
+from segment_index import SegmentIndex
+from term_dictionary import WILDCARDS, build_dictionary, enable_completion, expand_query
+
+
+# Manual input search, with snippets every result is followed by the start of its text from the document store
+# With positions phrases and proximity windows are matched exactly, with proximity close query terms score higher
+def interactive(pruning="maxscore", workers=1, incremental=False, snippets=False, postings_cache_mb=0,
+                positions=False, proximity=False):
     # Read documents and stopword
     script_dir = os.path.dirname(os.path.abspath(__file__))
     documents_path = os.path.join(script_dir, "documents_2")
     stopwords_path = os.path.join(script_dir, "files", "stopwords.txt")
 
-    documents = read_documents_info(documents_path)
     stopwords = read_stopword_file(stopwords_path)
-    p = porter.PorterStemmer()
+    p = porter.CachedPorterStemmer()
 
     # Create or read index
-    index, documents, avg_doclen = create_index(documents, stopwords, p)
-
+    if incremental:
+        postings = update_incremental_index(documents_path, stopwords, p)
+    else:
+        # The documents are only read when the index has to be built
+        documents = LazyDocuments(read_documents_info, documents_path)
+        with stage("index"):
+            index, postings, avg_doclen = create_index(documents, stopwords, p, workers, postings_cache_mb)
+
+    # The text of a document is only read from the store when its snippet is printed
+    store = None
+    if snippets and not incremental and os.path.exists("documents.store"):
+        store = open_document_store("documents.store")
+    # Positions share the dense doc ids of index.bin, the segmented index numbers documents differently
+    positional = None
+    if (positions or proximity) and not incremental:
+        positional = load_positional_index(postings, LazyDocuments(read_documents_info, documents_path), stopwords, p)
+    proximity = proximity and positional is not None
+    # Sorted term dictionary for wildcard queries and Tab completion of terms by df
+    dictionary = build_dictionary(postings)
+    enable_completion(dictionary)
+    # Repeated queries are answered from the cache
+    cache = QueryCache()
     # Read query and perform search
     while True:
-        query = input("Enter a query (or 'QUIT' to exit): ")
+        query = input("Enter a query, aero* matches prefixes, AND, OR, NOT, brackets and quotes make it Boolean "
+                      "(or 'QUIT' to exit, 'STATS' for the instrumentation report, 'SUGGEST <prefix>' for terms): ")
         if query == "QUIT":
+            print(f"Query cache: {cache.stats()}")
             break
+        elif query == "STATS":
+            if instrumentation.enabled:
+                instrumentation.emit()
+            else:
+                print("Instrumentation is off, start with --instrument")
+        elif query.startswith("SUGGEST "):
+            # Most frequent indexed terms starting with the prefix
+            for term, df, offset in dictionary.complete(query[len("SUGGEST "):].strip().lower()):
+                print(f"{term} {df}")
+        elif is_boolean(query):
+            # Only the documents matching the Boolean query are scored with bm25
+            try:
+                with stage("search"):
+                    results, counters = boolean_search(query, postings, stopwords, p, 1, 0.75, 15, positional)
+            except ValueError as error:
+                print(error)
+                continue
+            count("queries")
+            print(f"{counters['candidates']} matching documents")
+            rank = 1
+            for result in results:
+                print(str(rank) + " " + result[0] + " " + str(result[1]))
+                if store is not None:
+                    print("    " + store.snippet(result[0]))
+                rank += 1
         else:
-            # Search using the bm25 model
-            results = bm25_model(query, documents, index, 1, 0.75, avg_doclen)[:15]
+            # Search using the bm25 model, the query goes through the same analysis as the documents
+            # Words with * or ? are replaced by the indexed terms they match
+            with stage("query_analysis"):
+                if WILDCARDS.search(query):
+                    query_text = expand_query(query, stopwords, p, dictionary)
+                else:
+                    query_text = clear_txt(query, stopwords, p)
+            with stage("search"):
+                if proximity:
+                    results = bm25_proximity(query_text, postings, positional, 1, 0.75, 15)
+                else:
+                    results, counters = bm25_top_k(query_text, postings, 1, 0.75, 15, pruning, cache)
+            count("queries")
             rank = 1
             for result in results:
                 print(str(rank) + " " + result[0] + " " + str(result[1]))
+                if store is not None:
+                    print("    " + store.snippet(result[0]))
                 rank += 1
 
 
-# Automatic search
-def automatic():
+# Automatic search, top_k limits each ranking to the best top_k documents using dynamic pruning
+# With batch all queries are scored together with sparse matrix products
+# With query_workers > 1 batches of queries are ranked in worker processes that share the index file through mmap
+# postings_cache_mb > 0 keeps the postings of hot terms of a stored index in an LRU cache
+# With boolean every query is parsed as a Boolean query and only its matching documents are ranked
+# With positions Boolean phrases and proximity windows are matched exactly, with proximity the top documents of
+# every ranking are re-ranked by how close the query terms are in them
+def automatic(top_k=None, pruning="maxscore", workers=1, incremental=False, batch=False, query_workers=1,
+              postings_cache_mb=0, boolean=False, positions=False, proximity=False):
     # Read documents and stopword
     load_start_time = time.time()
     script_dir = os.path.dirname(os.path.abspath(__file__))
     documents_path = os.path.join(script_dir, "documents_2")
     stopwords_path = os.path.join(script_dir, "files", "stopwords.txt")
 
-    documents = read_documents_info(documents_path)
     stopwords = read_stopword_file(stopwords_path)
-    p = porter.PorterStemmer()
+    p = porter.CachedPorterStemmer()
 
     # Create or load index
-    index, documents, avg_doclen = create_index(documents, stopwords, p)
+    if incremental:
+        postings = update_incremental_index(documents_path, stopwords, p)
+    else:
+        # The documents are only read when the index has to be built
+        documents = LazyDocuments(read_documents_info, documents_path)
+        with stage("index"):
+            index, postings, avg_doclen = create_index(documents, stopwords, p, workers, postings_cache_mb)
+    positional = None
+    if (positions or proximity) and not incremental:
+        positional = load_positional_index(postings, LazyDocuments(read_documents_info, documents_path), stopwords, p)
+    proximity = proximity and positional is not None
     load_end_time = time.time()
     load_time = load_end_time - load_start_time
     print(f"Program load time：{load_time} seconds")
 
     print("Loading end")
     start_time = time.time()
+    cache = QueryCache()
+    scored = 0
+    skipped = 0
+    matching = 0
+    # Boolean and proximity queries are ranked one at a time
+    if boolean or proximity:
+        batch = False
+        query_workers = 1
     # Open the "queries.txt" file to read the query
     with open("files/queries.txt", "r") as queries_file:
         queries = queries_file.readlines()
 
+    # Process every query
+    query_ids = []
+    query_texts = []
+    with stage("query_analysis"):
+        for query in queries:
+            query_terms = query.strip().split(" ")
+            query_ids.append(query_terms[0])
+            if boolean:
+                query_texts.append(analyze_tree(parse_query(" ".join(query_terms[1:])), stopwords, p))
+            else:
+                query_texts.append(clear_txt(" ".join(query_terms[1:]).strip(), stopwords, p))
+    count("queries", len(query_ids))
+    if batch:
+        with stage("search"):
+            rankings = bm25_batch(query_texts, BM25Matrix(postings, 1, 0.75), top_k)
+    elif query_workers > 1:
+        # Stages inside the worker processes are not collected, only the whole parallel search is timed
+        index_spec = ("segments", "index_segments") if incremental else ("binary", "index.bin")
+        with stage("search"):
+            rankings, counters = parallel_search(query_texts, index_spec, query_workers, 1, 0.75, top_k, pruning)
+        scored += counters["scored"]
+        skipped += counters["skipped"]
+
     # Open the "results.txt" file to write the results
     with open("files/results.txt", "w") as results_file:
         # Iterate through each query
-        for query in queries:
-            query_terms = query.strip().split(" ")
-            query_id = query_terms[0]
-            query_text = clear_txt(" ".join(query_terms[1:]).strip(), stopwords, p)
+        for i, query_id in enumerate(query_ids):
+            query_text = query_texts[i]
 
             # Calculate the similarity score between the query and the document to get a ranked list
-            ranking = bm25_model(query_text, documents, index, 1, 0.75, avg_doclen)
+            if boolean:
+                with stage("search"):
+                    ranking, counters = ([], {"candidates": 0}) if query_text is None else \
+                        bm25_conjunctive(query_text, postings, 1, 0.75, top_k, positional)
+                matching += counters["candidates"]
+            elif proximity:
+                with stage("search"):
+                    ranking = bm25_proximity(query_text, postings, positional, 1, 0.75, top_k)
+            elif batch or query_workers > 1:
+                ranking = rankings[i]
+            elif top_k is None:
+                with stage("search"):
+                    ranking = bm25_model(query_text, postings, 1, 0.75, cache)
+            else:
+                with stage("search"):
+                    ranking, counters = bm25_top_k(query_text, postings, 1, 0.75, top_k, pruning, cache)
+                scored += counters["scored"]
+                skipped += counters["skipped"]
             rank_number = 1
 
             # Iterate through the list of rankings and write the results to the "results.txt" file
-            for rank in ranking:
-                results_file.write(f"{query_id}\t{rank_number}\t{rank[0]}\t{str(rank[1])}\n")
-                rank_number += 1
+            with stage("write"):
+                for rank in ranking:
+                    results_file.write(f"{query_id}\t{rank_number}\t{rank[0]}\t{str(rank[1])}\n")
+                    rank_number += 1
 
     end_time = time.time()
     runtime = end_time - start_time
     print(f"Program search time：{runtime} seconds")
+    if boolean:
+        print(f"Documents matching the Boolean queries: {matching}")
+    elif top_k is not None and not batch and not proximity:
+        print(f"Documents scored: {scored}, skipped by {pruning}: {skipped}")
+    print(f"Stemmer cache hit rate: {p.hit_rate()}")
+    if not boolean and not proximity and not batch and query_workers <= 1:
+        print(f"Query cache: {cache.stats()}")
+    if isinstance(postings, CachedPostingsIndex):
+        print(f"Postings cache: {postings.stats()}")
+    if instrumentation.enabled:
+        count("scored", scored)
+        count("skipped", skipped)
+        instrumentation.emit()
     return
 
 
-# Create index on first run, load index later
-def create_index(documents, stopwords, p):
-    # Read the index
+# Create index on first run, load index later, a new index is built by workers processes
+# A stored index is opened with a postings cache of postings_cache_mb megabytes when it is above 0
+def create_index(documents, stopwords, p, workers=1, postings_cache_mb=0):
+    # The binary index is mapped into memory, it holds the terms, postings and document lengths
+    binary_index_path = "index.bin"
+    # Stems of the indexed vocabulary, so that stemming a query is mostly a lookup
+    stems_path = "index_stems.json"
+    # Lengths, term frequencies and text of the indexed documents
+    store_path = "documents.store"
     index_file_path = "index.txt"
+    # The binary index is only used while it is at least as new as index.txt, deleting index.txt rebuilds both
+    if os.path.exists(binary_index_path) and os.path.exists(index_file_path) and \
+            os.path.getmtime(binary_index_path) >= os.path.getmtime(index_file_path):
+        print("Opening binary BM25 index.")
+        with stage("load"):
+            postings = open_cached_index(binary_index_path, int(postings_cache_mb * 2 ** 20))
+            if os.path.exists(stems_path):
+                p.load(stems_path)
+        return postings, postings, postings.avg_doclen
+
+    # Read the index
+    postings = None
     if os.path.exists(index_file_path):
-        processed_doc = {}
         # If the index file exists, load the index
-        index, avg_doclen = load_index(index_file_path)
-        # Processing of articles
-        for doc_id, document in documents.items():
-            processed_doc[doc_id] = clear_txt(documents[doc_id], stopwords, p)
+        with stage("load"):
+            index, avg_doclen = load_index(index_file_path)
+        if os.path.exists(store_path):
+            # The documents were analysed when the store was written, their term frequencies are read back
+            postings = postings_from_store(store_path, index, avg_doclen)
+            if os.path.exists(stems_path):
+                p.load(stems_path)
+        else:
+            processed_doc = {}
+            # Processing of articles
+            with stage("analysis"):
+                for doc_id, document in documents.items():
+                    processed_doc[doc_id] = clear_txt(documents[doc_id], stopwords, p)
     else:
         # If index file does not exist, create index and save to file
-        index = {}
-        processed_doc = {}
-        for doc_id, document in documents.items():
-            # Clear punctuation
-            document = clear_pun(document)
-            words = document.split()
-            clean_words = set()
-            all_words = []
-
-            for word in words:
-                if word not in stopwords:
-                    # stemming
-                    stem_word = p.stem(word)
-                    all_words.append(stem_word)  # Storage of processed words
-                    # Create index, index structure is {term : {doc_id : [doc_1, doc_2], idf : idf_value}}
-                    if stem_word not in clean_words:
-                        clean_words.add(stem_word)
-                        if stem_word in index:
-                            index[stem_word]["doc_id"].add(int(doc_id))
-                        else:
-                            index[stem_word] = {}
-                            index[stem_word]["doc_id"] = set()
-                            index[stem_word]["doc_id"].add(int(doc_id))
-            processed_doc[doc_id] = all_words
+        if workers > 1:
+            index, processed_doc = index_documents_parallel(documents, stopwords, workers, p)
+        else:
+            index, processed_doc = index_documents(documents, stopwords, p)
         # Average length of stored documents
         avg_doclen = calculate_avg_doc_len(processed_doc)
 
         # Calculate document idf
         document_numbers = len(processed_doc)
-        for term in index:
-            df = len(index[term]["doc_id"])
-            idf = math.log((document_numbers - df + 0.5) / (df + 0.5))
-            index[term]["idf"] = idf
+        with stage("idf"):
+            for term in index:
+                df = len(index[term]["doc_id"])
+                idf = math.log((document_numbers - df + 0.5) / (df + 0.5))
+                index[term]["idf"] = idf
 
         # Storage data
-        save_index(index, "index.txt", avg_doclen)
-    return index, processed_doc, avg_doclen
+        with stage("save"):
+            save_index(index, "index.txt", avg_doclen)
+
+    # Postings with term frequencies and dense doc ids for scoring
+    if postings is None:
+        with stage("postings_index"):
+            postings = build_postings_index(processed_doc, index, avg_doclen)
+        with stage("save"):
+            write_document_store(store_path, documents, processed_doc)
+    # Store the binary index so that later runs do not process the documents again
+    with stage("save"):
+        write_binary_index(postings, binary_index_path)
+        p.save(stems_path)
+    return index, postings, avg_doclen
+
+
+# Postings rebuilt from the term frequency vectors and lengths of a document store
+def postings_from_store(store_path, index, avg_doclen):
+    with stage("load"):
+        store = open_document_store(store_path)
+        tf_dict = dict(store.iter_vectors())
+        len_dict = dict(zip(store.doc_ids, store.doc_lens))
+        store.close()
+    with stage("postings_index"):
+        return build_postings_from_tf(tf_dict, len_dict, index, avg_doclen)
+
+
+# Positions of the analysed words of every document in index.bin, written again whenever index.bin is newer
+def load_positional_index(postings, documents, stopwords, p, positions_path="index_positions.bin"):
+    if not os.path.exists(positions_path) or os.path.getmtime(positions_path) < os.path.getmtime("index.bin"):
+        with stage("positions"):
+            processed_doc = dict(analyze_bulk(((doc_id, documents[doc_id]) for doc_id in postings.doc_ids),
+                                              stopwords, p))
+            write_positional_index(positions_path, processed_doc)
+    return open_positional_index(positions_path)
+
+
+# Segmented index in "index_segments", only documents added, changed or deleted since the last run are processed
+def update_incremental_index(documents_path, stopwords, p):
+    segment_index = SegmentIndex("index_segments", stopwords, p)
+    counters = segment_index.update([documents_path])
+    print(f"Incremental index: {counters['added']} added, {counters['changed']} changed, "
+          f"{counters['deleted']} deleted documents in {counters['seconds']} seconds")
+    compaction = segment_index.compact_in_background()
+    if compaction is not None:
+        compaction.join()
+    return segment_index.view()
+
+
+# Build the inverted index without idf, and the processed words of every document
+def index_documents(documents, stopwords, p):
+    index = {}
+    processed_doc = {}
+    # Clear punctuation, stopwords and stemming, the words of a chunk of documents are stemmed together
+    for doc_id, all_words in analyze_bulk(documents.items(), stopwords, p):
+        with stage("postings"):
+            clean_words = set()
+
+            for stem_word in all_words:
+                # Create index, index structure is {term : {doc_id : [doc_1, doc_2], idf : idf_value}}
+                if stem_word not in clean_words:
+                    clean_words.add(stem_word)
+                    if stem_word in index:
+                        index[stem_word]["doc_id"].add(int(doc_id))
+                    else:
+                        index[stem_word] = {}
+                        index[stem_word]["doc_id"] = set()
+                        index[stem_word]["doc_id"].add(int(doc_id))
+            processed_doc[doc_id] = all_words
+        count("documents")
+    return index, processed_doc
+
+
+# Index one chunk of documents in a worker process
+# The stem table of the worker is returned too, so the parent can save the stems of the whole vocabulary
+def index_chunk(chunk, stopwords):
+    p = porter.CachedPorterStemmer()
+    return index_documents(dict(chunk), stopwords, p) + (p.cache,)
+
+
+# Split the documents into contiguous chunks, index them in worker processes and merge the partial indexes in order
+# The stems found by the workers are added to the cache of p
+def index_documents_parallel(documents, stopwords, workers, p):
+    items = list(documents.items())
+    # A few chunks per worker keeps the cores busy when documents differ in length
+    chunk_size = max(1, math.ceil(len(items) / (workers * 4)))
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+    index = {}
+    processed_doc = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for partial_index, partial_doc, stems in executor.map(index_chunk, chunks, [stopwords] * len(chunks)):
+            # Chunks come back in document order, so terms and documents keep the order of a serial build
+            for term, value in partial_index.items():
+                if term in index:
+                    index[term]["doc_id"].update(value["doc_id"])
+                else:
+                    index[term] = value
+            processed_doc.update(partial_doc)
+            p.cache.update(stems)
+    return index, processed_doc
 
 
 # Clear punctuation and numbers
 def clear_pun(document_content):
-    clean_document = re.sub(r"[^\w\s]|[\d]", '', document_content)
-    return clean_document
+    return clean_text(document_content)
 
 
 # Process text, remove punctuation, numbers, and stemming
 def clear_txt(txt, stopwords, p):
-    clean_txt = re.sub(r"[^\w\s]|[\d]", '', txt)
-    words = clean_txt.split()
-    clean_words = []
-
-    for word in words:
-        if word not in stopwords:
-            # stemming
-            word = p.stem(word)
-            clean_words.append(word)
-    return clean_words
+    return analyze(txt, stopwords, p)
 
 
 # Creating an index
@@ -198,33 +444,23 @@ def read_documents_info(folder_path):
     return document_collection
 
 
-# Read stopword files
+# Read stopword files, as a frozenset for constant time lookups
 def read_stopword_file(stopwords_file_path):
-    with open(stopwords_file_path, 'r', encoding='utf-8') as file:
-        stopwords = file.read().splitlines()
-    return stopwords
-
-
-# BM25 model
-def bm25_model(query, documents, index, k, b, avg_doclen):
-    scores = {}
-    for term in query:
-        if term in index:
-            # The first run has a different index structure than subsequent runs, get idf
-            if type(index[term]) is list:
-                idf = float(index[term][0])
-            else:
-                idf = float(index[term]["idf"])
-            for doc_id, doc_content in documents.items():
-                # Calculation of tf and BM25
-                tf = doc_content.count(term)
-                score = idf * (tf * (k + 1)) / (tf + k * (1 - b + b * (len(doc_content) / float(avg_doclen))))
-                if doc_id in scores.keys():
-                    scores[doc_id] += score
-                else:
-                    scores[doc_id] = score
-    sorted_documents = sorted(scores.items(), key=lambda x: x[1], reverse=True)
-    return sorted_documents
+    return read_stopwords(stopwords_file_path)
+
+
+# BM25 model, only documents in the postings of the query terms are visited
+def bm25_model(query, postings, k, b, cache=None):
+    if cache is not None:
+        return cached_search(cache, query, postings, k, b)[0]
+    return bm25_taat(query, postings, k, b)
+
+
+# BM25 top-k with MaxScore or WAND pruning, returns the ranking and the scored/skipped counters
+def bm25_top_k(query, postings, k, b, top_k, pruning, cache=None):
+    if cache is not None:
+        return cached_search(cache, query, postings, k, b, top_k, pruning)
+    return bm25_topk(query, postings, k, b, top_k, pruning)
 
 
 # Calculate average document length
@@ -242,12 +478,46 @@ def main():
     parser = argparse.ArgumentParser(description='Small Corpus Search Program')
     parser.add_argument('-m', '--mode', choices=['automatic', 'interactive'], required=True,
                         help='Specify the mode to run the program')
+    parser.add_argument('-k', '--top-k', type=int, default=None,
+                        help='Only retrieve the top k documents of each query in automatic mode')
+    parser.add_argument('--pruning', choices=PRUNING_METHODS, default='maxscore',
+                        help='Dynamic pruning method used for top k retrieval')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of processes used to build a new index')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Use the segmented index that only re-indexes changed documents')
+    parser.add_argument('--batch', action='store_true',
+                        help='Score all queries at once with sparse matrix products (needs NumPy)')
+    parser.add_argument('-q', '--query-workers', type=int, default=1,
+                        help='Number of processes that rank queries in automatic mode')
+    parser.add_argument('--postings-cache-mb', type=float, default=0,
+                        help='Keep the postings of hot terms of a stored binary index in an LRU cache of this size')
+    parser.add_argument('--boolean', action='store_true',
+                        help='Parse the queries as Boolean queries with AND, OR, NOT, brackets and quotes, '
+                             'words next to each other must all match')
+    parser.add_argument('--positions', action='store_true',
+                        help='Keep word positions so that Boolean phrases "a b" and windows "a b"~5 match exactly')
+    parser.add_argument('--proximity', action='store_true',
+                        help='Re-rank the top documents by how close the query terms are, implies --positions')
+    parser.add_argument('--snippets', action='store_true',
+                        help='Print the start of every result document in interactive mode')
+    parser.add_argument('--instrument', action='store_true',
+                        help='Time the indexing and query stages and print a report')
+    parser.add_argument('--profile', action='store_true', help='Add a cProfile report to the instrumentation')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Add a tracemalloc report of the largest allocations to the instrumentation')
+    parser.add_argument('--report', default=None, help='Also write the instrumentation report as JSON to this file')
     args = parser.parse_args()
 
+    if args.instrument or args.profile or args.trace_memory or args.report:
+        instrumentation.enable(args.profile, args.trace_memory, args.report)
+
     if args.mode == 'automatic':
-        automatic()
+        automatic(args.top_k, args.pruning, args.workers, args.incremental, args.batch, args.query_workers,
+                  args.postings_cache_mb, args.boolean, args.positions, args.proximity)
     elif args.mode == 'interactive':
-        interactive()
+        interactive(args.pruning, args.workers, args.incremental, args.snippets, args.postings_cache_mb,
+                    args.positions, args.proximity)
 
 
 if __name__ == '__main__':
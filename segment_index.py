@@ -0,0 +1,400 @@
+import argparse
+import heapq
+import json
+import math
+import os
+import threading
+import time
+import weakref
+from array import array
+from collections import Counter
+import files.porter as porter
+from binary_index import open_binary_index, write_index_file
+from analyzer import analyze, read_stopwords
+
+MANIFEST = "manifest.json"
+
+
+# Segmented index that picks up added, changed and deleted documents without a rebuild
+# Every update writes its new documents into a small segment, replaced and deleted documents become tombstones,
+# and idf / avgdl are computed from the live documents of all segments.
+class SegmentIndex:
+
+    def __init__(self, index_dir, stopwords, p):
+        self.index_dir = index_dir
+        self.stopwords = stopwords
+        self.p = p
+        self.lock = threading.RLock()
+        self.compaction = None
+        os.makedirs(index_dir, exist_ok=True)
+        manifest_path = os.path.join(index_dir, MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as file:
+                self.manifest = json.load(file)
+        else:
+            # documents: path -> [segment, local doc id, mtime_ns, size, length], segment is None for an empty file
+            self.manifest = {"generation": 0, "next_segment": 0, "segments": [], "documents": {}, "tombstones": {}}
+        # Documents are known by absolute path, so a folder given relative once and absolute once is the same folder
+        self.manifest["documents"] = {os.path.abspath(path): entry
+                                      for path, entry in self.manifest["documents"].items()}
+        self.segments = {}
+        for name in self.manifest["segments"]:
+            self.segments[name] = open_binary_index(os.path.join(index_dir, name))
+        remove_unused_segments(index_dir, self.manifest["segments"])
+        self.current_view = None
+        # Views still alive, and merged segments that stay open until no view reads them
+        self.views = weakref.WeakSet()
+        self.retired = []
+
+    @property
+    def generation(self):
+        return self.manifest["generation"]
+
+    def save_manifest(self):
+        manifest_path = os.path.join(self.index_dir, MANIFEST)
+        with open(manifest_path + ".tmp", 'w', encoding='utf-8') as file:
+            json.dump(self.manifest, file)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    def tombstone(self, path):
+        segment, local_id = self.manifest["documents"].pop(path)[:2]
+        if segment is not None:
+            self.manifest["tombstones"].setdefault(segment, []).append(local_id)
+
+    # Write documents [(path, doc_id, text, mtime_ns, size)] to a new segment
+    def add_segment(self, documents):
+        name = f"segment_{self.manifest['next_segment']}.bin"
+        self.manifest["next_segment"] += 1
+        doc_ids = []
+        doc_lens = array('I')
+        postings = {}
+        for local_id, (path, doc_id, text, mtime_ns, size) in enumerate(documents):
+            words = analyze(text, self.stopwords, self.p)
+            doc_ids.append(doc_id)
+            doc_lens.append(len(words))
+            self.manifest["documents"][path] = [name, local_id, mtime_ns, size, len(words)]
+            for term, tf in Counter(words).items():
+                if term in postings:
+                    postings[term][0].append(local_id)
+                    postings[term][1].append(tf)
+                else:
+                    postings[term] = (array('I', [local_id]), array('I', [tf]))
+        write_segment_file(os.path.join(self.index_dir, name), doc_ids, doc_lens,
+                           ((term, docs, tfs) for term, (docs, tfs) in sorted(postings.items())))
+        self.segments[name] = open_binary_index(os.path.join(self.index_dir, name))
+        self.manifest["segments"].append(name)
+
+    # Scan the document folders (flat or nested) and index what changed since the last update
+    def update(self, folders):
+        start_time = time.time()
+        counters = {"added": 0, "changed": 0, "deleted": 0}
+        with self.lock:
+            known = self.manifest["documents"]
+            seen = set()
+            new_documents = []
+            for path, doc_id, stat in scan_documents([os.path.abspath(folder) for folder in folders]):
+                seen.add(path)
+                if path in known:
+                    if known[path][2:4] == [stat.st_mtime_ns, stat.st_size]:
+                        continue
+                    self.tombstone(path)
+                    counters["changed"] += 1
+                else:
+                    counters["added"] += 1
+                with open(path, 'r', encoding='utf-8') as file:
+                    text = file.read().lower()
+                # Empty documents are not indexed, like in read_documents_info, but remembered as seen
+                if len(text) != 0:
+                    new_documents.append((path, doc_id, text, stat.st_mtime_ns, stat.st_size))
+                else:
+                    known[path] = [None, -1, stat.st_mtime_ns, stat.st_size, 0]
+            for path in [path for path in known if path not in seen]:
+                self.tombstone(path)
+                counters["deleted"] += 1
+
+            if new_documents:
+                self.add_segment(new_documents)
+            if new_documents or counters["changed"] or counters["deleted"]:
+                self.manifest["generation"] += 1
+                self.save_manifest()
+        counters["seconds"] = time.time() - start_time
+        return counters
+
+    # Merge all segments into one without the tombstoned documents
+    def compact(self):
+        with self.lock:
+            names = list(self.manifest["segments"])
+            tombstones = {name: set(self.manifest["tombstones"].get(name, ())) for name in names}
+            if len(names) < 2 and not any(tombstones.values()):
+                return False
+            segments = [self.segments[name] for name in names]
+            name = f"segment_{self.manifest['next_segment']}.bin"
+            self.manifest["next_segment"] += 1
+
+        # The merge runs without the lock, updates meanwhile only add segments or tombstones
+        live_maps = [live_map(segment, tombstones[old]) for segment, old in zip(segments, names)]
+        bases = []
+        base = 0
+        for mapping in live_maps:
+            bases.append(base)
+            base += sum(1 for doc in mapping if doc >= 0)
+        doc_ids = []
+        doc_lens = array('I')
+        for segment, mapping in zip(segments, live_maps):
+            for local_id, doc in enumerate(mapping):
+                if doc >= 0:
+                    doc_ids.append(segment.doc_ids[local_id])
+                    doc_lens.append(segment.doc_lens[local_id])
+        write_segment_file(os.path.join(self.index_dir, name), doc_ids, doc_lens,
+                           merge_postings(segments, live_maps, bases))
+
+        with self.lock:
+            old_ids = {}
+            for old, mapping, base in zip(names, live_maps, bases):
+                old_ids[old] = (mapping, base)
+            # Point the documents of the merged segments to the new one, and carry over tombstones made meanwhile
+            for path, entry in self.manifest["documents"].items():
+                if entry[0] in old_ids:
+                    mapping, base = old_ids[entry[0]]
+                    entry[0], entry[1] = name, base + mapping[entry[1]]
+            new_tombstones = []
+            for old in names:
+                mapping, base = old_ids[old]
+                for local_id in self.manifest["tombstones"].pop(old, ()):
+                    if local_id not in tombstones[old]:
+                        new_tombstones.append(base + mapping[local_id])
+            if new_tombstones:
+                self.manifest["tombstones"][name] = new_tombstones
+            self.manifest["segments"] = [name] + [old for old in self.manifest["segments"] if old not in old_ids]
+            self.segments[name] = open_binary_index(os.path.join(self.index_dir, name))
+            self.manifest["generation"] += 1
+            self.save_manifest()
+            for old in names:
+                self.retired.append(self.segments.pop(old))
+            # The next view() reads the new segment, views of older generations keep the merged ones open
+            self.current_view = None
+            self.close_retired()
+        return True
+
+    # Close the merged segments that no live view reads any more and delete their files
+    def close_retired(self):
+        with self.lock:
+            in_use = {id(segment) for view in self.views for segment in view.segments}
+            still_used = []
+            for segment in self.retired:
+                if id(segment) in in_use:
+                    still_used.append(segment)
+                else:
+                    segment.close()
+            self.retired = still_used
+            remove_unused_segments(self.index_dir, self.manifest["segments"] +
+                                   [os.path.basename(segment.file_path) for segment in still_used])
+
+    # Compact in a background thread once there are more than max_segments segments
+    def compact_in_background(self, max_segments=4):
+        if len(self.manifest["segments"]) <= max_segments:
+            return None
+        if self.compaction is not None and self.compaction.is_alive():
+            return self.compaction
+        self.compaction = threading.Thread(target=self.compact, daemon=True)
+        self.compaction.start()
+        return self.compaction
+
+    # Postings view over the live documents, rebuilt when the generation changes
+    def view(self):
+        with self.lock:
+            if self.current_view is None or self.current_view.generation != self.generation:
+                names = self.manifest["segments"]
+                self.current_view = SegmentedView(
+                    [self.segments[name] for name in names],
+                    [set(self.manifest["tombstones"].get(name, ())) for name in names],
+                    self.generation)
+                self.views.add(self.current_view)
+                # Merged segments are closed once the last view of an older generation is collected
+                weakref.finalize(self.current_view, self.close_retired)
+            return self.current_view
+
+
+# Delete segment files that are no longer in the manifest
+def remove_unused_segments(index_dir, names):
+    for file_name in os.listdir(index_dir):
+        if file_name.startswith("segment_") and file_name not in names:
+            try:
+                os.remove(os.path.join(index_dir, file_name))
+            except OSError:
+                pass
+
+
+# Local doc id -> dense id among the live documents of one segment, -1 for a tombstone
+def live_map(segment, tombstones):
+    mapping = []
+    live = 0
+    for local_id in range(segment.num_docs):
+        if local_id in tombstones:
+            mapping.append(-1)
+        else:
+            mapping.append(live)
+            live += 1
+    return mapping
+
+
+# Postings of one term over all segments, in the dense ids of the live documents
+def live_postings(segments, live_maps, bases, term):
+    docs = array('i')
+    tfs = array('i')
+    for segment, mapping, base in zip(segments, live_maps, bases):
+        entry = segment.postings(term)
+        if entry is None:
+            continue
+        for doc, tf in zip(entry[1], entry[2]):
+            if mapping[doc] >= 0:
+                docs.append(base + mapping[doc])
+                tfs.append(tf)
+    return docs, tfs
+
+
+def segment_terms(segment):
+    for term_id in range(segment.num_terms):
+        yield segment.term(term_id)
+
+
+def merge_postings(segments, live_maps, bases):
+    terms = heapq.merge(*(segment_terms(segment) for segment in segments))
+    previous = None
+    for term in terms:
+        if term == previous:
+            continue
+        previous = term
+        docs, tfs = live_postings(segments, live_maps, bases, term)
+        if docs:
+            yield term, docs, tfs
+
+
+# Segments keep no idf or bounds, both depend on the statistics of all segments
+def write_segment_file(file_path, doc_ids, doc_lens, postings):
+    avg_doclen = sum(doc_lens) / len(doc_lens) if doc_lens else 0.0
+    write_index_file(file_path, doc_ids, doc_lens, avg_doclen,
+                     ((term, 0.0, docs, tfs, 0.0) for term, docs, tfs in postings))
+
+
+# Read-only postings index over the segments of one generation, with the interface of PostingsIndex
+class SegmentedView:
+
+    def __init__(self, segments, tombstones, generation):
+        self.segments = segments
+        self.generation = generation
+        self.live_maps = [live_map(segment, dead) for segment, dead in zip(segments, tombstones)]
+        self.bases = []
+        self.doc_ids = []
+        self.doc_lens = array('i')
+        for segment, mapping in zip(segments, self.live_maps):
+            self.bases.append(len(self.doc_ids))
+            for local_id, doc in enumerate(mapping):
+                if doc >= 0:
+                    self.doc_ids.append(segment.doc_ids[local_id])
+                    self.doc_lens.append(segment.doc_lens[local_id])
+        # Collection statistics of the live documents
+        self.total_len = sum(self.doc_lens)
+        self.avg_doclen = self.total_len / len(self.doc_ids) if self.doc_ids else 0.0
+        self.terms = {}
+        self.norms_cache = {}
+        self.bounds_cache = {}
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __contains__(self, term):
+        return self.postings(term) is not None
+
+    def postings(self, term):
+        if term not in self.terms:
+            docs, tfs = live_postings(self.segments, self.live_maps, self.bases, term)
+            if docs:
+                df = len(docs)
+                idf = math.log((len(self.doc_ids) - df + 0.5) / (df + 0.5))
+                self.terms[term] = (idf, docs, tfs)
+            else:
+                self.terms[term] = None
+        return self.terms[term]
+
+    def iter_postings(self):
+        for term, docs, tfs in merge_postings(self.segments, self.live_maps, self.bases):
+            yield term, self.postings(term)
+
+    def norms(self, k, b):
+        key = (k, b)
+        if key not in self.norms_cache:
+            avg_doclen = self.avg_doclen
+            self.norms_cache[key] = [k * (1 - b + b * (doc_len / avg_doclen)) for doc_len in self.doc_lens]
+        return self.norms_cache[key]
+
+    def upper_bounds(self, k, b):
+        key = (k, b)
+        if key not in self.bounds_cache:
+            self.bounds_cache[key] = ViewBounds(self, k, b)
+        return self.bounds_cache[key]
+
+
+# Score upper bounds of a SegmentedView, computed per term on first use
+class ViewBounds:
+
+    def __init__(self, view, k, b):
+        self.view = view
+        self.k = k
+        self.b = b
+        self.bounds = {}
+
+    def __getitem__(self, term):
+        if term not in self.bounds:
+            entry = self.view.postings(term)
+            if entry is None:
+                raise KeyError(term)
+            idf, docs, tfs = entry
+            norms = self.view.norms(self.k, self.b)
+            k_plus = self.k + 1
+            bound = 0.0
+            for doc, tf in zip(docs, tfs):
+                bound = max(bound, idf * (tf * k_plus) / (tf + norms[doc]))
+            self.bounds[term] = bound
+        return self.bounds[term]
+
+
+# Yield (path, doc_id, stat) of every document file, sub folders are scanned for the nested layout
+def scan_documents(folders):
+    for folder in folders:
+        for entry in sorted(os.scandir(folder), key=lambda entry: entry.name):
+            if entry.is_dir():
+                yield from scan_documents([entry.path])
+            elif entry.is_file():
+                yield entry.path, entry.name, entry.stat()
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Incremental segmented index')
+    parser.add_argument('action', choices=['update', 'compact', 'stats'])
+    parser.add_argument('folders', nargs='*', default=[os.path.join(script_dir, "documents_2")],
+                        help='Document folders to scan on update')
+    parser.add_argument('-i', '--index-dir', default="index_segments", help='Directory of the segments')
+    parser.add_argument('--max-segments', type=int, default=4,
+                        help='Suggest a compaction when an update leaves more segments than this')
+    args = parser.parse_intermixed_args()
+
+    stopwords = read_stopwords(os.path.join(script_dir, "files", "stopwords.txt"))
+    segment_index = SegmentIndex(args.index_dir, stopwords, porter.CachedPorterStemmer())
+    if args.action == 'update':
+        counters = segment_index.update(args.folders)
+        print(f"Added {counters['added']}, changed {counters['changed']}, deleted {counters['deleted']} "
+              f"documents in {counters['seconds']} seconds")
+        # A background merge would die with this process, so a long-lived reader or the compact action merges
+        if len(segment_index.manifest["segments"]) > args.max_segments:
+            print(f"More than {args.max_segments} segments, run the compact action to merge them")
+    elif args.action == 'compact':
+        segment_index.compact()
+    view = segment_index.view()
+    print(f"Generation {view.generation}: {len(segment_index.manifest['segments'])} segments, "
+          f"{len(view)} live documents, average length {view.avg_doclen}")
+
+
+if __name__ == '__main__':
+    main()
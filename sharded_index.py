@@ -0,0 +1,252 @@
+import argparse
+import heapq
+import ipaddress
+import json
+import os
+import socket
+import time
+from bisect import bisect_left
+from itertools import islice
+from multiprocessing import AuthenticationError, Pipe, Process
+from multiprocessing.connection import Client, Listener
+import files.porter as porter
+from analyzer import analyze, read_stopwords
+from binary_index import open_binary_index, write_binary_index
+from bm25_index import PRUNING_METHODS, PostingsIndex, bm25_taat, bm25_topk
+
+# Nodes and coordinators exchange pickled messages, so whoever knows the secret can run code on a node.
+# The secret of nodes started by hand is read from this environment variable
+AUTHKEY_ENV = "BM25_SHARD_KEY"
+MANIFEST = "shards.json"
+
+
+# Secret shared by the shard nodes and the coordinator: the value of BM25_SHARD_KEY, or a fresh random secret
+# for nodes started by this process when it is not set and not required
+def shard_authkey(required=False):
+    key = os.environ.get(AUTHKEY_ENV)
+    if key:
+        return key.encode('utf-8')
+    if required:
+        raise SystemExit(f"Set {AUTHKEY_ENV} to the secret shared by the shard nodes and the coordinator")
+    return os.urandom(32)
+
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+# Split an index by document into shards of consecutive dense ids
+# Every shard keeps the whole vocabulary with the global idf and the global average document length,
+# so a document scores exactly as in the single index and the zero score of unmatched documents is the same
+def split_index(postings_index, shard_count):
+    documents = len(postings_index)
+    bounds = [documents * i // shard_count for i in range(shard_count + 1)]
+    doc_ids = list(postings_index.doc_ids)
+    shards = [PostingsIndex(doc_ids[start:end], postings_index.doc_lens[start:end], postings_index.avg_doclen)
+              for start, end in zip(bounds, bounds[1:])]
+    for term, (idf, docs, tfs) in postings_index.iter_postings():
+        for shard, start, end in zip(shards, bounds, bounds[1:]):
+            first = bisect_left(docs, start)
+            last = bisect_left(docs, end, first)
+            shard.add_term(term, idf, [doc - start for doc in docs[first:last]], tfs[first:last])
+    return shards, bounds
+
+
+# Write the shards as binary index files with a manifest, one file per node
+def write_shards(postings_index, shard_count, directory):
+    os.makedirs(directory, exist_ok=True)
+    shards, bounds = split_index(postings_index, shard_count)
+    paths = []
+    for number, shard in enumerate(shards):
+        path = os.path.join(directory, f"shard_{number}.bin")
+        write_binary_index(shard, path)
+        paths.append(path)
+    manifest = {"documents": len(postings_index), "avg_doclen": postings_index.avg_doclen,
+                "shards": [{"path": os.path.basename(path), "first_doc": start, "documents": end - start}
+                           for path, start, end in zip(paths, bounds, bounds[1:])]}
+    with open(os.path.join(directory, MANIFEST), 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2)
+    return paths
+
+
+def shard_paths(directory):
+    with open(os.path.join(directory, MANIFEST), 'r', encoding='utf-8') as file:
+        manifest = json.load(file)
+    return [os.path.join(directory, shard["path"]) for shard in manifest["shards"]]
+
+
+# Rankings of one shard for a batch of analysed queries, the full ranking with top_k None
+def search_shard(shard, queries, k, b, top_k, pruning):
+    if top_k is None:
+        return [bm25_taat(query, shard, k, b) for query in queries]
+    return [bm25_topk(query, shard, k, b, top_k, pruning)[0] for query in queries]
+
+
+# A shard node: maps its shard file and answers ("search", queries, k, b, top_k, pruning) messages
+# over a TCP connection until it receives ("stop",). The bound address is sent to ready when given
+def serve_shard(path, authkey, host="127.0.0.1", port=0, ready=None):
+    shard = open_binary_index(path)
+    with Listener((host, port), authkey=authkey) as listener:
+        if ready is not None:
+            ready.send(listener.address)
+            ready.close()
+        else:
+            print(f"Serving {path} on {listener.address[0]}:{listener.address[1]}")
+        while True:
+            # A client without the secret is turned away before any of its messages is unpickled
+            try:
+                connection = listener.accept()
+            except (AuthenticationError, OSError):
+                continue
+            with connection:
+                while True:
+                    try:
+                        message = connection.recv()
+                    except EOFError:
+                        break
+                    if message[0] == "stop":
+                        return
+                    command, queries, k, b, top_k, pruning = message
+                    connection.send(search_shard(shard, queries, k, b, top_k, pruning))
+
+
+# Start one local node process per shard file, returns the processes and their addresses
+def start_local_shards(paths, authkey, host="127.0.0.1"):
+    processes = []
+    addresses = []
+    for path in paths:
+        receiver, sender = Pipe(duplex=False)
+        process = Process(target=serve_shard, args=(path, authkey, host, 0, sender), daemon=True)
+        process.start()
+        sender.close()
+        addresses.append(receiver.recv())
+        receiver.close()
+        processes.append(process)
+    return processes, addresses
+
+
+# Broadcasts analysed queries to every shard node and merges their rankings
+# Shards hold consecutive documents in collection order and heapq.merge breaks ties by shard order,
+# so the merged ranking is the ranking of the single index
+class ShardCoordinator:
+
+    def __init__(self, addresses, authkey):
+        self.connections = [Client(tuple(address), authkey=authkey) for address in addresses]
+
+    def __len__(self):
+        return len(self.connections)
+
+    def search_many(self, queries, k=1, b=0.75, top_k=None, pruning="maxscore"):
+        # Scatter the whole batch first, so the shards work at the same time
+        for connection in self.connections:
+            connection.send(("search", queries, k, b, top_k, pruning))
+        shard_rankings = [connection.recv() for connection in self.connections]
+        rankings = []
+        for per_shard in zip(*shard_rankings):
+            merged = heapq.merge(*per_shard, key=lambda item: -item[1])
+            rankings.append(list(merged) if top_k is None else list(islice(merged, top_k)))
+        return rankings
+
+    def search(self, query, k=1, b=0.75, top_k=None, pruning="maxscore"):
+        return self.search_many([query], k, b, top_k, pruning)[0]
+
+    def close(self, stop_shards=True):
+        for connection in self.connections:
+            if stop_shards:
+                connection.send(("stop",))
+            connection.close()
+
+
+def stop_local_shards(coordinator, processes):
+    coordinator.close()
+    for process in processes:
+        process.join()
+
+
+# Queries per second of the query set on local shard nodes, for each shard count, and whether every ranking
+# is the ranking of the single index
+def shard_scaling(postings_index, queries, shard_counts, directory, top_k=None, repeat=1):
+    expected = search_shard(postings_index, queries, 1, 0.75, top_k, "maxscore")
+    authkey = shard_authkey()
+    report = []
+    for shard_count in shard_counts:
+        paths = write_shards(postings_index, shard_count, os.path.join(directory, f"shards_{shard_count}"))
+        processes, addresses = start_local_shards(paths, authkey)
+        coordinator = ShardCoordinator(addresses, authkey)
+        try:
+            start_time = time.perf_counter()
+            for _ in range(repeat):
+                rankings = coordinator.search_many(queries, top_k=top_k)
+            seconds = time.perf_counter() - start_time
+        finally:
+            stop_local_shards(coordinator, processes)
+        report.append({"shards": shard_count, "queries": repeat * len(queries), "seconds": seconds,
+                       "qps": repeat * len(queries) / seconds, "exact": rankings == expected})
+    return report
+
+
+def read_queries(queries_path, stopwords, p):
+    with open(queries_path, "r") as queries_file:
+        return [analyze(" ".join(query.strip().split(" ")[1:]).strip(), stopwords, p) for query in queries_file]
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Document sharded index with scatter-gather search')
+    commands = parser.add_subparsers(dest='command', required=True)
+    split = commands.add_parser('split', help='Split a binary index into shard files')
+    split.add_argument('-i', '--index', default="index.bin", help='Binary index file')
+    split.add_argument('-n', '--shards', type=int, default=4, help='Number of shards')
+    split.add_argument('-d', '--directory', default="index_shards", help='Directory of the shard files')
+    serve = commands.add_parser('serve', help='Serve one shard file as a node')
+    serve.add_argument('shard', help='Shard file')
+    serve.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    serve.add_argument('--port', type=int, default=0, help='Port to listen on, 0 picks a free port')
+    serve.add_argument('--allow-remote', action='store_true',
+                       help='Listen on an address other hosts can reach, only on a trusted network')
+    scaling = commands.add_parser('scaling', help='Query throughput on local nodes for each shard count')
+    scaling.add_argument('-i', '--index', default="index.bin", help='Binary index file')
+    scaling.add_argument('-n', '--shards', type=int, nargs='+', default=[1, 2, 4], help='Shard counts to compare')
+    scaling.add_argument('-d', '--directory', default="index_shards", help='Directory of the shard files')
+    scaling.add_argument('-k', '--top-k', type=int, default=None, help='Rank only the top k documents')
+    scaling.add_argument('-r', '--repeat', type=int, default=1, help='Runs of the query file')
+    search = commands.add_parser('search', help='Rank the query file on running nodes')
+    search.add_argument('nodes', nargs='+', help='host:port of every shard node, in shard order')
+    search.add_argument('-k', '--top-k', type=int, default=10, help='Rank only the top k documents')
+    search.add_argument('--pruning', choices=PRUNING_METHODS, default='maxscore',
+                        help='Dynamic pruning method used on the shards')
+    args = parser.parse_args()
+
+    if args.command == 'split':
+        paths = write_shards(open_binary_index(args.index), args.shards, args.directory)
+        print(f"Wrote {len(paths)} shards to {args.directory}")
+    elif args.command == 'serve':
+        if not args.allow_remote and not is_loopback(args.host):
+            parser.error(f"{args.host} is not a loopback address, pass --allow-remote to listen on it")
+        serve_shard(args.shard, shard_authkey(required=True), args.host, args.port)
+    else:
+        stopwords = read_stopwords(os.path.join(script_dir, "files", "stopwords.txt"))
+        queries = read_queries(os.path.join(script_dir, "files", "queries.txt"), stopwords,
+                               porter.CachedPorterStemmer())
+        if args.command == 'scaling':
+            for row in shard_scaling(open_binary_index(args.index), queries, args.shards, args.directory,
+                                     args.top_k, args.repeat):
+                print(f"{row['shards']} shards: {row['queries']} queries in {row['seconds']:.3f} seconds, "
+                      f"{row['qps']:.1f} queries/s, same rankings as one index: {row['exact']}")
+        else:
+            addresses = [(node.rsplit(":", 1)[0], int(node.rsplit(":", 1)[1])) for node in args.nodes]
+            coordinator = ShardCoordinator(addresses, shard_authkey(required=True))
+            try:
+                start_time = time.perf_counter()
+                rankings = coordinator.search_many(queries, top_k=args.top_k, pruning=args.pruning)
+                seconds = time.perf_counter() - start_time
+            finally:
+                coordinator.close(stop_shards=False)
+            print(f"{len(rankings)} queries on {len(addresses)} shards in {seconds:.3f} seconds")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+import argparse
+import heapq
+import math
+import os
+import shutil
+import struct
+import tempfile
+import time
+from array import array
+from collections import Counter
+import files.porter as porter
+from binary_index import CODEC_IDS, open_binary_index, pack_uint32, write_index_file
+from analyzer import analyze, read_stopwords
+
+# Rough memory cost of the in-memory block: a new term (dict slot, key and two arrays) and one posting (two ints)
+TERM_BYTES = 250
+POSTING_BYTES = 8
+LENGTH = struct.Struct("<I")
+
+
+# Yield (doc_id, lower-case text) one document at a time, in the order read_documents_info uses
+# A nested folder holds one sub folder per group of documents, as search_large_corpus expects
+def iter_documents(folder_path, nested=False):
+    if nested:
+        folders = [os.path.join(folder_path, name) for name in os.listdir(folder_path)]
+        folders = [folder for folder in folders if os.path.isdir(folder)]
+    else:
+        folders = [folder_path]
+    for folder in folders:
+        for file_id in os.listdir(folder):
+            with open(os.path.join(folder, file_id), 'r', encoding='utf-8') as file:
+                document_content = file.read().lower()
+            if len(document_content) != 0:
+                yield file_id, document_content
+
+
+# Write one sorted block of postings {term : (docs, tfs)} as a segment file
+def write_segment(block, segment_path):
+    with open(segment_path, 'wb') as file:
+        for term in sorted(block):
+            docs, tfs = block[term]
+            term_bytes = term.encode('utf-8')
+            file.write(LENGTH.pack(len(term_bytes)))
+            file.write(term_bytes)
+            file.write(LENGTH.pack(len(docs)))
+            file.write(pack_uint32(docs))
+            file.write(pack_uint32(tfs))
+
+
+# Read (term, docs, tfs) back from a segment file in term order
+def read_segment(segment_path):
+    with open(segment_path, 'rb') as file:
+        while True:
+            header = file.read(LENGTH.size)
+            if not header:
+                return
+            term = file.read(LENGTH.unpack(header)[0]).decode('utf-8')
+            df = LENGTH.unpack(file.read(LENGTH.size))[0]
+            docs = array('I')
+            docs.frombytes(file.read(4 * df))
+            tfs = array('I')
+            tfs.frombytes(file.read(4 * df))
+            yield term, docs, tfs
+
+
+# Merge the segments term by term, segments are written in document order so postings only need to be appended
+def merge_segments(segment_paths):
+    merged = heapq.merge(*(read_segment(path) for path in segment_paths), key=lambda entry: entry[0])
+    current = None
+    for term, docs, tfs in merged:
+        if current is not None and current[0] == term:
+            current[1].extend(docs)
+            current[2].extend(tfs)
+        else:
+            if current is not None:
+                yield current
+            current = (term, docs, tfs)
+    if current is not None:
+        yield current
+
+
+# Single-pass in-memory indexing: postings are flushed to a sorted segment whenever memory_budget bytes are reached,
+# then the segments are merged into one binary index file
+def build_streaming_index(documents, stopwords, p, output_path, memory_budget=64 * 1024 * 1024, k=1, b=0.75,
+                          codec="raw"):
+    segment_dir = tempfile.mkdtemp(prefix="spimi_", dir=os.path.dirname(os.path.abspath(output_path)))
+    segment_paths = []
+    doc_ids = []
+    doc_lens = array('I')
+    block = {}
+    block_bytes = 0
+    try:
+        for doc_id, document in documents:
+            dense_id = len(doc_ids)
+            words = analyze(document, stopwords, p)
+            doc_ids.append(doc_id)
+            doc_lens.append(len(words))
+            for term, tf in Counter(words).items():
+                if term in block:
+                    block[term][0].append(dense_id)
+                    block[term][1].append(tf)
+                else:
+                    block[term] = (array('I', [dense_id]), array('I', [tf]))
+                    block_bytes += TERM_BYTES
+                block_bytes += POSTING_BYTES
+            if block_bytes >= memory_budget:
+                segment_paths.append(os.path.join(segment_dir, f"segment_{len(segment_paths)}"))
+                write_segment(block, segment_paths[-1])
+                block = {}
+                block_bytes = 0
+        if block or not segment_paths:
+            segment_paths.append(os.path.join(segment_dir, f"segment_{len(segment_paths)}"))
+            write_segment(block, segment_paths[-1])
+        block = None
+
+        document_numbers = len(doc_ids)
+        if document_numbers == 0:
+            raise ValueError("No documents to index")
+        avg_doclen = sum(doc_lens) / document_numbers
+        norms = [k * (1 - b + b * (doc_len / avg_doclen)) for doc_len in doc_lens]
+        write_index_file(output_path, doc_ids, doc_lens, avg_doclen,
+                         merged_entries(merge_segments(segment_paths), document_numbers, norms, k),
+                         k, b, codec)
+    finally:
+        shutil.rmtree(segment_dir)
+    return len(segment_paths)
+
+
+# Add idf and the score upper bound to every merged postings list
+def merged_entries(merged, document_numbers, norms, k):
+    k_plus = k + 1
+    for term, docs, tfs in merged:
+        df = len(docs)
+        idf = math.log((document_numbers - df + 0.5) / (df + 0.5))
+        bound = 0.0
+        for doc, tf in zip(docs, tfs):
+            bound = max(bound, idf * (tf * k_plus) / (tf + norms[doc]))
+        yield term, idf, docs, tfs, bound
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Build a binary index with bounded memory')
+    parser.add_argument('documents', help='Folder of documents')
+    parser.add_argument('-o', '--output', default="index.bin", help='Binary index file to write')
+    parser.add_argument('--nested', action='store_true',
+                        help='Documents are in sub folders, as in the large corpus layout')
+    parser.add_argument('-m', '--memory-mb', type=float, default=64,
+                        help='Memory budget of the in-memory block before it is flushed to a segment')
+    parser.add_argument('-c', '--codec', choices=list(CODEC_IDS), default='raw', help='Postings encoding')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    stopwords = read_stopwords(os.path.join(script_dir, "files", "stopwords.txt"))
+    segments = build_streaming_index(iter_documents(args.documents, args.nested), stopwords,
+                                     porter.CachedPorterStemmer(), args.output, int(args.memory_mb * 1024 * 1024),
+                                     codec=args.codec)
+    binary_index = open_binary_index(args.output)
+    print(f"Wrote {args.output}: {binary_index.num_docs} documents, {binary_index.num_terms} terms, "
+          f"{segments} segments merged in {time.time() - start_time} seconds")
+    binary_index.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+import argparse
+import math
+import os
+import random
+import string
+from bisect import bisect
+from collections import Counter
+from itertools import accumulate
+from analyzer import clean_text, read_stopwords
+
+
+# Least squares slope and intercept of y over x
+def fit_line(xs, ys):
+    n = len(xs)
+    mean_x = sum(xs) / n
+    mean_y = sum(ys) / n
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance if variance else 0.0
+    return slope, mean_y - slope * mean_x
+
+
+# Distributions of a corpus and its queries after the analysis of clear_txt (punctuation, digits and stopwords
+# removed), fitted on the words before stemming so that generated text goes through the same stemming when indexed
+class CorpusModel:
+
+    def __init__(self, documents, queries, stopwords):
+        words = Counter()
+        stop_counts = Counter()
+        self.doc_lengths = []  # analysed length of every document
+        heaps_points = []  # (tokens, distinct words) while reading the corpus
+        tokens = 0
+        for text in documents:
+            length = 0
+            for word in clean_text(text).split():
+                if word in stopwords:
+                    stop_counts[word] += 1
+                else:
+                    words[word] += 1
+                    length += 1
+            tokens += length
+            self.doc_lengths.append(length)
+            heaps_points.append((tokens, len(words)))
+        self.tokens = tokens
+        self.vocabulary = [word for word, count in sorted(words.items(), key=lambda item: (-item[1], item[0]))]
+        self.counts = [words[word] for word in self.vocabulary]
+        self.stopwords = sorted(stop_counts)
+        self.stop_counts = [stop_counts[word] for word in self.stopwords]
+        self.stop_rate = sum(self.stop_counts) / (sum(self.stop_counts) + tokens) if tokens else 0.0
+
+        # Zipf: log frequency is linear in log rank, fitted over the words seen at least twice
+        ranked = [(math.log(rank), math.log(count)) for rank, count in enumerate(self.counts, 1) if count > 1]
+        slope, self.zipf_intercept = fit_line([x for x, y in ranked], [y for x, y in ranked])
+        self.zipf_exponent = -slope
+        # Heaps: log vocabulary size is linear in log tokens
+        points = [(math.log(n), math.log(v)) for n, v in heaps_points if n > 0 and v > 0]
+        self.heaps_beta, log_k = fit_line([x for x, y in points], [y for x, y in points])
+        self.heaps_k = math.exp(log_k)
+
+        # Queries: their analysed lengths and the corpus frequency rank of every query word
+        ranks = {word: rank for rank, word in enumerate(self.vocabulary)}
+        self.query_lengths = []
+        self.query_ranks = []
+        for text in queries:
+            query_words = [word for word in clean_text(text).split() if word not in stopwords and word in ranks]
+            if query_words:
+                self.query_lengths.append(len(query_words))
+                self.query_ranks.extend(ranks[word] for word in query_words)
+
+    # Vocabulary size expected for a corpus of tokens tokens
+    def vocabulary_size(self, tokens):
+        return max(len(self.vocabulary), int(self.heaps_k * tokens ** self.heaps_beta))
+
+
+# Made-up word for a rank past the observed vocabulary, letters only so that it survives the analysis
+def invented_word(rank):
+    letters = []
+    while True:
+        rank, digit = divmod(rank, 26)
+        letters.append(string.ascii_lowercase[digit])
+        if rank == 0:
+            break
+    return "zq" + "".join(reversed(letters))
+
+
+# Synthetic documents and queries drawn from a CorpusModel, the same seed always gives the same output
+# Observed words keep their frequencies, the vocabulary grows past them with Heaps' law and a Zipf tail
+class CorpusGenerator:
+
+    def __init__(self, model, scale, seed=0):
+        self.model = model
+        self.random = random.Random(seed)
+        # Queries have their own stream, so a query file does not depend on the number of documents
+        self.query_random = random.Random(f"{seed}:queries")
+        self.documents = scale * len(model.doc_lengths)
+        size = model.vocabulary_size(scale * model.tokens)
+        observed = len(model.vocabulary)
+        weights = model.counts + [math.exp(model.zipf_intercept) * rank ** -model.zipf_exponent
+                                  for rank in range(observed + 1, size + 1)]
+        self.words = model.vocabulary + [invented_word(rank) for rank in range(size - observed)]
+        self.cum_weights = list(accumulate(weights))
+        self.stop_cum_weights = list(accumulate(model.stop_counts))
+
+    # Content words of length drawn from the fitted distribution, with stopwords mixed in at the fitted rate
+    def document(self):
+        rng = self.random
+        model = self.model
+        length = rng.choice(model.doc_lengths)
+        content = rng.choices(self.words, cum_weights=self.cum_weights, k=length)
+        text = []
+        for word in content:
+            while model.stopwords and rng.random() < model.stop_rate:
+                text.append(model.stopwords[bisect(self.stop_cum_weights, rng.random() * self.stop_cum_weights[-1])])
+            text.append(word)
+        return " ".join(text)
+
+    def query(self):
+        rng = self.query_random
+        length = rng.choice(self.model.query_lengths)
+        return " ".join(self.words[rng.choice(self.model.query_ranks)] for _ in range(length))
+
+    # Write the documents one at a time, flat: folder/<id>, nested: folder/<id>/<id> as search_large_corpus reads
+    def write_documents(self, folder, nested=False):
+        os.makedirs(folder, exist_ok=True)
+        for doc_id in range(1, self.documents + 1):
+            path = os.path.join(folder, str(doc_id))
+            if nested:
+                os.makedirs(path, exist_ok=True)
+                path = os.path.join(path, str(doc_id))
+            with open(path, 'w', encoding='utf-8') as file:
+                file.write(self.document())
+                file.write("\n")
+        return self.documents
+
+    # Query file in the format of files/queries.txt: "<id> <text>" per line
+    def write_queries(self, file_path, count):
+        with open(file_path, 'w', encoding='utf-8') as file:
+            for query_id in range(1, count + 1):
+                file.write(f"{query_id} {self.query()}\n")
+        return count
+
+
+# Lower-case texts of a corpus in either layout, in file name order so that the fit does not depend on the file system
+def iter_texts(folder_path):
+    for name in sorted(os.listdir(folder_path)):
+        path = os.path.join(folder_path, name)
+        if os.path.isdir(path):
+            yield from iter_texts(path)
+        else:
+            with open(path, 'r', encoding='utf-8') as file:
+                text = file.read().lower()
+            if len(text) != 0:
+                yield text
+
+
+def read_query_texts(queries_path):
+    with open(queries_path, 'r', encoding='utf-8') as file:
+        return [" ".join(line.strip().split(" ")[1:]).lower() for line in file if line.strip()]
+
+
+# Fit a model on a corpus and write a corpus scale times its size with count matching queries
+def generate(source, queries_path, output, scale, nested=False, seed=0, query_count=None, output_queries=None):
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    stopwords = read_stopwords(os.path.join(script_dir, "files", "stopwords.txt"))
+    query_texts = read_query_texts(queries_path)
+    model = CorpusModel(iter_texts(source), query_texts, stopwords)
+    generator = CorpusGenerator(model, scale, seed)
+    generator.write_documents(output, nested)
+    output_queries = output_queries or output.rstrip("/\\") + "_queries.txt"
+    generator.write_queries(output_queries, query_count or len(query_texts))
+    return model, generator, output_queries
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Generate a synthetic corpus and queries fitted on a real corpus')
+    parser.add_argument('output', help='Folder of the generated documents')
+    parser.add_argument('-s', '--scale', type=int, default=10, help='Size as a multiple of the source corpus')
+    parser.add_argument('--source', default=os.path.join(script_dir, "documents_2"),
+                        help='Corpus to fit, flat or nested')
+    parser.add_argument('--queries', default=os.path.join(script_dir, "files", "queries.txt"),
+                        help='Query file to fit')
+    parser.add_argument('--layout', choices=['flat', 'nested'], default='flat',
+                        help='flat as documents_2, nested as documents/<folder>/<id>')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('-n', '--num-queries', type=int, default=None,
+                        help='Number of queries, as many as the fitted query file by default')
+    parser.add_argument('-q', '--query-file', default=None, help='Query file to write, <output>_queries.txt by default')
+    args = parser.parse_args()
+
+    model, generator, query_file = generate(args.source, args.queries, args.output, args.scale,
+                                            args.layout == 'nested', args.seed, args.num_queries, args.query_file)
+    print(f"Fitted {len(model.doc_lengths)} documents: {model.tokens} tokens, {len(model.vocabulary)} words, "
+          f"Zipf exponent {model.zipf_exponent:.3f}, Heaps beta {model.heaps_beta:.3f}, "
+          f"stopword rate {model.stop_rate:.3f}")
+    print(f"Wrote {generator.documents} documents with a vocabulary of {len(generator.words)} words to {args.output} "
+          f"and queries to {query_file}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+import argparse
+import fnmatch
+import heapq
+import re
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from analyzer import analyze
+from binary_index import BinaryIndex, open_binary_index
+from postings_cache import CachedPostingsIndex
+from postings_codec import varint_encode
+
+# Terms per front-coded block, a lookup decodes at most one block after the binary search of the block heads
+BLOCK_SIZE = 16
+# Characters that make a query word a pattern
+WILDCARDS = re.compile(r"[*?]")
+
+
+def read_varint(data, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+
+
+# Sorted term dictionary with front coding: every block stores its first term whole and each following term as
+# the length of the prefix it shares with the previous term plus the rest, in one bytes object
+# Term ids are positions in sorted order, df and the postings offset of every term are kept in parallel arrays
+class FrontCodedDictionary:
+
+    def __init__(self, entries, block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self.heads = []  # first term of every block, searched with bisect
+        self.block_offs = array('I')  # start of every block in data
+        self.dfs = array('I')
+        self.offsets = array('Q')
+        data = bytearray()
+        previous = b""
+        for term_id, (term, df, offset) in enumerate(entries):
+            encoded = term.encode('utf-8')
+            if term_id % block_size == 0:
+                self.heads.append(term)
+                self.block_offs.append(len(data))
+                shared = 0
+            else:
+                shared = 0
+                limit = min(len(previous), len(encoded))
+                while shared < limit and previous[shared] == encoded[shared]:
+                    shared += 1
+            varint_encode((shared, len(encoded) - shared), data)
+            data += encoded[shared:]
+            self.dfs.append(df)
+            self.offsets.append(offset)
+            previous = encoded
+        self.data = bytes(data)
+
+    def __len__(self):
+        return len(self.dfs)
+
+    def __contains__(self, term):
+        return self.term_id(term) >= 0
+
+    # Bytes held by the dictionary, without the Python object headers
+    def nbytes(self):
+        return (len(self.data) + self.block_offs.itemsize * len(self.block_offs) +
+                self.dfs.itemsize * len(self.dfs) + self.offsets.itemsize * len(self.offsets) +
+                sum(len(head) for head in self.heads))
+
+    def block_terms(self, block):
+        data = self.data
+        position = self.block_offs[block]
+        count = min(self.block_size, len(self.dfs) - block * self.block_size)
+        terms = []
+        previous = b""
+        for _ in range(count):
+            shared, position = read_varint(data, position)
+            length, position = read_varint(data, position)
+            previous = previous[:shared] + data[position:position + length]
+            position += length
+            terms.append(previous.decode('utf-8'))
+        return terms
+
+    # Term id of a term, or -1 when it is not in the dictionary
+    def term_id(self, term):
+        block = bisect_right(self.heads, term) - 1
+        if block < 0:
+            return -1
+        for position, block_term in enumerate(self.block_terms(block)):
+            if block_term == term:
+                return block * self.block_size + position
+            if block_term > term:
+                break
+        return -1
+
+    def term(self, term_id):
+        return self.block_terms(term_id // self.block_size)[term_id % self.block_size]
+
+    # (term, df, postings offset) of a term, or None
+    def lookup(self, term):
+        term_id = self.term_id(term)
+        if term_id < 0:
+            return None
+        return term, self.dfs[term_id], self.offsets[term_id]
+
+    # (term, df, postings offset) of every term starting with prefix, in term order
+    def prefix(self, prefix):
+        block = max(0, bisect_left(self.heads, prefix) - 1)
+        for block in range(block, len(self.heads)):
+            for position, term in enumerate(self.block_terms(block)):
+                if term.startswith(prefix):
+                    term_id = block * self.block_size + position
+                    yield term, self.dfs[term_id], self.offsets[term_id]
+                elif term > prefix:
+                    return
+
+    # Terms matching a pattern with * (any characters) and ? (one character), only the range of its literal
+    # prefix is decoded
+    def wildcard(self, pattern):
+        literal = WILDCARDS.split(pattern, 1)[0]
+        matcher = re.compile(fnmatch.translate(pattern))
+        for entry in self.prefix(literal):
+            if matcher.match(entry[0]):
+                yield entry
+
+    # Most frequent terms starting with prefix, ties in term order
+    def complete(self, prefix, limit=10):
+        return heapq.nlargest(limit, self.prefix(prefix), key=lambda entry: entry[1])
+
+
+# Dictionary of any postings index, a BinaryIndex gives its stored term order, df and postings offsets
+# A postings cache is looked through, reading the dictionary must neither decode every postings list nor fill the cache
+def build_dictionary(postings_index, block_size=BLOCK_SIZE):
+    if isinstance(postings_index, CachedPostingsIndex):
+        postings_index = postings_index.index
+    if isinstance(postings_index, BinaryIndex):
+        entries = ((postings_index.term(term_id),) + postings_index.term_entry(term_id)[1:3]
+                   for term_id in range(postings_index.num_terms))
+    else:
+        terms = sorted((term, len(docs)) for term, (idf, docs, tfs) in postings_index.iter_postings())
+        entries = ((term, df, term_id) for term_id, (term, df) in enumerate(terms))
+    return FrontCodedDictionary(entries, block_size)
+
+
+# Analysed query where words with * or ? are replaced by the indexed terms they match, at most max_expansions
+# terms of highest df per pattern. Expanded terms are indexed stems, so they are not stemmed again
+def expand_query(text, stopwords, p, dictionary, max_expansions=50):
+    query = []
+    plain = []
+    for word in text.lower().split():
+        if WILDCARDS.search(word):
+            query.extend(analyze(" ".join(plain), stopwords, p))
+            plain = []
+            matches = heapq.nlargest(max_expansions, dictionary.wildcard(word), key=lambda entry: entry[1])
+            query.extend(sorted(term for term, df, offset in matches))
+        else:
+            plain.append(word)
+    query.extend(analyze(" ".join(plain), stopwords, p))
+    return query
+
+
+# Tab completion of the last word of an input() line by df, when the readline module is available
+def enable_completion(dictionary, limit=10):
+    try:
+        import readline
+    except ImportError:
+        return False
+
+    def completer(text, state):
+        suggestions = [term for term, df, offset in dictionary.complete(text.lower(), limit)]
+        return suggestions[state] if state < len(suggestions) else None
+
+    readline.set_completer(completer)
+    readline.parse_and_bind("tab: complete")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Front-coded term dictionary lookups')
+    parser.add_argument('patterns', nargs='*', default=["aero*", "wing?", "*flow"],
+                        help='Terms, prefixes ending with * or patterns with * and ?')
+    parser.add_argument('-i', '--index', default="index.bin", help='Binary index file')
+    parser.add_argument('-b', '--block-size', type=int, default=BLOCK_SIZE, help='Terms per front-coded block')
+    parser.add_argument('-n', '--limit', type=int, default=10, help='Terms shown per pattern')
+    args = parser.parse_args()
+
+    index = open_binary_index(args.index)
+    start_time = time.perf_counter()
+    dictionary = build_dictionary(index, args.block_size)
+    build_time = time.perf_counter() - start_time
+    raw_bytes = sum(len(index.term(term_id).encode('utf-8')) for term_id in range(index.num_terms))
+    print(f"{len(dictionary)} terms in {dictionary.nbytes()} bytes ({raw_bytes} bytes of term text), "
+          f"built in {1000 * build_time:.1f} ms")
+    for pattern in args.patterns:
+        start_time = time.perf_counter()
+        if WILDCARDS.search(pattern):
+            matches = list(dictionary.wildcard(pattern))
+        else:
+            matches = [entry for entry in [dictionary.lookup(pattern)] if entry is not None]
+        seconds = time.perf_counter() - start_time
+        top = heapq.nlargest(args.limit, matches, key=lambda entry: entry[1])
+        print(f"{pattern}: {len(matches)} terms in {1000 * seconds:.3f} ms, by df: "
+              + ", ".join(f"{term} ({df})" for term, df, offset in top))
+
+
+if __name__ == '__main__':
+    main()